@@ -18,21 +18,64 @@ TON_RUB_CACHE_TTL = 60  # секунд
 
 # --- Баланс ---
 START_BALANCE_COINS = 0
+BALANCE_FLUSH_INTERVAL_SECONDS = 2  # как часто сбрасываем изменённые балансы в БД
+BALANCE_FLUSH_MAX_PENDING = 5000    # лимит «грязных» пользователей до досрочного сброса
+STARTUP_LOAD_CHUNK_SIZE = 5000      # строк за один FETCH при загрузке кэша на старте
+# "eager" — весь users в памяти с самого старта;
+# "lazy" — пользователь подгружается при первом обращении, кэш ограничен LRU
+BALANCE_CACHE_MODE = os.getenv("BALANCE_CACHE_MODE", "eager")
+BALANCE_CACHE_MAX_USERS = 100000    # лимит кэша в режиме "lazy"
+# "dict" — обычные словари; "compact" — массивы int64 с открытой адресацией
+# (≈45–55 байт на пользователя вместо ≈130–145, см. app/services/balance_store.py)
+BALANCE_STORE = os.getenv("BALANCE_STORE", "dict")
+USER_LOCK_STRIPES = 1024            # полос замков «проверить баланс → списать»
+
+# --- Фоновые задачи ---
+BACKGROUND_TASKS_MAX_CONCURRENCY = 4  # сколько фоновых задач с БД выполняются одновременно
+BACKGROUND_TASKS_MAX_BACKLOG = 1000   # сколько ждут в очереди, дальше — отбрасываем
+BACKGROUND_TASKS_DRAIN_TIMEOUT = 10   # сколько ждём фоновые задачи при остановке, секунд
+
+# --- Журнал балансов (ledger) ---
+LEDGER_FLUSH_INTERVAL_SECONDS = 2
+LEDGER_MAX_PENDING = 20000               # при переполнении буфер сбрасывается досрочно
+LEDGER_SNAPSHOT_INTERVAL_SECONDS = 3600  # как часто делаем снимок балансов
+
+# --- Состояние диалога (ввод ставок, вывод, перевод) ---
+USER_STATE_BACKEND = os.getenv("USER_STATE_BACKEND", "memory")  # "memory" или "redis"
+USER_STATE_TTL_SECONDS = 900  # брошенный на полпути ввод забываем через 15 минут
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# --- Снимок живых игр (открытые кости и раунд Банкира) ---
+LIVE_STATE_PATH = os.getenv("LIVE_STATE_PATH", "live_state.json")
+LIVE_STATE_RETRY_SECONDS = 1       # первая пауза перед повтором сорвавшейся записи
+LIVE_STATE_RETRY_MAX_SECONDS = 30  # дальше пауза удваивается до этого предела
 
 # --- История игр ---
 HISTORY_LIMIT = 30
 HISTORY_PAGE_SIZE = 10
+HISTORY_CACHE_MAX_USERS = 10000  # сколько пользователей держим в кэше истории
+HISTORY_CACHE_TTL_SECONDS = 300  # статистика «за сутки/неделю» устаревает со временем
 
 # --- Кости ---
 GAME_CANCEL_TTL_SECONDS = 60
 DICE_MIN_BET = 10
 DICE_BET_MIN_CANCEL_AGE = timedelta(minutes=1)
+RATING_WINDOW_DAYS = 30  # окно рейтинга костей (дней)
+LOBBY_PAGE_SIZE = 10  # игр на одной странице лобби
+LOBBY_BET_BUCKETS = (10, 100, 1000, 10000)  # нижние границы фильтров по ставке, ₽
 
 # --- Банкир ---
 RAFFLE_TIMER_SECONDS = 60
 RAFFLE_MIN_BET = 10
 RAFFLE_MAX_BETS_PER_ROUND = 10
 RAFFLE_CANCEL_WINDOW_SECONDS = 600  # 10 минут
+# Комнаты: независимые раунды, сгруппированные по ставке за долю
+RAFFLE_STAKE_TIERS = (10, 100, 1000)  # нижние границы уровней ставок, ₽
+RAFFLE_ROOM_MAX_PARTICIPANTS = 50     # заполненная комната — новичков ведём в новую
+RAFFLE_MAX_ROOMS_PER_TIER = 5         # больше комнат одного уровня не открываем
+RAFFLE_ID_BLOCK_SIZE = 100            # id раундов резервируются в БД блоками (hi/lo)
+RAFFLE_SAVE_RETRY_SECONDS = 5         # пауза перед повтором записи итога раунда
+RAFFLE_DRAW_RETRY_SECONDS = 5         # пауза перед повтором сорвавшегося розыгрыша
 
 # --- Админы ---
 MAIN_ADMIN_ID = 7106398341
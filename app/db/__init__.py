@@ -2,11 +2,14 @@
 
 from .pool import init_db, pool
 from .users import upsert_user, get_user_registered_at
+from .stats import bump_user_stats, get_user_profile
 from .games import (
     upsert_game,
-    get_user_games,
+    settle_dice_game,
+    get_user_games_page,
+    get_user_games_stats,
     get_user_dice_games_count,
-    get_users_profit_and_games_30_days,
+    get_dice_rating_30_days,
 )
 from .raffle import (
     upsert_raffle_round,
@@ -22,10 +25,14 @@ __all__ = [
     "init_db",
     "upsert_user",
     "get_user_registered_at",
+    "bump_user_stats",
+    "get_user_profile",
     "upsert_game",
-    "get_user_games",
+    "settle_dice_game",
+    "get_user_games_page",
+    "get_user_games_stats",
     "get_user_dice_games_count",
-    "get_users_profit_and_games_30_days",
+    "get_dice_rating_30_days",
     "upsert_raffle_round",
     "add_raffle_bet",
     "get_user_raffle_bets_count",
@@ -1,7 +1,7 @@
 # app/db/deposits.py
 from datetime import datetime, timezone
 
-from .pool import pool
+import app.db.pool as db_pool
 
 
 async def add_ton_deposit(
@@ -12,6 +12,7 @@ async def add_ton_deposit(
     comment: str,
 ):
     """Сохранить факт пополнения через TON."""
+    pool = db_pool.pool
     if not pool:
         return
     async with pool.acquire() as db:
@@ -25,5 +26,5 @@ async def add_ton_deposit(
             ton_amount,
             coins,
             comment,
-            datetime.now(timezone.utc).isoformat(),
+            datetime.now(timezone.utc),
         )
@@ -1,7 +1,10 @@
 # app/db/games.py
 
-from typing import Dict, Any, List
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 import app.db.pool as db_pool  # ⬅ импортируем МОДУЛЬ, а не переменную
+from app.db.stats import bump_user_stats
+from app.db.users import write_user_balances
 
 
 def _get_pool():
@@ -17,58 +20,203 @@ def _get_pool():
 # -------------------------------------------
 # СОХРАНЕНИЕ/ОБНОВЛЕНИЕ ИГР
 # -------------------------------------------
+_UPSERT_GAME_SQL = """
+    INSERT INTO games (
+        id, creator_id, opponent_id, bet,
+        creator_roll, opponent_roll, winner,
+        finished, created_at, finished_at
+    ) VALUES (
+        $1,$2,$3,$4,$5,$6,$7,$8,$9,$10
+    )
+    ON CONFLICT (id) DO UPDATE SET
+        creator_id = EXCLUDED.creator_id,
+        opponent_id = EXCLUDED.opponent_id,
+        bet = EXCLUDED.bet,
+        creator_roll = EXCLUDED.creator_roll,
+        opponent_roll = EXCLUDED.opponent_roll,
+        winner = EXCLUDED.winner,
+        finished = EXCLUDED.finished,
+        created_at = EXCLUDED.created_at,
+        finished_at = EXCLUDED.finished_at
+"""
+
+
+def _game_args(g: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (
+        g["id"],
+        g["creator_id"],
+        g["opponent_id"],
+        g["bet"],
+        g["creator_roll"],
+        g["opponent_roll"],
+        g["winner"],
+        g["finished"],
+        g["created_at"],
+        g["finished_at"],
+    )
+
+
 async def upsert_game(g: Dict[str, Any]):
     pool = _get_pool()
     async with pool.acquire() as db:
-        await db.execute(
-            """
-            INSERT INTO games (
-                id, creator_id, opponent_id, bet,
-                creator_roll, opponent_roll, winner,
-                finished, created_at, finished_at
-            ) VALUES (
-                $1,$2,$3,$4,$5,$6,$7,$8,$9,$10
-            )
-            ON CONFLICT (id) DO UPDATE SET
-                creator_id = EXCLUDED.creator_id,
-                opponent_id = EXCLUDED.opponent_id,
-                bet = EXCLUDED.bet,
-                creator_roll = EXCLUDED.creator_roll,
-                opponent_roll = EXCLUDED.opponent_roll,
-                winner = EXCLUDED.winner,
-                finished = EXCLUDED.finished,
-                created_at = EXCLUDED.created_at,
-                finished_at = EXCLUDED.finished_at
-            """,
-            g["id"],
-            g["creator_id"],
-            g["opponent_id"],
-            g["bet"],
-            g["creator_roll"],
-            g["opponent_roll"],
-            g["winner"],
-            g["finished"],
-            g["created_at"],
-            g["finished_at"],
+        await db.execute(_UPSERT_GAME_SQL, *_game_args(g))
+
+
+async def get_max_game_id() -> int:
+    """Наибольший id игры в БД (0, если игр нет)."""
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        return await db.fetchval("SELECT COALESCE(MAX(id), 0) FROM games")
+
+
+async def get_finished_game_ids(ids: List[int]) -> List[int]:
+    """Какие из игр ids в БД уже завершены."""
+    if not ids:
+        return []
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        rows = await db.fetch(
+            "SELECT id FROM games WHERE id = ANY($1::int[]) AND finished",
+            ids,
         )
+    return [r["id"] for r in rows]
+
+
+async def settle_dice_game(
+    g: Dict[str, Any],
+    user_rows: List[Tuple[int, Optional[str], int]],
+) -> Dict[int, int]:
+    """
+    Расчёт игры одной транзакцией на одном соединении:
+    - результат игры
+    - балансы участников расчёта (user_id, username, balance): оба игрока и комиссия
+    - счётчики user_stats
+    Возвращает закоммиченные балансы {user_id: balance}.
+    """
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            await db.execute(_UPSERT_GAME_SQL, *_game_args(g))
+            committed = await write_user_balances(db, user_rows)
+            await bump_user_stats(db, (g["creator_id"], g["opponent_id"]), dice_games=1)
+
+    return committed
 
 
 # -------------------------------------------
-# ИСТОРИЯ ИГР ПОЛЬЗОВАТЕЛЯ
+# ИСТОРИЯ ИГР ПОЛЬЗОВАТЕЛЯ (keyset-пагинация)
 # -------------------------------------------
-async def get_user_games(uid: int) -> List[Dict[str, Any]]:
+HISTORY_COLUMNS = (
+    "id, creator_id, opponent_id, bet, creator_roll, opponent_roll, winner, finished_at"
+)
+
+
+async def get_user_games_page(
+    uid: int,
+    cursor: Optional[Tuple[datetime, int]] = None,
+    direction: str = "older",
+    limit: int = 10,
+) -> List[Dict[str, Any]]:
+    """
+    Страница завершённых игр пользователя, от новых к старым.
+    cursor — (finished_at, id) граничной игры:
+    - direction="older": игры старше курсора (следующая страница)
+    - direction="newer": игры новее курсора (предыдущая страница)
+    Каждая ветка UNION ALL идёт по своему индексу (creator_id/opponent_id, finished_at).
+    """
     pool = _get_pool()
+
+    older = direction != "newer"
+    order = "DESC" if older else "ASC"
+    if cursor is None:
+        keyset = ""
+        args: List[Any] = [uid, limit]
+    else:
+        cmp = "<" if older else ">"
+        keyset = f"AND (finished_at, id) {cmp} ($3, $4)"
+        args = [uid, limit, cursor[0], cursor[1]]
+
     async with pool.acquire() as db:
         rows = await db.fetch(
+            f"""
+            SELECT {HISTORY_COLUMNS}
+            FROM (
+                (
+                    SELECT {HISTORY_COLUMNS}
+                    FROM games
+                    WHERE creator_id = $1 AND finished = TRUE {keyset}
+                    ORDER BY finished_at {order}, id {order}
+                    LIMIT $2
+                )
+                UNION ALL
+                (
+                    SELECT {HISTORY_COLUMNS}
+                    FROM games
+                    WHERE opponent_id = $1 AND creator_id <> $1 AND finished = TRUE {keyset}
+                    ORDER BY finished_at {order}, id {order}
+                    LIMIT $2
+                )
+            ) g
+            ORDER BY finished_at {order}, id {order}
+            LIMIT $2
+            """,
+            *args,
+        )
+
+    result = [dict(r) for r in rows]
+    if not older:
+        result.reverse()
+    return result
+
+
+async def get_user_games_stats(uid: int) -> Dict[str, Dict[str, int]]:
+    """
+    Количество игр и профит пользователя за сутки / неделю / месяц —
+    одним агрегатом в БД, без выгрузки самих игр.
+    """
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        row = await db.fetchrow(
             """
-            SELECT *
-            FROM games
-            WHERE creator_id = $1 OR opponent_id = $1
-            ORDER BY id DESC
+            WITH mine AS (
+                SELECT
+                    finished_at,
+                    CASE winner
+                        WHEN 'creator' THEN bet
+                        WHEN 'opponent' THEN -bet
+                        ELSE 0
+                    END AS profit
+                FROM games
+                WHERE creator_id = $1 AND finished = TRUE
+                  AND finished_at >= NOW() - INTERVAL '30 days'
+                UNION ALL
+                SELECT
+                    finished_at,
+                    CASE winner
+                        WHEN 'opponent' THEN bet
+                        WHEN 'creator' THEN -bet
+                        ELSE 0
+                    END AS profit
+                FROM games
+                WHERE opponent_id = $1 AND creator_id <> $1 AND finished = TRUE
+                  AND finished_at >= NOW() - INTERVAL '30 days'
+            )
+            SELECT
+                COUNT(*) AS month_games,
+                COALESCE(SUM(profit), 0) AS month_profit,
+                COUNT(*) FILTER (WHERE finished_at >= NOW() - INTERVAL '7 days') AS week_games,
+                COALESCE(SUM(profit) FILTER (WHERE finished_at >= NOW() - INTERVAL '7 days'), 0) AS week_profit,
+                COUNT(*) FILTER (WHERE finished_at >= NOW() - INTERVAL '1 day') AS day_games,
+                COALESCE(SUM(profit) FILTER (WHERE finished_at >= NOW() - INTERVAL '1 day'), 0) AS day_profit
+            FROM mine
             """,
             uid,
         )
-        return [dict(r) for r in rows]
+
+    return {
+        period: {"games": row[f"{period}_games"], "profit": row[f"{period}_profit"]}
+        for period in ("month", "week", "day")
+    }
 
 
 # -------------------------------------------
@@ -77,38 +225,126 @@ async def get_user_games(uid: int) -> List[Dict[str, Any]]:
 async def get_user_dice_games_count(uid: int) -> int:
     pool = _get_pool()
     async with pool.acquire() as db:
-        row = await db.fetchrow(
-            """
-            SELECT COUNT(*) AS c
-            FROM games
-            WHERE finished = TRUE AND (creator_id = $1 OR opponent_id = $1)
-            """,
+        count = await db.fetchval(
+            "SELECT dice_games FROM user_stats WHERE user_id = $1",
             uid,
         )
-        return row["c"] if row else 0
+        return count if count is not None else 0
 
 
 # -------------------------------------------
 # РЕЙТИНГ (прибыль за 30 дней)
 # -------------------------------------------
-async def get_users_profit_and_games_30_days() -> List[Dict[str, Any]]:
+async def get_dice_rating_30_days(
+    requesting_uid: int,
+    top_n: int = 3,
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]], int]:
+    """
+    Рейтинг костей за 30 дней, посчитанный целиком в Postgres.
+    Возвращает (топ-N строк, строка запрашивающего или None, всего игроков).
+    Каждая строка: user_id, profit, games, place.
+    """
     pool = _get_pool()
     async with pool.acquire() as db:
         rows = await db.fetch(
             """
-            SELECT
-                u.user_id,
-                COALESCE(SUM(g.profit), 0) AS profit,
-                COUNT(g.id) AS games
-            FROM users u
-            LEFT JOIN games g ON g.winner = u.user_id 
-                AND g.finished = TRUE
-                AND g.finished_at >= NOW() - INTERVAL '30 days'
-            GROUP BY u.user_id
-            ORDER BY profit DESC
-            """
+            WITH recent AS (
+                SELECT creator_id, opponent_id, bet, winner
+                FROM games
+                WHERE finished = TRUE
+                  AND finished_at >= NOW() - INTERVAL '30 days'
+            ),
+            per_game AS (
+                SELECT
+                    creator_id AS user_id,
+                    CASE winner
+                        WHEN 'creator' THEN bet
+                        WHEN 'opponent' THEN -bet
+                        ELSE 0
+                    END AS profit
+                FROM recent
+                UNION ALL
+                SELECT
+                    opponent_id AS user_id,
+                    CASE winner
+                        WHEN 'opponent' THEN bet
+                        WHEN 'creator' THEN -bet
+                        ELSE 0
+                    END AS profit
+                FROM recent
+                WHERE opponent_id IS NOT NULL
+            ),
+            ranked AS (
+                SELECT
+                    user_id,
+                    SUM(profit) AS profit,
+                    COUNT(*) AS games,
+                    ROW_NUMBER() OVER (
+                        ORDER BY SUM(profit) DESC, COUNT(*) ASC, user_id
+                    ) AS place,
+                    COUNT(*) OVER () AS total_players
+                FROM per_game
+                GROUP BY user_id
+            )
+            SELECT user_id, profit, games, place, total_players
+            FROM ranked
+            WHERE place <= $2 OR user_id = $1
+            ORDER BY place
+            """,
+            requesting_uid,
+            top_n,
         )
-        return [dict(r) for r in rows]
+
+    if not rows:
+        return [], None, 0
+
+    total_players = rows[0]["total_players"]
+    result = [
+        {
+            "user_id": r["user_id"],
+            "profit": r["profit"],
+            "games": r["games"],
+            "place": r["place"],
+        }
+        for r in rows
+    ]
+    top = [r for r in result if r["place"] <= top_n]
+    me = next((r for r in result if r["user_id"] == requesting_uid), None)
+    return top, me, total_players
+
+
+# -------------------------------------------
+# ПОТОКОВАЯ ВЫГРУЗКА ДЛЯ РЕЙТИНГА В ПАМЯТИ
+# -------------------------------------------
+async def iter_finished_games_since(
+    since: datetime,
+    chunk_size: int = 1000,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Завершённые игры начиная с since — серверным курсором, пачками по chunk_size.
+    creator_profit: профит создателя (у соперника он с обратным знаком).
+    """
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        async with db.transaction():
+            async for r in db.cursor(
+                """
+                SELECT
+                    creator_id,
+                    opponent_id,
+                    finished_at,
+                    CASE winner
+                        WHEN 'creator' THEN bet
+                        WHEN 'opponent' THEN -bet
+                        ELSE 0
+                    END AS creator_profit
+                FROM games
+                WHERE finished = TRUE AND finished_at >= $1
+                """,
+                since,
+                prefetch=chunk_size,
+            ):
+                yield dict(r)
 
 
 # -------------------------------------------
@@ -0,0 +1,155 @@
+# app/db/ledger.py
+from datetime import date, datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import app.db.pool as db_pool
+
+LedgerRow = Tuple[int, int, str, Optional[int], datetime]
+
+
+async def append_ledger_entries(
+    rows: List[LedgerRow],
+    months: Iterable[date] = (),
+) -> None:
+    """
+    Дописать пачку записей журнала (user_id, delta, reason, ref_id, ts) через COPY.
+    months — месяцы, для которых перед записью нужно создать партиции.
+    """
+    pool = db_pool.pool
+    if not pool or not rows:
+        return
+    async with pool.acquire() as db:
+        async with db.transaction():
+            for month in months:
+                await db.execute("SELECT ensure_ledger_partition($1)", month)
+            await db.copy_records_to_table(
+                "ledger",
+                records=rows,
+                columns=["user_id", "delta", "reason", "ref_id", "ts"],
+            )
+
+
+async def ensure_ledger_partitions(months: Iterable[date]) -> None:
+    """Создать месячные партиции журнала, если их ещё нет."""
+    pool = db_pool.pool
+    if not pool:
+        return
+    async with pool.acquire() as db:
+        for month in months:
+            await db.execute("SELECT ensure_ledger_partition($1)", month)
+
+
+async def create_balance_snapshot(keep: int = 2) -> Optional[int]:
+    """
+    Новый снимок балансов = предыдущий снимок + записи журнала после него.
+    Старые снимки (кроме последних keep) удаляются.
+    Возвращает id снимка.
+    """
+    pool = db_pool.pool
+    if not pool:
+        return None
+    async with pool.acquire() as db:
+        async with db.transaction():
+            prev = await db.fetchrow(
+                "SELECT id, last_ledger_id FROM balance_snapshots ORDER BY id DESC LIMIT 1"
+            )
+            snap = await db.fetchrow(
+                """
+                INSERT INTO balance_snapshots (last_ledger_id)
+                SELECT COALESCE(MAX(id), 0) FROM ledger
+                RETURNING id, last_ledger_id
+            """
+            )
+            await db.execute(
+                """
+                INSERT INTO balance_snapshot_rows (snapshot_id, user_id, balance)
+                SELECT $1, user_id, SUM(amount)
+                FROM (
+                    SELECT user_id, balance AS amount
+                    FROM balance_snapshot_rows
+                    WHERE snapshot_id = $2
+                    UNION ALL
+                    SELECT user_id, delta
+                    FROM ledger
+                    WHERE id > $3 AND id <= $4
+                ) t
+                GROUP BY user_id
+            """,
+                snap["id"],
+                prev["id"] if prev else 0,
+                prev["last_ledger_id"] if prev else 0,
+                snap["last_ledger_id"],
+            )
+            await db.execute(
+                """
+                DELETE FROM balance_snapshots
+                WHERE id NOT IN (
+                    SELECT id FROM balance_snapshots ORDER BY id DESC LIMIT $1
+                )
+            """,
+                keep,
+            )
+        return snap["id"]
+
+
+_LEDGER_BALANCES_SQL = """
+    WITH snap AS (
+        SELECT id, last_ledger_id
+        FROM balance_snapshots
+        ORDER BY id DESC
+        LIMIT 1
+    )
+    SELECT user_id, SUM(amount) AS balance
+    FROM (
+        SELECT user_id, balance AS amount
+        FROM balance_snapshot_rows
+        WHERE snapshot_id = (SELECT id FROM snap)
+        UNION ALL
+        SELECT user_id, delta
+        FROM ledger
+        WHERE id > COALESCE((SELECT last_ledger_id FROM snap), 0)
+    ) t
+    GROUP BY user_id
+"""
+
+
+async def get_ledger_balances() -> Dict[int, int]:
+    """Балансы по журналу: последний снимок + хвост журнала после него."""
+    pool = db_pool.pool
+    if not pool:
+        return {}
+    async with pool.acquire() as db:
+        rows = await db.fetch(_LEDGER_BALANCES_SQL)
+    return {r["user_id"]: r["balance"] for r in rows}
+
+
+async def find_balance_mismatches(limit: int = 20) -> Tuple[int, List[Dict[str, int]]]:
+    """
+    Сверка users.balance с журналом.
+    Возвращает (сколько всего расхождений, первые limit из них).
+    """
+    pool = db_pool.pool
+    if not pool:
+        return 0, []
+    async with pool.acquire() as db:
+        rows = await db.fetch(
+            f"""
+            WITH ledger_balances AS ({_LEDGER_BALANCES_SQL})
+            SELECT
+                COALESCE(u.user_id, l.user_id) AS user_id,
+                COALESCE(u.balance, 0) AS cached,
+                COALESCE(l.balance, 0) AS ledger,
+                COUNT(*) OVER () AS total
+            FROM users u
+            FULL JOIN ledger_balances l ON l.user_id = u.user_id
+            WHERE COALESCE(u.balance, 0) <> COALESCE(l.balance, 0)
+            ORDER BY 1
+            LIMIT $1
+        """,
+            limit,
+        )
+    total = rows[0]["total"] if rows else 0
+    return total, [
+        {"user_id": r["user_id"], "cached": r["cached"], "ledger": r["ledger"]}
+        for r in rows
+    ]
@@ -1,21 +1,293 @@
 # app/db/pool.py
+import asyncio
 import os
+import time
 from datetime import datetime, timezone
-from typing import Dict
+from typing import Dict, List, MutableMapping, Optional, Tuple
 
 import asyncpg
 
+from app.config import RAFFLE_ID_BLOCK_SIZE, STARTUP_LOAD_CHUNK_SIZE
+
 
 # Глобальный пул подключений к PostgreSQL
 pool: asyncpg.Pool | None = None
 
 
+# -------------------------------------------
+# МИГРАЦИИ СХЕМЫ
+# -------------------------------------------
+# (версия, название, список SQL). Применяются по порядку, каждая — в своей
+# транзакции; применённые версии хранятся в schema_migrations.
+# Новые изменения схемы — только новой версией в конец списка.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (
+        1,
+        "typed timestamps and boolean games.finished",
+        [
+            """
+            ALTER TABLE users
+                ALTER COLUMN registered_at TYPE TIMESTAMPTZ
+                    USING NULLIF(registered_at, '')::timestamptz
+            """,
+            """
+            ALTER TABLE games
+                ALTER COLUMN created_at TYPE TIMESTAMPTZ
+                    USING NULLIF(created_at, '')::timestamptz,
+                ALTER COLUMN finished_at TYPE TIMESTAMPTZ
+                    USING NULLIF(finished_at, '')::timestamptz,
+                ALTER COLUMN finished TYPE BOOLEAN
+                    USING COALESCE(finished, 0) <> 0
+            """,
+            """
+            ALTER TABLE raffle_rounds
+                ALTER COLUMN created_at TYPE TIMESTAMPTZ
+                    USING NULLIF(created_at, '')::timestamptz,
+                ALTER COLUMN finished_at TYPE TIMESTAMPTZ
+                    USING NULLIF(finished_at, '')::timestamptz
+            """,
+            """
+            ALTER TABLE ton_deposits
+                ALTER COLUMN at TYPE TIMESTAMPTZ
+                    USING NULLIF(at, '')::timestamptz
+            """,
+            """
+            ALTER TABLE transfers
+                ALTER COLUMN at TYPE TIMESTAMPTZ
+                    USING NULLIF(at, '')::timestamptz
+            """,
+        ],
+    ),
+    (
+        2,
+        "indexes for history, profile and rating queries",
+        [
+            "CREATE INDEX IF NOT EXISTS games_creator_finished_idx ON games (creator_id, finished_at)",
+            "CREATE INDEX IF NOT EXISTS games_opponent_finished_idx ON games (opponent_id, finished_at)",
+            "CREATE INDEX IF NOT EXISTS raffle_bets_user_raffle_idx ON raffle_bets (user_id, raffle_id)",
+            "CREATE INDEX IF NOT EXISTS raffle_bets_raffle_idx ON raffle_bets (raffle_id)",
+            "CREATE INDEX IF NOT EXISTS raffle_rounds_finished_idx ON raffle_rounds (finished_at)",
+            "CREATE INDEX IF NOT EXISTS transfers_from_at_idx ON transfers (from_id, at)",
+            "CREATE INDEX IF NOT EXISTS transfers_to_at_idx ON transfers (to_id, at)",
+        ],
+    ),
+    (
+        3,
+        "partial index for the 30-day dice rating",
+        [
+            "CREATE INDEX IF NOT EXISTS games_finished_at_idx ON games (finished_at) WHERE finished",
+        ],
+    ),
+    (
+        4,
+        "user_stats counters for the profile",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS user_stats (
+                user_id BIGINT PRIMARY KEY,
+                dice_games INTEGER NOT NULL DEFAULT 0,
+                raffle_rounds INTEGER NOT NULL DEFAULT 0
+            )
+            """,
+            """
+            INSERT INTO user_stats (user_id, dice_games)
+            SELECT user_id, COUNT(*)
+            FROM (
+                SELECT creator_id AS user_id FROM games WHERE finished
+                UNION ALL
+                SELECT opponent_id FROM games
+                WHERE finished AND opponent_id IS NOT NULL AND opponent_id <> creator_id
+            ) g
+            GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET dice_games = EXCLUDED.dice_games
+            """,
+            """
+            INSERT INTO user_stats (user_id, raffle_rounds)
+            SELECT user_id, COUNT(DISTINCT raffle_id)
+            FROM raffle_bets
+            GROUP BY user_id
+            ON CONFLICT (user_id) DO UPDATE SET raffle_rounds = EXCLUDED.raffle_rounds
+            """,
+        ],
+    ),
+    (
+        5,
+        "append-only balance ledger partitioned by month, balance snapshots",
+        [
+            """
+            CREATE TABLE IF NOT EXISTS ledger (
+                id BIGSERIAL,
+                user_id BIGINT NOT NULL,
+                delta BIGINT NOT NULL,
+                reason TEXT NOT NULL,
+                ref_id BIGINT,
+                ts TIMESTAMPTZ NOT NULL,
+                PRIMARY KEY (id, ts)
+            ) PARTITION BY RANGE (ts)
+            """,
+            "CREATE INDEX IF NOT EXISTS ledger_user_ts_idx ON ledger (user_id, ts)",
+            """
+            CREATE OR REPLACE FUNCTION ensure_ledger_partition(p_month DATE) RETURNS VOID AS $$
+            DECLARE
+                m DATE := date_trunc('month', p_month)::date;
+            BEGIN
+                EXECUTE format(
+                    'CREATE TABLE IF NOT EXISTS %I PARTITION OF ledger FOR VALUES FROM (%L) TO (%L)',
+                    'ledger_' || to_char(m, 'YYYY_MM'),
+                    m::timestamp AT TIME ZONE 'UTC',
+                    (m + INTERVAL '1 month')::timestamp AT TIME ZONE 'UTC'
+                );
+            END
+            $$ LANGUAGE plpgsql
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balance_snapshots (
+                id BIGSERIAL PRIMARY KEY,
+                taken_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                last_ledger_id BIGINT NOT NULL
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS balance_snapshot_rows (
+                snapshot_id BIGINT NOT NULL REFERENCES balance_snapshots (id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                balance BIGINT NOT NULL,
+                PRIMARY KEY (snapshot_id, user_id)
+            )
+            """,
+            # стартовые записи: текущие балансы становятся «открытием» журнала
+            "SELECT ensure_ledger_partition((NOW() AT TIME ZONE 'UTC')::date)",
+            """
+            INSERT INTO ledger (user_id, delta, reason, ts)
+            SELECT user_id, balance, 'opening', NOW()
+            FROM users
+            WHERE COALESCE(balance, 0) <> 0
+            """,
+        ],
+    ),
+    (
+        6,
+        "case-insensitive username index",
+        [
+            "CREATE INDEX IF NOT EXISTS users_username_lower_idx ON users (lower(username))",
+        ],
+    ),
+    (
+        7,
+        "raffle round ids reserved from the sequence in blocks",
+        [
+            # раньше id раундов брались из счётчика процесса: ставим
+            # последовательность выше всего, что уже есть в обеих таблицах
+            """
+            SELECT setval(
+                pg_get_serial_sequence('raffle_rounds', 'id'),
+                GREATEST(
+                    (SELECT COALESCE(MAX(id), 0) FROM raffle_rounds),
+                    (SELECT COALESCE(MAX(raffle_id), 0) FROM raffle_bets),
+                    1
+                )
+            )
+            """,
+            # один nextval = блок id (hi/lo), см. reserve_raffle_id_block
+            f"""
+            DO $$
+            BEGIN
+                EXECUTE format(
+                    'ALTER SEQUENCE %s INCREMENT BY {RAFFLE_ID_BLOCK_SIZE}',
+                    pg_get_serial_sequence('raffle_rounds', 'id')
+                );
+            END
+            $$
+            """,
+        ],
+    ),
+]
+
+# ключ advisory-lock, чтобы два инстанса не мигрировали одновременно
+MIGRATIONS_LOCK_ID = 7106398341
+
+
+async def run_migrations(db: asyncpg.Connection) -> None:
+    """Применить все ещё не применённые миграции из MIGRATIONS."""
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """
+    )
+
+    await db.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+    try:
+        applied = {
+            r["version"] for r in await db.fetch("SELECT version FROM schema_migrations")
+        }
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            async with db.transaction():
+                for sql in statements:
+                    await db.execute(sql)
+                await db.execute(
+                    "INSERT INTO schema_migrations (version, name) VALUES ($1, $2)",
+                    version,
+                    name,
+                )
+            print(f"🗄 Применена миграция {version}: {name}")
+    finally:
+        await db.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+
+async def _load_users(
+    user_balances: MutableMapping[int, int],
+    user_usernames: MutableMapping[int, str],
+    username_index: Optional[Dict[str, int]],
+) -> int:
+    """Потоково загрузить пользователей в кэш через серверный курсор."""
+    count = 0
+    async with pool.acquire() as db:
+        async with db.transaction():  # курсор живёт только внутри транзакции
+            async for record in db.cursor(
+                "SELECT user_id, username, balance FROM users",
+                prefetch=STARTUP_LOAD_CHUNK_SIZE,
+            ):
+                uid = record["user_id"]
+                user_balances[uid] = record["balance"] or 0
+                user_usernames[uid] = record["username"]
+                if username_index is not None and record["username"]:
+                    username_index[record["username"].lower()] = uid
+                count += 1
+    return count
+
+
+async def _load_ton_deposits(processed_ton_tx: set[str]) -> int:
+    """Потоково загрузить хэши обработанных TON-транзакций."""
+    count = 0
+    async with pool.acquire() as db:
+        async with db.transaction():
+            async for record in db.cursor(
+                "SELECT tx_hash FROM ton_deposits",
+                prefetch=STARTUP_LOAD_CHUNK_SIZE,
+            ):
+                processed_ton_tx.add(record["tx_hash"])
+                count += 1
+    return count
+
+
 async def init_db(
-    user_balances: Dict[int, int],
-    user_usernames: Dict[int, str],
+    user_balances: MutableMapping[int, int],
+    user_usernames: MutableMapping[int, str],
     processed_ton_tx: set[str],
+    preload_users: bool = True,
+    username_index: Optional[Dict[str, int]] = None,
 ):
-    """Инициализация пула подключений и создание таблиц + загрузка кэша."""
+    """
+    Инициализация пула подключений и создание таблиц + загрузка кэша.
+    preload_users=False — пользователи не загружаются (ленивый кэш балансов).
+    username_index — заполняется парами username.lower() -> user_id.
+    """
     global pool
 
     DATABASE_URL = os.environ.get("DATABASE_URL")
@@ -110,18 +382,21 @@ async def init_db(
         """
         )
 
-        # 7. Загрузка пользователей в память
-        records = await db.fetch("SELECT user_id, username, balance FROM users")
-        for record in records:
-            uid = record["user_id"]
-            username = record["username"]
-            balance = record["balance"]
-            user_balances[uid] = balance
-            user_usernames[uid] = username
-
-        # 8. Загрузка обработанных TON-транзакций
-        records = await db.fetch("SELECT tx_hash FROM ton_deposits")
-        for record in records:
-            processed_ton_tx.add(record["tx_hash"])
+        # Типы колонок и индексы — через версионные миграции
+        await run_migrations(db)
+
+    # 7–8. Загрузка пользователей и обработанных TON-транзакций в память.
+    # Читаем пачками по STARTUP_LOAD_CHUNK_SIZE, не собирая таблицы целиком
+    # в списки; обе таблицы грузятся параллельно на разных соединениях.
+    started = time.monotonic()
+    loads = [_load_ton_deposits(processed_ton_tx)]
+    if preload_users:
+        loads.append(_load_users(user_balances, user_usernames, username_index))
+    deposits_count, *users_loaded = await asyncio.gather(*loads)
+    users_count = users_loaded[0] if users_loaded else 0
+    print(
+        f"📥 Кэш загружен за {time.monotonic() - started:.2f} с: "
+        f"пользователей {users_count}, TON-транзакций {deposits_count}"
+    )
 
 
@@ -1,35 +1,66 @@
 # app/db/raffle.py
 from datetime import datetime, timezone, timedelta
-from typing import Any, Dict, List, Tuple
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
-from .pool import pool
+import app.db.pool as db_pool
+from app.db.stats import bump_user_stats
+from app.db.users import write_user_balances
 
 
-async def upsert_raffle_round(r: Dict[str, Any]):
-    """Сохранить результат раунда 'Банкир'."""
+async def upsert_raffle_round(
+    r: Dict[str, Any],
+    participant_ids: Iterable[int] = (),
+    bets: List[Tuple[int, int, int]] = (),
+    user_rows: List[Tuple[int, Optional[str], int]] = (),
+) -> Optional[Dict[int, int]]:
+    """
+    Сохранить результат раунда 'Банкир'.
+    В той же транзакции:
+    - ставки раунда bets (raffle_id, user_id, amount) — одним COPY
+    - балансы user_rows (user_id, username, balance): ставки и выплаты раунда
+    - счётчик раундов у участников (user_stats)
+    Возвращает записанные балансы.
+    Запись повторяется при сбоях, поэтому раунд, уже записанный в
+    raffle_rounds (коммит прошёл, а ответ потерялся), не трогаем —
+    иначе ставки и счётчики задвоятся; тогда возвращает None.
+    """
+    pool = db_pool.pool
     if not pool:
-        return
+        return None
     async with pool.acquire() as db:
-        await db.execute(
-            """
-            INSERT INTO raffle_rounds (id, created_at, finished_at, winner_id, total_bank)
-            VALUES ($1, $2, $3, $4, $5)
-            ON CONFLICT(id) DO UPDATE SET
-                created_at=EXCLUDED.created_at,
-                finished_at=EXCLUDED.finished_at,
-                winner_id=EXCLUDED.winner_id,
-                total_bank=EXCLUDED.total_bank
-        """,
-            r.get("id"),
-            r["created_at"].isoformat() if r.get("created_at") else None,
-            r["finished_at"].isoformat() if r.get("finished_at") else None,
-            r.get("winner_id"),
-            r.get("total_bank", 0),
-        )
+        async with db.transaction():
+            inserted = await db.fetchval(
+                """
+                INSERT INTO raffle_rounds (id, created_at, finished_at, winner_id, total_bank)
+                VALUES (
+                    COALESCE($1, nextval(pg_get_serial_sequence('raffle_rounds', 'id'))),
+                    $2, $3, $4, $5
+                )
+                ON CONFLICT(id) DO NOTHING
+                RETURNING id
+            """,
+                r.get("id"),
+                r.get("created_at"),
+                r.get("finished_at"),
+                r.get("winner_id"),
+                r.get("total_bank", 0),
+            )
+            if inserted is None:
+                return None
+            if bets:
+                await db.copy_records_to_table(
+                    "raffle_bets",
+                    records=bets,
+                    columns=["raffle_id", "user_id", "amount"],
+                )
+            committed = await write_user_balances(db, user_rows)
+            await bump_user_stats(db, participant_ids, raffle_rounds=1)
+    return committed
 
 
 async def add_raffle_bet(raffle_id: int, user_id: int, amount: int):
     """Добавить ставку пользователя в конкретный раунд."""
+    pool = db_pool.pool
     if not pool:
         return
     async with pool.acquire() as db:
@@ -44,13 +75,66 @@ async def add_raffle_bet(raffle_id: int, user_id: int, amount: int):
         )
 
 
+# последовательность id раундов и её шаг (= размер блока, миграция 7)
+_RAFFLE_SEQUENCE_SQL = """
+    FROM (SELECT pg_get_serial_sequence('raffle_rounds', 'id') AS seq) AS t
+    JOIN pg_sequences AS s
+      ON format('%I.%I', s.schemaname, s.sequencename) = t.seq
+"""
+
+
+def _get_pool():
+    if db_pool.pool is None:
+        raise RuntimeError("Database pool is not initialized. Call init_db() before using DB.")
+    return db_pool.pool
+
+
+async def reserve_raffle_id_block() -> range:
+    """
+    Зарезервировать блок id раундов (hi/lo).
+    Шаг последовательности raffle_rounds равен размеру блока, поэтому
+    один nextval отдаёт конец блока, а все id до него — наши.
+    """
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        row = await db.fetchrow(
+            "SELECT nextval(t.seq::regclass) AS hi, s.increment_by AS size" + _RAFFLE_SEQUENCE_SQL
+        )
+    return range(row["hi"] - row["size"] + 1, row["hi"] + 1)
+
+
+async def ensure_raffle_ids_above(min_id: int) -> None:
+    """Сдвинуть последовательность id раундов, чтобы она не выдала id <= min_id."""
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        await db.execute(
+            "SELECT setval(t.seq::regclass, $1)" + _RAFFLE_SEQUENCE_SQL
+            + " WHERE COALESCE(s.last_value, 0) < $1",
+            min_id,
+        )
+
+
+async def get_saved_raffle_ids(ids: List[int]) -> List[int]:
+    """Какие из раундов ids уже записаны в raffle_rounds."""
+    if not ids:
+        return []
+    pool = _get_pool()
+    async with pool.acquire() as db:
+        rows = await db.fetch(
+            "SELECT id FROM raffle_rounds WHERE id = ANY($1::int[])",
+            ids,
+        )
+    return [r["id"] for r in rows]
+
+
 async def get_user_raffle_bets_count(uid: int) -> int:
     """Количество раундов Банкира, где участвовал пользователь."""
+    pool = db_pool.pool
     if not pool:
         return 0
     async with pool.acquire() as db:
         count = await db.fetchval(
-            "SELECT COUNT(DISTINCT raffle_id) FROM raffle_bets WHERE user_id = $1",
+            "SELECT raffle_rounds FROM user_stats WHERE user_id = $1",
             uid,
         )
         return count if count is not None else 0
@@ -58,6 +142,7 @@ async def get_user_raffle_bets_count(uid: int) -> int:
 
 async def get_user_bets_in_raffle(raffle_id: int, user_id: int) -> int:
     """Количество ставок пользователя в конкретном раунде Банкира."""
+    pool = db_pool.pool
     if not pool:
         return 0
     async with pool.acquire() as db:
@@ -75,37 +160,42 @@ async def get_raffle_rounds_and_bets_30_days() -> Tuple[List[Dict[str, Any]], Li
     - возвращает список раундов за последние 30 дней
     - и список всех ставок по этим раундам
     """
+    pool = db_pool.pool
     if not pool:
         return [], []
 
     now = datetime.now(timezone.utc)
     delta_30 = now - timedelta(days=30)
 
+    # ставки и раунд пишутся одной транзакцией с общим id —
+    # хватает одного запроса с JOIN (ставки сразу сложены по игроку)
     async with pool.acquire() as db:
-        rounds_records = await db.fetch(
+        records = await db.fetch(
             """
-            SELECT id, created_at, finished_at, winner_id, total_bank
-            FROM raffle_rounds
-            WHERE finished_at IS NOT NULL AND finished_at >= $1
+            SELECT r.id, r.created_at, r.finished_at, r.winner_id, r.total_bank,
+                   b.user_id, SUM(b.amount) AS amount
+            FROM raffle_rounds AS r
+            JOIN raffle_bets AS b ON b.raffle_id = r.id
+            WHERE r.finished_at >= $1
+            GROUP BY r.id, b.user_id
         """,
-            delta_30.isoformat(),
+            delta_30,
         )
 
-        round_ids = [r["id"] for r in rounds_records]
-        if not round_ids:
-            return [], []
-
-        bets_records = await db.fetch(
-            """
-            SELECT raffle_id, user_id, amount
-            FROM raffle_bets
-            WHERE raffle_id = ANY($1::int[])
-        """,
-            round_ids,
+    rounds: Dict[int, Dict[str, Any]] = {}
+    bets: List[Dict[str, Any]] = []
+    for rec in records:
+        rounds.setdefault(
+            rec["id"],
+            {
+                "id": rec["id"],
+                "created_at": rec["created_at"],
+                "finished_at": rec["finished_at"],
+                "winner_id": rec["winner_id"],
+                "total_bank": rec["total_bank"],
+            },
         )
-
-    rounds = [dict(r) for r in rounds_records]
-    bets = [dict(b) for b in bets_records]
-    return rounds, bets
+        bets.append({"raffle_id": rec["id"], "user_id": rec["user_id"], "amount": rec["amount"]})
+    return list(rounds.values()), bets
 
 
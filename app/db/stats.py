@@ -0,0 +1,60 @@
+# app/db/stats.py
+from typing import Any, Dict, Iterable
+
+import asyncpg
+
+import app.db.pool as db_pool
+
+
+async def bump_user_stats(
+    db: asyncpg.Connection,
+    user_ids: Iterable[int],
+    dice_games: int = 0,
+    raffle_rounds: int = 0,
+) -> None:
+    """
+    Увеличить счётчики user_stats для пользователей.
+    Вызывается внутри транзакции, которая сохраняет игру / раунд.
+    """
+    uids = sorted({u for u in user_ids if u is not None})
+    if not uids:
+        return
+    await db.execute(
+        """
+        INSERT INTO user_stats (user_id, dice_games, raffle_rounds)
+        SELECT u, $2, $3 FROM unnest($1::bigint[]) AS u
+        ON CONFLICT (user_id) DO UPDATE SET
+            dice_games = user_stats.dice_games + EXCLUDED.dice_games,
+            raffle_rounds = user_stats.raffle_rounds + EXCLUDED.raffle_rounds
+    """,
+        uids,
+        dice_games,
+        raffle_rounds,
+    )
+
+
+async def get_user_profile(uid: int) -> Dict[str, Any]:
+    """
+    Всё для профиля одним запросом по первичному ключу:
+    registered_at, dice_games, raffle_rounds.
+    """
+    profile = {"registered_at": None, "dice_games": 0, "raffle_rounds": 0}
+    pool = db_pool.pool
+    if not pool:
+        return profile
+    async with pool.acquire() as db:
+        row = await db.fetchrow(
+            """
+            SELECT
+                u.registered_at,
+                COALESCE(s.dice_games, 0) AS dice_games,
+                COALESCE(s.raffle_rounds, 0) AS raffle_rounds
+            FROM users u
+            LEFT JOIN user_stats s ON s.user_id = u.user_id
+            WHERE u.user_id = $1
+        """,
+            uid,
+        )
+    if row:
+        profile.update(dict(row))
+    return profile
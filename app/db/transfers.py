@@ -2,7 +2,7 @@
 from datetime import datetime, timezone
 from typing import Dict, Any, List
 
-from app.db.pool import pool
+import app.db.pool as db_pool
 
 
 async def add_transfer(sender_id: int, receiver_id: int, amount: int) -> None:
@@ -10,6 +10,7 @@ async def add_transfer(sender_id: int, receiver_id: int, amount: int) -> None:
     Сохраняет перевод в таблицу transfers.
     Вызывается из handlers/text.py
     """
+    pool = db_pool.pool
     if not pool:
         return
 
@@ -22,7 +23,7 @@ async def add_transfer(sender_id: int, receiver_id: int, amount: int) -> None:
             sender_id,
             receiver_id,
             amount,
-            datetime.now(timezone.utc).isoformat(),
+            datetime.now(timezone.utc),
         )
 
 
@@ -30,6 +31,7 @@ async def get_user_transfers(uid: int) -> List[Dict[str, Any]]:
     """
     Получить список переводов пользователя (как отправитель или получатель).
     """
+    pool = db_pool.pool
     if not pool:
         return []
 
@@ -37,8 +39,8 @@ async def get_user_transfers(uid: int) -> List[Dict[str, Any]]:
         rows = await db.fetch(
             """
             SELECT * FROM transfers
-            WHERE sender_id = $1 OR receiver_id = $1
-            ORDER BY created_at DESC
+            WHERE from_id = $1 OR to_id = $1
+            ORDER BY at DESC
             """,
             uid,
         )
@@ -1,8 +1,8 @@
 # app/db/users.py
 from datetime import datetime, timezone
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-from .pool import pool
+import app.db.pool as db_pool  # ⬅ модуль, чтобы видеть пул после init_db
 
 
 async def upsert_user(
@@ -12,6 +12,7 @@ async def upsert_user(
     registered_at: Optional[datetime] = None,
 ):
     """Создать/обновить пользователя в БД."""
+    pool = db_pool.pool
     if not pool:
         return
     async with pool.acquire() as db:
@@ -26,14 +27,78 @@ async def upsert_user(
             uid,
             username,
             balance,
-            registered_at.isoformat()
-            if registered_at
-            else datetime.now(timezone.utc).isoformat(),
+            registered_at or datetime.now(timezone.utc),
         )
 
 
+async def upsert_users_batch(rows: List[Tuple[int, str | None, int]]) -> None:
+    """
+    Пакетно создать/обновить пользователей: (user_id, username, balance).
+    Вся пачка уходит одним executemany на одном соединении.
+    """
+    pool = db_pool.pool
+    if not pool or not rows:
+        return
+
+    registered_at = datetime.now(timezone.utc)
+    async with pool.acquire() as db:
+        async with db.transaction():
+            await db.executemany(
+                """
+                INSERT INTO users (user_id, username, balance, registered_at)
+                VALUES ($1, $2, $3, $4)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    username=EXCLUDED.username,
+                    balance=EXCLUDED.balance
+            """,
+                [(uid, username, balance, registered_at) for uid, username, balance in rows],
+            )
+            # username уникален в Telegram: если он перешёл к пользователю из пачки,
+            # у прежнего владельца его стираем (поиск по индексу lower(username))
+            await db.execute(
+                """
+                UPDATE users AS u SET username = NULL
+                FROM unnest($1::bigint[], $2::text[]) AS n(user_id, username)
+                WHERE n.username IS NOT NULL
+                  AND lower(u.username) = lower(n.username)
+                  AND u.user_id <> n.user_id
+            """,
+                [uid for uid, _, _ in rows],
+                [username for _, username, _ in rows],
+            )
+
+
+async def write_user_balances(
+    db, user_rows: List[Tuple[int, Optional[str], int]]
+) -> Dict[int, int]:
+    """
+    Записать балансы (user_id, username, balance) в транзакции вызывающего
+    (расчёт игры, итог раунда Банкира). Возвращает записанные балансы.
+    """
+    if not user_rows:
+        return {}
+    rows = await db.fetch(
+        """
+        INSERT INTO users (user_id, username, balance, registered_at)
+        SELECT u.user_id, u.username, u.balance, $4
+        FROM unnest($1::bigint[], $2::text[], $3::integer[])
+            AS u(user_id, username, balance)
+        ON CONFLICT (user_id) DO UPDATE SET
+            username = COALESCE(EXCLUDED.username, users.username),
+            balance = EXCLUDED.balance
+        RETURNING user_id, balance
+        """,
+        [row[0] for row in user_rows],
+        [row[1] for row in user_rows],
+        [row[2] for row in user_rows],
+        datetime.now(timezone.utc),
+    )
+    return {r["user_id"]: r["balance"] for r in rows}
+
+
 async def get_user_registered_at(uid: int) -> Optional[datetime]:
     """Получить дату регистрации пользователя."""
+    pool = db_pool.pool
     if not pool:
         return None
     async with pool.acquire() as db:
@@ -41,11 +106,29 @@ async def get_user_registered_at(uid: int) -> Optional[datetime]:
             "SELECT registered_at FROM users WHERE user_id = $1",
             uid,
         )
-        if row and row["registered_at"]:
-            try:
-                return datetime.fromisoformat(row["registered_at"])
-            except ValueError:
-                return None
-        return None
+        return row["registered_at"] if row else None
 
 
+async def get_users_by_ids(uids: List[int]) -> List[Tuple[int, str | None, int]]:
+    """(user_id, username, balance) для найденных пользователей — одним запросом."""
+    pool = db_pool.pool
+    if not pool or not uids:
+        return []
+    async with pool.acquire() as db:
+        rows = await db.fetch(
+            "SELECT user_id, username, balance FROM users WHERE user_id = ANY($1::bigint[])",
+            list(uids),
+        )
+    return [(r["user_id"], r["username"], r["balance"] or 0) for r in rows]
+
+
+async def find_user_id_by_username(username: str) -> Optional[int]:
+    """user_id по username без учёта регистра (индекс users_username_lower_idx)."""
+    pool = db_pool.pool
+    if not pool:
+        return None
+    async with pool.acquire() as db:
+        return await db.fetchval(
+            "SELECT user_id FROM users WHERE lower(username) = lower($1) LIMIT 1",
+            username,
+        )
@@ -5,11 +5,24 @@ from aiogram.filters import Command
 from app.bot import dp
 from app.config import ADMIN_IDS, MAIN_ADMIN_ID
 from app.services.balances import (
-    register_user,
     change_balance,
     set_balance,
     get_balance,
+    load_user,
+    try_debit,
+    balance_cache_size,
+    balance_cache_stats,
+    register_stats,
 )
+from app.services.balance_writer import writer_stats
+from app.services.games import games_stats, live_games_size
+from app.services.history_cache import history_cache_size, history_cache_stats
+from app.services.ledger import ledger_stats
+from app.services.live_state import live_state_stats
+from app.services.raffle import raffle_rooms, raffle_save_stats, unsaved_rounds
+from app.services.tasks import pending_tasks, task_errors, task_stats
+from app.services.user_locks import user_lock
+from app.services.user_state import user_state_size, user_state_stats
 from app.services.ton import get_ton_rub_rate
 from app.utils.formatters import format_rubles
 
@@ -20,7 +33,6 @@ def is_admin(uid: int) -> bool:
 
 @dp.message(Command("addbalance"))
 async def cmd_addbalance(m: types.Message):
-    register_user(m.from_user)
     if not is_admin(m.from_user.id):
         return await m.answer("⛔ Нет прав.")
     parts = (m.text or "").split()
@@ -29,7 +41,10 @@ async def cmd_addbalance(m: types.Message):
 
     uid = int(parts[1])
     amount = int(parts[2])
-    change_balance(uid, amount)
+    # под тем же замком, что и списания (try_debit / transfer_balance)
+    async with user_lock(uid):
+        await load_user(uid)
+        change_balance(uid, amount, reason="admin_add")
     await m.answer(
         f"✅ Баланс {uid} увеличен на {format_rubles(amount)} ₽. "
         f"Теперь: {format_rubles(get_balance(uid))} ₽"
@@ -38,7 +53,6 @@ async def cmd_addbalance(m: types.Message):
 
 @dp.message(Command("removebalance"))
 async def cmd_removebalance(m: types.Message):
-    register_user(m.from_user)
     if not is_admin(m.from_user.id):
         return await m.answer("⛔ Нет прав.")
     parts = (m.text or "").split()
@@ -47,7 +61,11 @@ async def cmd_removebalance(m: types.Message):
 
     uid = int(parts[1])
     amount = int(parts[2])
-    change_balance(uid, -amount)
+    # проверка и списание атомарно — баланс не уходит в минус
+    if not await try_debit(uid, amount, reason="admin_remove"):
+        return await m.answer(
+            f"⛔ У {uid} недостаточно средств: {format_rubles(get_balance(uid))} ₽"
+        )
     await m.answer(
         f"✅ Баланс {uid} уменьшен на {format_rubles(amount)} ₽. "
         f"Теперь: {format_rubles(get_balance(uid))} ₽"
@@ -56,7 +74,6 @@ async def cmd_removebalance(m: types.Message):
 
 @dp.message(Command("setbalance"))
 async def cmd_setbalance(m: types.Message):
-    register_user(m.from_user)
     if not is_admin(m.from_user.id):
         return await m.answer("⛔ Нет прав.")
     parts = (m.text or "").split()
@@ -65,13 +82,14 @@ async def cmd_setbalance(m: types.Message):
 
     uid = int(parts[1])
     amount = int(parts[2])
-    set_balance(uid, amount)
+    async with user_lock(uid):
+        await load_user(uid)
+        set_balance(uid, amount)
     await m.answer(f"✅ Баланс {uid} установлен на {format_rubles(amount)} ₽")
 
 
 @dp.message(Command("adminprofit"))
 async def cmd_adminprofit(m: types.Message):
-    register_user(m.from_user)
     if m.from_user.id != MAIN_ADMIN_ID:
         return await m.answer("⛔ Только основной админ.")
     bal = get_balance(MAIN_ADMIN_ID)
@@ -83,3 +101,43 @@ async def cmd_adminprofit(m: types.Message):
         f"≈ {ton_equiv:.4f} TON по текущему курсу ({rate:.2f} ₽ за 1 TON).\n"
         "Эти ₽ можно вывести, обменяв TON на рубли."
     )
+
+
+@dp.message(Command("botstats"))
+async def cmd_botstats(m: types.Message):
+    if not is_admin(m.from_user.id):
+        return await m.answer("⛔ Нет прав.")
+    running, queued = pending_tasks()
+    live_games, lobby_games = live_games_size()
+    errors_by_task = ", ".join(f"{name}: {n}" for name, n in task_errors.items()) or "нет"
+    await m.answer(
+        "📊 Внутренняя статистика бота\n\n"
+        f"💾 Сброс балансов: {writer_stats['flushes']} пачек, "
+        f"{writer_stats['rows']} строк, ошибок: {writer_stats['errors']}\n"
+        f"📒 Журнал: {ledger_stats['entries']} записей в {ledger_stats['flushes']} пачках, "
+        f"снимков {ledger_stats['snapshots']}, ошибок: {ledger_stats['errors']}\n"
+        f"📋 Кэш истории: {history_cache_size()} польз., "
+        f"попаданий {history_cache_stats['hits']}, "
+        f"промахов {history_cache_stats['misses']}, "
+        f"вытеснено {history_cache_stats['evictions']}, "
+        f"сброшено {history_cache_stats['invalidations']}, "
+        f"устаревших не сохранено {history_cache_stats['stale']}\n"
+        f"👥 Кэш балансов: {balance_cache_size()} польз., "
+        f"загружено {balance_cache_stats['loads']}, "
+        f"вытеснено {balance_cache_stats['evictions']}\n"
+        f"📝 Регистрация: записей {register_stats['writes']}, "
+        f"пропущено без изменений {register_stats['skipped']}\n"
+        f"⚙️ Фоновые задачи: выполняются {running}, в очереди {queued}, "
+        f"готово {task_stats['done']}, склеено {task_stats['merged']}, "
+        f"отброшено {task_stats['dropped']}, ошибки: {errors_by_task}\n"
+        f"💬 Незавершённый ввод: {user_state_size()} польз., "
+        f"истекло по TTL {user_state_stats['expired']}\n"
+        f"🎲 Игры в памяти: {live_games} (в лобби {lobby_games}), "
+        f"создано {games_stats['created']}, убрано после расчёта {games_stats['evicted']}, "
+        f"снимков {live_state_stats['saves']}, ошибок снимка {live_state_stats['errors']}, "
+        f"повторов {live_state_stats['retries']}\n"
+        f"🎩 Комнаты Банкира: {len(raffle_rooms)}, "
+        f"с таймером {sum(1 for r in raffle_rooms.values() if r['draw_at'])}, "
+        f"итогов ждут записи {len(unsaved_rounds)}, записано {raffle_save_stats['saved']}, "
+        f"повторов {raffle_save_stats['retries']}"
+    )
@@ -1,31 +1,23 @@
 # app/handlers/balance.py
 
-from typing import Dict, Any, Optional
+from typing import Optional
 
 from aiogram import F, types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
 from app.bot import dp
 from app.config import TON_WALLET_ADDRESS
+from app.db.users import find_user_id_by_username
 from app.services.balances import (
-    register_user,
     get_balance,
-    user_usernames,
+    find_user_by_username,
 )
 from app.services.ton import get_ton_rub_rate
+from app.services.user_state import FLOW_TRANSFER, FLOW_WITHDRAW, clear_state, set_state
 from app.utils.formatters import format_rubles
 from app.utils.keyboards import bottom_menu
 
 
-# ---------- СОСТОЯНИЯ ДЛЯ ВЫВОДА ----------
-pending_withdraw_step: Dict[int, str] = {}
-temp_withdraw: Dict[int, Dict[str, Any]] = {}
-
-# ---------- СОСТОЯНИЯ ДЛЯ ПЕРЕВОДОВ ----------
-pending_transfer_step: Dict[int, str] = {}     # await_username / await_amount
-temp_transfer: Dict[int, Dict[str, Any]] = {}  # target_id, amount
-
-
 # ---------- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ----------
 
 async def format_balance_text(uid: int) -> str:
@@ -39,32 +31,28 @@ async def format_balance_text(uid: int) -> str:
     )
 
 
-def resolve_user_by_username(username_str: str) -> Optional[int]:
+async def resolve_user_by_username(username_str: str) -> Optional[int]:
     """
     Нужна для переводов — ищем user_id по @username.
+    Сначала индекс в памяти, затем БД (пользователь может быть не в кэше).
     """
     uname = username_str.strip().lstrip("@").lower()
     if not uname:
         return None
 
-    for uid, stored in user_usernames.items():
-        if stored and stored.lower() == uname:
-            return uid
-
-    return None
+    uid = find_user_by_username(uname)
+    if uid is None:
+        uid = await find_user_id_by_username(uname)
+    return uid
 
 
 # ---------- ГЛАВНОЕ МЕНЮ БАЛАНСА ----------
 
 @dp.message(F.text == "💼 Баланс")
 async def msg_balance(m: types.Message):
-    register_user(m.from_user)
     uid = m.from_user.id
 
-    pending_withdraw_step.pop(uid, None)
-    temp_withdraw.pop(uid, None)
-    pending_transfer_step.pop(uid, None)
-    temp_transfer.pop(uid, None)
+    await clear_state(uid, FLOW_WITHDRAW, FLOW_TRANSFER)
 
     text = await format_balance_text(uid)
 
@@ -85,10 +73,7 @@ async def msg_balance(m: types.Message):
 async def cb_balance_back(callback: CallbackQuery):
     uid = callback.from_user.id
 
-    pending_withdraw_step.pop(uid, None)
-    temp_withdraw.pop(uid, None)
-    pending_transfer_step.pop(uid, None)
-    temp_transfer.pop(uid, None)
+    await clear_state(uid, FLOW_WITHDRAW, FLOW_TRANSFER)
 
     await callback.message.answer("Главное меню:", reply_markup=bottom_menu())
     await callback.answer()
@@ -137,8 +122,7 @@ async def cb_withdraw_menu(callback: CallbackQuery):
     if bal <= 0:
         return await callback.answer("Баланс 0 ₽.", show_alert=True)
 
-    pending_withdraw_step[uid] = "amount"
-    temp_withdraw[uid] = {}
+    await set_state(uid, FLOW_WITHDRAW, "amount")
 
     rate = await get_ton_rub_rate()
     ton_equiv = bal / rate if rate > 0 else 0
@@ -157,11 +141,7 @@ async def cb_withdraw_menu(callback: CallbackQuery):
 async def cb_transfer_menu(callback: CallbackQuery):
     uid = callback.from_user.id
 
-    pending_transfer_step.pop(uid, None)
-    temp_transfer.pop(uid, None)
-
-    pending_transfer_step[uid] = "await_username"
-    temp_transfer[uid] = {}
+    await set_state(uid, FLOW_TRANSFER, "await_username")
 
     await callback.message.answer(
         "🔄 Перевод ₽\n"
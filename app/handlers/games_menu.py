@@ -8,24 +8,29 @@ from app.bot import dp
 from app.utils.formatters import format_rubles
 from app.services.games import (
     games,
-    pending_bet_input,
+    close_open_game,
+    open_game,
+    remove_game,
     send_games_list,
     build_games_text,
     build_games_keyboard,
+    parse_lobby_callback,
     build_user_stats_and_history,
     build_history_keyboard,
+    parse_history_callback,
     build_rating_text,
     play_game
 )
-from app.services.raffle import pending_raffle_bet_input
 from app.services.state_reset import reset_user_state
-from app.services.balances import get_balance, change_balance
+from app.services.user_state import FLOW_DICE_BET, set_state
+from app.services.balances import apply_balance_delta, requeue_unsettled, try_debit
+from app.services.live_state import mark_live_state_changed
 from app.config import DICE_MIN_BET, DICE_BET_MIN_CANCEL_AGE
 
 
 @dp.callback_query(F.data == "menu_games")
 async def cb_menu_games(callback: CallbackQuery):
-    reset_user_state(callback.from_user.id)
+    await reset_user_state(callback.from_user.id)
 
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
@@ -41,7 +46,7 @@ async def cb_menu_games(callback: CallbackQuery):
 @dp.callback_query(F.data == "back_main")
 async def back_main(callback):
     from app.utils.keyboards import bottom_menu
-    reset_user_state(callback.from_user.id)
+    await reset_user_state(callback.from_user.id)
     await callback.message.answer("Главное меню:", reply_markup=bottom_menu())
     await callback.answer()
 
@@ -53,8 +58,7 @@ async def back_main(callback):
 @dp.callback_query(F.data == "create_game")
 async def cb_create_game(callback: CallbackQuery):
     uid = callback.from_user.id
-    pending_bet_input[uid] = True
-    pending_raffle_bet_input.pop(uid, None)
+    await set_state(uid, FLOW_DICE_BET)
 
     await callback.message.answer(
         f"Введите ставку (числом, в ₽). Минимум {DICE_MIN_BET} ₽:"
@@ -148,8 +152,12 @@ async def cb_cancel_game(callback: CallbackQuery):
             show_alert=True,
         )
 
-    change_balance(uid, g["bet"])
-    del games[gid]
+    # ставка была только в кэше — возврат гасит её, расчёта не будет,
+    # обе записи журнала и баланс допишет write-behind
+    apply_balance_delta(uid, g["bet"], reason="dice_cancel", ref_id=gid)
+    requeue_unsettled(gid, [uid])
+    remove_game(gid)
+    mark_live_state_changed()
 
     await callback.message.answer(
         f"❌ Ставка №{gid} отменена. {format_rubles(g['bet'])} ₽ возвращены."
@@ -173,14 +181,15 @@ async def cb_join_confirm(callback: CallbackQuery):
     if g["opponent_id"] is not None:
         return await callback.answer("Кто-то уже вступил!", show_alert=True)
 
-    if get_balance(uid) < g["bet"]:
-        return await callback.answer("Недостаточно ₽.", show_alert=True)
-
+    # занимаем место соперника до await, чтобы второй желающий не прошёл проверку выше
     g["opponent_id"] = uid
-    change_balance(uid, -g["bet"])
-
-    from app.db.games import upsert_game
-    await upsert_game(g)
+    close_open_game(gid)
+    # списание сохранится в БД вместе с расчётом игры (settle_game)
+    if not await try_debit(uid, g["bet"], reason="dice_bet", ref_id=gid, settle_later=True):
+        g["opponent_id"] = None
+        open_game(g)
+        return await callback.answer("Недостаточно ₽.", show_alert=True)
+    mark_live_state_changed()
 
     await callback.message.answer(f"✅ Вы вступили в игру №{gid}!")
     await callback.answer()
@@ -195,10 +204,10 @@ async def cb_join_confirm(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("my_games"))
 async def cb_my_games(callback: CallbackQuery):
     uid = callback.from_user.id
-    page = int(callback.data.split(":")[1])
+    page, cursor, direction = parse_history_callback(callback.data)
 
-    stats, history = await build_user_stats_and_history(uid)
-    kb = build_history_keyboard(history, page)
+    stats, history, nav = await build_user_stats_and_history(uid, page, cursor, direction)
+    kb = build_history_keyboard(history, nav)
 
     await callback.message.answer(stats, reply_markup=kb)
     await callback.answer()
@@ -208,18 +217,20 @@ async def cb_my_games(callback: CallbackQuery):
 #                    ОБНОВЛЕНИЕ СПИСКА ИГР
 # ---------------------------------------------------------
 
-@dp.callback_query(F.data == "refresh_games")
+@dp.callback_query((F.data == "refresh_games") | F.data.startswith("lobby:"))
 async def cb_refresh_games(callback: CallbackQuery):
     uid = callback.from_user.id
+    bucket, page = parse_lobby_callback(callback.data)
+    kb = build_games_keyboard(uid, page, bucket)
     try:
         await callback.message.edit_text(
             build_games_text(),
-            reply_markup=build_games_keyboard(uid),
+            reply_markup=kb,
         )
     except:
         await callback.message.answer(
             build_games_text(),
-            reply_markup=build_games_keyboard(uid),
+            reply_markup=kb,
         )
     await callback.answer("Обновлено!")
 
@@ -273,7 +284,8 @@ async def cb_help_dice(callback: CallbackQuery):
 async def cb_help_banker(callback: CallbackQuery):
     text = (
         "🎩 *Помощь: Банкир*\n\n"
-        "1️⃣ Первая ставка задаёт цену доли.\n"
+        "🚪 Одновременно идёт несколько комнат с разной ценой доли.\n"
+        "1️⃣ Первая ставка в комнате задаёт цену доли.\n"
         "2️⃣ До 10 ставок на игрока.\n"
         "3️⃣ Чем больше ставок — тем выше шанс.\n"
         "4️⃣ Таймер 60 секунд после 2 участников.\n"
@@ -0,0 +1,26 @@
+# app/handlers/middleware.py
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram.types import TelegramObject
+
+from app.bot import dp
+from app.services.balances import load_user, register_user
+
+
+@dp.update.outer_middleware()
+async def user_middleware(
+    handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+    event: TelegramObject,
+    data: Dict[str, Any],
+) -> Any:
+    """
+    До любого хендлера:
+    - подгружаем из БД пользователя, от которого пришёл апдейт
+      (ленивый кэш балансов; в режиме "eager" — ничего)
+    - регистрируем его (запись в БД — только если что-то изменилось)
+    """
+    user = data.get("event_from_user")
+    if user is not None:
+        await load_user(user.id)
+        register_user(user)
+    return await handler(event, data)
@@ -2,24 +2,23 @@
 from aiogram import F, types
 
 from app.bot import dp
-from app.services.balances import register_user
-from app.db.users import get_user_registered_at
-from app.db.games import get_user_dice_games_count
-from app.db.raffle import get_user_raffle_bets_count
+from app.db.stats import get_user_profile
 
 
 @dp.message(F.text == "👤 Профиль")
 async def msg_profile(m: types.Message):
-    register_user(m.from_user)
     uid = m.from_user.id
 
-    reg_date_dt = await get_user_registered_at(uid)
+    # дата регистрации и счётчики игр — одним запросом (users + user_stats)
+    profile = await get_user_profile(uid)
+
+    reg_date_dt = profile["registered_at"]
     reg_date_str = (
         reg_date_dt.strftime("%d.%m.%Y %H:%M:%S") if reg_date_dt else "Неизвестно"
     )
 
-    dice_games_count = await get_user_dice_games_count(uid)
-    raffle_rounds_count = await get_user_raffle_bets_count(uid)
+    dice_games_count = profile["dice_games"]
+    raffle_rounds_count = profile["raffle_rounds"]
 
     text = (
         "👤 Ваш Профиль:\n\n"
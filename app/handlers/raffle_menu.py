@@ -5,13 +5,12 @@ from aiogram.types import CallbackQuery
 from app.bot import dp
 from app.config import RAFFLE_MIN_BET
 from app.services.raffle import (
-    pending_raffle_bet_input,
     _process_raffle_bet,
     send_raffle_menu,
     cancel_user_bets,
     build_raffle_rating_text,
 )
-from app.services.games import pending_bet_input
+from app.services.user_state import FLOW_RAFFLE_BET, set_state
 
 
 @dp.callback_query(F.data == "mode_banker")
@@ -29,8 +28,7 @@ async def cb_raffle_make_bet(callback: CallbackQuery):
     Если раунд уже идёт — просим ввести сумму (кратную базовой ставке).
     """
     uid = callback.from_user.id
-    pending_raffle_bet_input[uid] = True
-    pending_bet_input.pop(uid, None)
+    await set_state(uid, FLOW_RAFFLE_BET)
 
     await callback.message.answer(
         "Введите сумму ₽ для участия в Банкире.\n"
@@ -42,17 +40,19 @@ async def cb_raffle_make_bet(callback: CallbackQuery):
 
 @dp.callback_query(F.data.startswith("raffle_quick:"))
 async def cb_raffle_quick(callback: CallbackQuery):
-    """Быстрые суммы (1/3/7 долей)."""
+    """Быстрые суммы (1/3/7 долей) и вход в комнату: raffle_quick:<сумма>[:<комната>]."""
     uid = callback.from_user.id
     chat_id = callback.message.chat.id
 
+    parts = callback.data.split(":")
     try:
-        amount = int(callback.data.split(":", 1)[1])
+        amount = int(parts[1])
+        room_id = int(parts[2]) if len(parts) > 2 else None
     except (ValueError, IndexError):
         await callback.answer("Некорректная сумма.", show_alert=True)
         return
 
-    msg_text = await _process_raffle_bet(uid, chat_id, amount)
+    msg_text = await _process_raffle_bet(uid, chat_id, amount, room_id)
     await callback.message.answer(msg_text)
     await callback.answer()
 
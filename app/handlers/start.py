@@ -4,7 +4,7 @@ from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 
 from app.bot import dp
-from app.services.balances import register_user, get_balance
+from app.services.balances import get_balance
 from app.utils.keyboards import bottom_menu
 from app.services.games import send_games_list
 from app.services.raffle import send_raffle_menu
@@ -12,7 +12,6 @@ from app.services.raffle import send_raffle_menu
 
 @dp.message(Command("start"))
 async def cmd_start(m: types.Message):
-    register_user(m.from_user)
     get_balance(m.from_user.id)
     await m.answer(
         "Добро пожаловать в игровой бот TON!\n"
@@ -31,7 +30,6 @@ async def cmd_start(m: types.Message):
 
 @dp.message(F.text == "🕹 Игры")
 async def msg_games(m: types.Message):
-    register_user(m.from_user)
     kb = InlineKeyboardMarkup(
         inline_keyboard=[
             [InlineKeyboardButton(text="🎲 Кости", callback_data="mode_dice")],
@@ -44,13 +42,11 @@ async def msg_games(m: types.Message):
 @dp.message(F.text == "🎁 Розыгрыш")
 async def msg_raffle_main(m: types.Message):
     # как в оригинале — заглушка
-    register_user(m.from_user)
     await m.answer("Розыгрыши скоро появятся.")
 
 
 @dp.message(F.text == "🌐 Поддержка")
 async def msg_support(m: types.Message):
-    register_user(m.from_user)
     await m.answer("Поддержка: @Btcbqq")
 
 
@@ -8,40 +8,46 @@ from app.bot import dp, bot
 from app.config import DICE_MIN_BET, ADMIN_IDS
 from app.db.games import upsert_game
 from app.db.transfers import add_transfer
-from app.handlers.balance import (
-    pending_withdraw_step,
-    temp_withdraw,
-    pending_transfer_step,
-    temp_transfer,
-    resolve_user_by_username,
-)
+from app.handlers.balance import resolve_user_by_username
 from app.services.balances import (
-    register_user,
     get_balance,
-    change_balance,
+    transfer_balance,
+    try_debit,
 )
 from app.services.games import (
-    games,
-    pending_bet_input,
-    next_game_id,
+    add_game,
+    allocate_game_id,
     send_games_list,
 )
-from app.services.raffle import pending_raffle_bet_input, _process_raffle_bet
+from app.services.live_state import mark_live_state_changed
+from app.services.raffle import _process_raffle_bet
 from app.services.ton import get_ton_rub_rate
+from app.services.user_state import (
+    FLOW_DICE_BET,
+    FLOW_RAFFLE_BET,
+    FLOW_TRANSFER,
+    FLOW_WITHDRAW,
+    clear_state,
+    get_state,
+    save_state,
+)
 from app.utils.formatters import format_rubles
 
 
 @dp.message()
 async def process_text(m: Message):
-    register_user(m.from_user)
     uid = m.from_user.id
     text = (m.text or "").strip()
 
     if text.startswith("/"):
         return  # игнорируем команды
 
+    state = await get_state(uid)
+    flow = state.flow if state else None
+    step = state.step if state else None
+
     # 1) Кости — ввод ставки
-    if pending_bet_input.get(uid):
+    if flow == FLOW_DICE_BET:
         if not text.isdigit():
             return await m.answer("Введите корректную ставку (число):")
 
@@ -51,11 +57,15 @@ async def process_text(m: Message):
         if bet > get_balance(uid):
             return await m.answer("Недостаточно ₽ на балансе!")
 
-        global next_game_id
-        gid = next_game_id
-        next_game_id += 1
+        gid = allocate_game_id()
+
+        # проверка и списание — атомарно, под замком пользователя;
+        # в БД ставка попадёт вместе с расчётом игры (settle_game),
+        # до него её хранит снимок живого состояния
+        if not await try_debit(uid, bet, reason="dice_bet", ref_id=gid, settle_later=True):
+            return await m.answer("Недостаточно ₽ на балансе!")
 
-        games[gid] = {
+        g = {
             "id": gid,
             "creator_id": uid,
             "opponent_id": None,
@@ -67,16 +77,17 @@ async def process_text(m: Message):
             "created_at": datetime.now(timezone.utc),
             "finished_at": None,
         }
+        add_game(g)
+        mark_live_state_changed()
 
-        change_balance(uid, -bet)
-        pending_bet_input.pop(uid)
+        await clear_state(uid)
 
-        await upsert_game(games[gid])
+        await upsert_game(g)
         await m.answer(f"🎲 Игра №{gid} создана!")
         return await send_games_list(m.chat.id, uid)
 
     # 2) ВЫВОД TON — шаг 1: сумма
-    if pending_withdraw_step.get(uid) == "amount":
+    if flow == FLOW_WITHDRAW and step == "amount":
         if not text.isdigit():
             return await m.answer("Введите сумму числом:")
 
@@ -89,8 +100,9 @@ async def process_text(m: Message):
                 f"Недостаточно ₽. Ваш баланс: {format_rubles(bal)} ₽."
             )
 
-        temp_withdraw[uid]["amount"] = amount
-        pending_withdraw_step[uid] = "details"
+        state.data["amount"] = amount
+        state.step = "details"
+        await save_state(uid, state)
 
         rate = await get_ton_rub_rate()
         ton_amount = amount / rate if rate > 0 else 0
@@ -102,9 +114,9 @@ async def process_text(m: Message):
         )
 
     # 3) ВЫВОД TON — шаг 2: комментарий
-    if pending_withdraw_step.get(uid) == "details":
+    if flow == FLOW_WITHDRAW and step == "details":
         details = text
-        amount = temp_withdraw[uid]["amount"]
+        amount = state.data["amount"]
 
         user = m.from_user
         username = user.username
@@ -141,17 +153,16 @@ async def process_text(m: Message):
             "Администратор свяжется и выполнит вывод."
         )
 
-        pending_withdraw_step.pop(uid, None)
-        temp_withdraw.pop(uid, None)
+        await clear_state(uid)
         return
 
     # 4) ПЕРЕВОД — шаг 1: получатель
-    if pending_transfer_step.get(uid) == "await_username":
+    if flow == FLOW_TRANSFER and step == "await_username":
         target_id = None
 
         # username
         if text.startswith("@"):
-            target_id = resolve_user_by_username(text)
+            target_id = await resolve_user_by_username(text)
 
         # ID
         elif text.isdigit():
@@ -159,7 +170,7 @@ async def process_text(m: Message):
 
         # username без @
         else:
-            target_id = resolve_user_by_username(text)
+            target_id = await resolve_user_by_username(text)
 
         if not target_id:
             return await m.answer(
@@ -171,13 +182,14 @@ async def process_text(m: Message):
         if target_id == uid:
             return await m.answer("❌ Нельзя переводить самому себе.")
 
-        temp_transfer[uid]["target_id"] = target_id
-        pending_transfer_step[uid] = "await_amount"
+        state.data["target_id"] = target_id
+        state.step = "await_amount"
+        await save_state(uid, state)
 
         return await m.answer("Введите сумму ₽ для перевода:")
 
     # 5) ПЕРЕВОД — шаг 2: сумма
-    if pending_transfer_step.get(uid) == "await_amount":
+    if flow == FLOW_TRANSFER and step == "await_amount":
         if not text.isdigit():
             return await m.answer("Введите сумму числом!")
 
@@ -191,11 +203,14 @@ async def process_text(m: Message):
                 f"Недостаточно ₽! Ваш баланс: {format_rubles(bal)} ₽."
             )
 
-        target_id = temp_transfer[uid]["target_id"]
+        target_id = state.data["target_id"]
 
-        # проводим перевод
-        change_balance(uid, -amount)
-        change_balance(target_id, amount)
+        # проводим перевод (замки обоих пользователей, проверка + списание атомарно)
+        if not await transfer_balance(uid, target_id, amount):
+            return await m.answer(
+                f"Недостаточно ₽! Ваш баланс: {format_rubles(get_balance(uid))} ₽."
+            )
+        await clear_state(uid)
 
         await add_transfer(uid, target_id, amount)
 
@@ -215,18 +230,15 @@ async def process_text(m: Message):
             )
         except:
             pass
-
-        pending_transfer_step.pop(uid, None)
-        temp_transfer.pop(uid, None)
         return
 
     # 6) Банкир — ставка
-    if pending_raffle_bet_input.get(uid):
+    if flow == FLOW_RAFFLE_BET:
         if not text.isdigit():
             return await m.answer("Введите сумму числом (₽):")
 
         amount = int(text)
-        pending_raffle_bet_input.pop(uid, None)
+        await clear_state(uid)
 
         msg = await _process_raffle_bet(uid, m.chat.id, amount)
         return await m.answer(msg)
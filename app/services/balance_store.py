@@ -0,0 +1,303 @@
+# app/services/balance_store.py
+
+"""
+Компактное хранилище балансов и username (BALANCE_STORE = "compact").
+
+Два dict (user_balances + user_usernames) стоят ~100+ байт на пользователя:
+объект int для ключа, объект int для баланса и по слоту в каждой хэш-таблице.
+Здесь одна таблица с открытой адресацией (линейное пробирование):
+- _keys:   array('q') — user_id (0 — пустой слот, -1 — удалённый)
+- _values: array('q') — баланс
+- _names:  list — интернированная строка username (или None)
+- _flags:  bytearray — есть ли в слоте баланс / username
+Наружу таблица отдаёт два MutableMapping (balances и usernames),
+так что get_balance / change_balance и остальной код не меняются.
+
+Замер памяти против dict:
+    python -m app.services.balance_store 1000000 10000000
+"""
+
+import sys
+from array import array
+from typing import Iterator, List, MutableMapping, Optional
+
+_EMPTY = 0
+_DELETED = -1
+
+_HAS_BALANCE = 1
+_HAS_NAME = 2
+
+_MAX_LOAD = 0.7
+_HASH_MUL = 0x9E3779B97F4A7C15  # фибоначчиево хэширование
+_U64 = (1 << 64) - 1
+
+
+class CompactUserTable:
+    """Таблица user_id -> (баланс, username) на типизированных массивах."""
+
+    def __init__(self, capacity: int = 1024):
+        self._alloc(capacity)
+        self.balances = _BalanceView(self)
+        self.usernames = _UsernameView(self)
+
+    def _alloc(self, capacity: int) -> None:
+        bits = 3
+        while (1 << bits) < capacity:
+            bits += 1
+        size = 1 << bits
+
+        self._mask = size - 1
+        self._shift = 64 - bits
+        self._keys = array("q", bytes(8 * size))
+        self._values = array("q", bytes(8 * size))
+        self._names: List[Optional[str]] = [None] * size
+        self._flags = bytearray(size)
+        self._used = 0  # занятые + удалённые слоты
+        self._counts = [0, 0]  # сколько балансов / username
+
+    def _slot(self, uid: int) -> int:
+        return ((uid * _HASH_MUL) & _U64) >> self._shift
+
+    def _find(self, uid: int) -> int:
+        """Индекс слота с uid или -1."""
+        keys = self._keys
+        mask = self._mask
+        i = self._slot(uid)
+        while True:
+            key = keys[i]
+            if key == uid:
+                return i
+            if key == _EMPTY:
+                return -1
+            i = (i + 1) & mask
+
+    def _find_or_insert(self, uid: int) -> int:
+        if uid <= 0:
+            raise ValueError(f"user_id должен быть положительным: {uid}")
+        if self._used + 1 > len(self._keys) * _MAX_LOAD:
+            self._resize()
+
+        keys = self._keys
+        mask = self._mask
+        i = self._slot(uid)
+        free = -1
+        while True:
+            key = keys[i]
+            if key == uid:
+                return i
+            if key == _EMPTY:
+                break
+            if key == _DELETED and free < 0:
+                free = i
+            i = (i + 1) & mask
+
+        if free < 0:
+            free = i
+            self._used += 1
+        keys[free] = uid
+        return free
+
+    def _release(self, i: int) -> None:
+        """Освободить слот, если в нём не осталось ни баланса, ни username."""
+        if not self._flags[i]:
+            self._keys[i] = _DELETED
+            self._values[i] = 0
+            self._names[i] = None
+
+    def _resize(self) -> None:
+        keys, values, names, flags = self._keys, self._values, self._names, self._flags
+        live = sum(1 for f in flags if f)
+        self._alloc(int((live + 1) / _MAX_LOAD) + 1)
+
+        for i, f in enumerate(flags):
+            if not f:
+                continue
+            j = self._find_or_insert(keys[i])
+            self._values[j] = values[i]
+            self._names[j] = names[i]
+            self._flags[j] = f
+            if f & _HAS_BALANCE:
+                self._counts[0] += 1
+            if f & _HAS_NAME:
+                self._counts[1] += 1
+
+    def _iter_uids(self, flag: int) -> Iterator[int]:
+        keys = self._keys
+        for i, f in enumerate(self._flags):
+            if f & flag:
+                yield keys[i]
+
+    def memory_bytes(self) -> int:
+        """Память самой таблицы (без строк username — они общие с любым хранилищем)."""
+        return (
+            sys.getsizeof(self._keys)
+            + sys.getsizeof(self._values)
+            + sys.getsizeof(self._names)
+            + sys.getsizeof(self._flags)
+        )
+
+
+class _BalanceView(MutableMapping[int, int]):
+    __slots__ = ("_t",)
+
+    def __init__(self, table: CompactUserTable):
+        self._t = table
+
+    def __getitem__(self, uid: int) -> int:
+        t = self._t
+        i = t._find(uid)
+        if i < 0 or not t._flags[i] & _HAS_BALANCE:
+            raise KeyError(uid)
+        return t._values[i]
+
+    def get(self, uid: int, default=None):
+        t = self._t
+        i = t._find(uid)
+        if i < 0 or not t._flags[i] & _HAS_BALANCE:
+            return default
+        return t._values[i]
+
+    def __contains__(self, uid) -> bool:
+        t = self._t
+        i = t._find(uid)
+        return i >= 0 and bool(t._flags[i] & _HAS_BALANCE)
+
+    def __setitem__(self, uid: int, balance: int) -> None:
+        t = self._t
+        i = t._find_or_insert(uid)
+        if not t._flags[i] & _HAS_BALANCE:
+            t._flags[i] |= _HAS_BALANCE
+            t._counts[0] += 1
+        t._values[i] = balance
+
+    def __delitem__(self, uid: int) -> None:
+        t = self._t
+        i = t._find(uid)
+        if i < 0 or not t._flags[i] & _HAS_BALANCE:
+            raise KeyError(uid)
+        t._flags[i] &= ~_HAS_BALANCE
+        t._counts[0] -= 1
+        t._values[i] = 0
+        t._release(i)
+
+    def __iter__(self) -> Iterator[int]:
+        return self._t._iter_uids(_HAS_BALANCE)
+
+    def __len__(self) -> int:
+        return self._t._counts[0]
+
+
+class _UsernameView(MutableMapping[int, Optional[str]]):
+    __slots__ = ("_t",)
+
+    def __init__(self, table: CompactUserTable):
+        self._t = table
+
+    def __getitem__(self, uid: int) -> Optional[str]:
+        t = self._t
+        i = t._find(uid)
+        if i < 0 or not t._flags[i] & _HAS_NAME:
+            raise KeyError(uid)
+        return t._names[i]
+
+    def get(self, uid: int, default=None):
+        t = self._t
+        i = t._find(uid)
+        if i < 0 or not t._flags[i] & _HAS_NAME:
+            return default
+        return t._names[i]
+
+    def __contains__(self, uid) -> bool:
+        t = self._t
+        i = t._find(uid)
+        return i >= 0 and bool(t._flags[i] & _HAS_NAME)
+
+    def __setitem__(self, uid: int, username: Optional[str]) -> None:
+        t = self._t
+        i = t._find_or_insert(uid)
+        if not t._flags[i] & _HAS_NAME:
+            t._flags[i] |= _HAS_NAME
+            t._counts[1] += 1
+        # повторная загрузка того же username из БД не плодит копии строки
+        t._names[i] = sys.intern(username) if username is not None else None
+
+    def __delitem__(self, uid: int) -> None:
+        t = self._t
+        i = t._find(uid)
+        if i < 0 or not t._flags[i] & _HAS_NAME:
+            raise KeyError(uid)
+        t._flags[i] &= ~_HAS_NAME
+        t._counts[1] -= 1
+        t._names[i] = None
+        t._release(i)
+
+    def __iter__(self) -> Iterator[int]:
+        return self._t._iter_uids(_HAS_NAME)
+
+    def __len__(self) -> int:
+        return self._t._counts[1]
+
+
+# =====================================================
+#                 ЗАМЕР ПАМЯТИ
+# =====================================================
+
+def _dict_memory_bytes(balances: dict, usernames: dict) -> int:
+    """Два dict + объекты int ключей и балансов (строки username не считаем)."""
+    total = sys.getsizeof(balances) + sys.getsizeof(usernames)
+    for uid, balance in balances.items():
+        total += sys.getsizeof(uid)  # один объект ключа на оба dict
+        if not -5 <= balance <= 256:  # мелкие int у CPython общие
+            total += sys.getsizeof(balance)
+    return total
+
+
+def _benchmark(n: int) -> None:
+    import random
+    import time
+
+    rnd = random.Random(n)
+    names = [f"user_{i}" for i in range(1000)]
+
+    def rows():
+        uid = 5_000_000_000
+        for i in range(n):
+            uid += rnd.randint(1, 500)
+            yield uid, rnd.randint(0, 1_000_000), names[i % len(names)]
+
+    started = time.perf_counter()
+    balances: dict = {}
+    usernames: dict = {}
+    for uid, balance, username in rows():
+        balances[uid] = balance
+        usernames[uid] = username
+    dict_fill = time.perf_counter() - started
+    dict_bytes = _dict_memory_bytes(balances, usernames)
+    probe = list(balances)[:: max(1, n // 100_000)]
+    del balances, usernames
+
+    rnd.seed(n)
+    started = time.perf_counter()
+    table = CompactUserTable()
+    for uid, balance, username in rows():
+        table.balances[uid] = balance
+        table.usernames[uid] = username
+    compact_fill = time.perf_counter() - started
+    compact_bytes = table.memory_bytes()
+
+    started = time.perf_counter()
+    for uid in probe:
+        table.balances.get(uid, 0)
+    lookup_us = (time.perf_counter() - started) / len(probe) * 1e6
+
+    mb = 1024 * 1024
+    print(f"{n:>11,} польз. | dict: {dict_bytes / mb:8.1f} МБ "
+          f"({dict_bytes / n:5.1f} Б/польз., заполнение {dict_fill:6.1f} с)")
+    print(f"{'':>11}        | compact: {compact_bytes / mb:5.1f} МБ "
+          f"({compact_bytes / n:5.1f} Б/польз., заполнение {compact_fill:6.1f} с, "
+          f"get {lookup_us:.2f} мкс)")
+
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:] or ["1000000"]:
+        _benchmark(int(arg))
@@ -0,0 +1,163 @@
+# app/services/balance_writer.py
+
+"""
+Write-behind для балансов пользователей.
+
+change_balance / set_balance / register_user (если что-то изменилось)
+только помечают user_id «грязным».
+Фоновая задача раз в BALANCE_FLUSH_INTERVAL_SECONDS забирает накопленные id
+и одной пачкой пишет в users актуальные username/balance из кэша.
+Несколько изменений одного пользователя между сбросами схлопываются в одну запись.
+"""
+
+import asyncio
+from typing import Dict, Iterable, List, Set, Tuple
+
+from app.config import BALANCE_FLUSH_INTERVAL_SECONDS, BALANCE_FLUSH_MAX_PENDING
+from app.db.users import upsert_users_batch
+from app.services.tasks import spawn
+
+# «Грязные» user_id (dict как упорядоченное множество)
+_dirty: Dict[int, None] = {}
+# user_id из пачки, которая пишется прямо сейчас
+_in_flight: Set[int] = set()
+
+# будим фоновую задачу раньше таймера, когда очередь переполнена
+_wakeup = asyncio.Event()
+# выставлен, пока в очереди есть место (для backpressure)
+_has_room = asyncio.Event()
+_has_room.set()
+# одновременно идёт не больше одного сброса
+_flush_lock = asyncio.Lock()
+# расчёты, которые пишут балансы своей транзакцией: (их user_id, кого из них
+# за это время снимал сброс или кто был «грязным» на старте) — см. watch_flushes
+_watches: List[Tuple[Set[int], Set[int]]] = []
+
+_writer_task: asyncio.Task | None = None
+_stopping: bool = False
+
+# счётчики для диагностики
+writer_stats: Dict[str, int] = {"flushes": 0, "rows": 0, "errors": 0}
+
+
+def mark_dirty(uid: int) -> None:
+    """Пометить пользователя для сохранения в БД при ближайшем сбросе."""
+    _dirty[uid] = None
+
+    if len(_dirty) >= BALANCE_FLUSH_MAX_PENDING:
+        # очередь заполнена — сбрасываем досрочно и притормаживаем писателей
+        _has_room.clear()
+        _wakeup.set()
+
+
+def is_dirty(uid: int) -> bool:
+    """Есть ли у пользователя изменения, ещё не записанные в БД."""
+    return uid in _dirty or uid in _in_flight
+
+
+def watch_flushes(uids: Iterable[int]) -> Set[int]:
+    """
+    Начать следить за сбросами пользователей uids (на время транзакции расчёта).
+    Возвращаемое множество пополняется теми, чей баланс сброс снял, пока
+    транзакция шла: такой сброс мог записать баланс без изменений расчёта
+    и закоммититься уже после него. Их надо записать ещё раз.
+    """
+    watched = set(uids)
+    seen = {uid for uid in watched if is_dirty(uid)}
+    _watches.append((watched, seen))
+    return seen
+
+
+def unwatch_flushes(seen: Set[int]) -> None:
+    """Транзакция расчёта завершилась — перестать следить."""
+    for i, (_, s) in enumerate(_watches):
+        if s is seen:
+            del _watches[i]
+            return
+
+
+async def wait_for_room() -> None:
+    """
+    Backpressure для асинхронного кода:
+    если очередь на запись переполнена — ждём ближайшего сброса.
+    """
+    while len(_dirty) >= BALANCE_FLUSH_MAX_PENDING:
+        _wakeup.set()
+        await _has_room.wait()
+
+
+async def flush_dirty_users() -> int:
+    """
+    Записать всех «грязных» пользователей одной пачкой.
+    Возвращает количество записанных строк.
+    """
+    # импорт внутри — balances сам импортирует этот модуль
+    from app.services.balances import settled_balance, user_usernames
+
+    async with _flush_lock:
+        if not _dirty:
+            return 0
+
+        uids = list(_dirty)
+        _dirty.clear()
+        for watched, seen in _watches:
+            seen.update(watched.intersection(uids))
+
+        # снимок берём синхронно: всё, что изменится во время записи,
+        # снова попадёт в _dirty и уйдёт следующим сбросом;
+        # незакреплённые изменения (идущая игра) не пишем — их запишет расчёт
+        rows = [
+            (uid, user_usernames.get(uid), settled_balance(uid))
+            for uid in uids
+        ]
+
+        _in_flight.update(uids)
+        try:
+            await upsert_users_batch(rows)
+        except Exception as e:
+            writer_stats["errors"] += 1
+            print("Ошибка сброса балансов в БД:", e)
+            # возвращаем id в очередь — попробуем на следующем тике
+            for uid in uids:
+                _dirty.setdefault(uid, None)
+            return 0
+        finally:
+            _in_flight.clear()
+            if len(_dirty) < BALANCE_FLUSH_MAX_PENDING:
+                _has_room.set()
+
+        writer_stats["flushes"] += 1
+        writer_stats["rows"] += len(rows)
+        return len(rows)
+
+
+async def _writer_loop():
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=BALANCE_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        if _dirty:
+            # сам сброс — через супервизор; повторные тики склеиваются по key
+            spawn("flush_balances", flush_dirty_users, key="flush_balances")
+
+
+def start_balance_writer() -> None:
+    """Запустить фоновый сброс балансов (вызывается после init_db)."""
+    global _writer_task, _stopping
+    if _writer_task and not _writer_task.done():
+        return
+    _stopping = False
+    _writer_task = asyncio.create_task(_writer_loop())
+
+
+async def stop_balance_writer() -> None:
+    """Остановить фоновую задачу и дописать всё, что осталось в очереди."""
+    global _writer_task, _stopping
+    _stopping = True
+    _wakeup.set()
+    if _writer_task:
+        await _writer_task
+        _writer_task = None
+    await flush_dirty_users()
@@ -1,64 +1,222 @@
 # app/services/balances.py
 
+"""
+Кэш балансов и username пользователей.
+
+BALANCE_CACHE_MODE = "eager": init_db загружает весь users, кэш не ограничен.
+BALANCE_CACHE_MODE = "lazy": пользователь подгружается из БД при первом
+обращении (load_user / load_users), кэш — LRU на BALANCE_CACHE_MAX_USERS.
+Вытесняются только пользователи, чьи изменения уже записаны в БД.
+В режиме "lazy" перед изменением баланса пользователь должен быть загружен:
+отправителя апдейта подгружает middleware, остальных (получатель перевода,
+участники игры, победитель розыгрыша) — вызывающий код.
+"""
+
 import asyncio
-from typing import Dict, Any
+from collections import OrderedDict
+from typing import Dict, Hashable, Iterable, List, MutableMapping, Optional, Tuple
 
-from app.db.users import upsert_user
+from app.config import (
+    BALANCE_CACHE_MAX_USERS,
+    BALANCE_CACHE_MODE,
+    BALANCE_STORE,
+    MAIN_ADMIN_ID,
+)
+from app.db.users import get_users_by_ids
+from app.services.balance_store import CompactUserTable
+from app.services.balance_writer import is_dirty, mark_dirty
+from app.services.ledger import record_ledger
+from app.services.user_locks import user_lock, user_locks
 
 # Баланс пользователей (кэш в памяти, синхронизируется с БД)
-user_balances: Dict[int, int] = {}
+user_balances: MutableMapping[int, int]
 
 # username по user_id (для переводов и отображения)
-user_usernames: Dict[int, str] = {}
+user_usernames: MutableMapping[int, str]
+
+if BALANCE_STORE == "compact":
+    _store = CompactUserTable()
+    user_balances = _store.balances
+    user_usernames = _store.usernames
+else:
+    user_balances = {}
+    user_usernames = {}
+
+# username в нижнем регистре -> user_id (поиск получателя перевода за O(1))
+username_index: Dict[str, int] = {}
+
+# ----- Ленивый кэш (BALANCE_CACHE_MODE = "lazy") -----
+# порядок обращений: в начале — давно не использованные
+_recent: "OrderedDict[int, None]" = OrderedDict()
+# загрузки, которые уже идут: user_id -> future
+_loading: Dict[int, asyncio.Future] = {}
+
+balance_cache_stats: Dict[str, int] = {"loads": 0, "misses": 0, "evictions": 0}
+
+# ----- Незакреплённые изменения (apply_balance_delta) -----
+# Изменение уже в кэше, но в БД его запишет транзакция расчёта операции.
+# До неё ни write-behind, ни журнал его не видят: если процесс упадёт,
+# в БД не останется «половины» игры. Операцию определяет ключ: id игры
+# или, если id разных операций могут совпасть, свой ключ (("raffle", id)).
+# user_id -> {ключ операции: сумма изменений}
+_unsettled: Dict[int, Dict[Hashable, int]] = {}
+# ключ операции -> записи журнала, которые уйдут после расчёта:
+# (user_id, delta, reason, ref_id)
+_unsettled_ledger: Dict[Hashable, List[Tuple[int, int, str, Optional[int]]]] = {}
+
+# register_user: сколько раз ставили запись и сколько раз пропустили (ничего не изменилось)
+register_stats: Dict[str, int] = {"writes": 0, "skipped": 0}
+
+
+# 🟦 LAZY CACHE -------------------------------------------------------------
+
+
+def is_lazy_cache() -> bool:
+    return BALANCE_CACHE_MODE == "lazy"
+
+
+def _touch(uid: int) -> None:
+    if is_lazy_cache():
+        _recent[uid] = None
+        _recent.move_to_end(uid)
+
+
+def _evict() -> None:
+    """Вытеснить давно не использованных пользователей сверх лимита."""
+    checked = 0
+    while len(user_balances) > BALANCE_CACHE_MAX_USERS and checked < len(_recent):
+        uid = next(iter(_recent))
+        checked += 1
+        if uid == MAIN_ADMIN_ID or _unsettled.get(uid) or is_dirty(uid):
+            # ещё нужен или не записан в БД — в конец очереди
+            _recent.move_to_end(uid)
+            continue
+        del _recent[uid]
+        user_balances.pop(uid, None)
+        _drop_username(uid)
+        balance_cache_stats["evictions"] += 1
+
+
+async def load_users(uids: Iterable[int]) -> None:
+    """
+    Подгрузить пользователей в кэш (в режиме "eager" ничего не делает).
+    Недостающих читаем одним запросом; одновременные загрузки
+    одного и того же пользователя склеиваются.
+    """
+    if not is_lazy_cache():
+        return
 
-# ----- Пополнения -----
-pending_topup: Dict[int, Any] = {}
+    missing: List[int] = []
+    waiting: List[asyncio.Future] = []
+    for uid in dict.fromkeys(uids):
+        if uid in user_balances:
+            _touch(uid)
+        elif uid in _loading:
+            waiting.append(_loading[uid])
+        else:
+            missing.append(uid)
 
-# ----- Вывод -----
-pending_withdraw: Dict[int, Any] = {}
-temp_withdraw: Dict[int, Any] = {}
+    if missing:
+        balance_cache_stats["misses"] += len(missing)
+        future = asyncio.get_running_loop().create_future()
+        for uid in missing:
+            _loading[uid] = future
+        try:
+            rows = await get_users_by_ids(missing)
+            for uid, username, balance in rows:
+                # пока шёл запрос, значение в кэше могло появиться — оно новее
+                if uid not in user_balances:
+                    user_balances[uid] = balance
+                    if username:
+                        _set_username(uid, username, from_db=True)
+                _touch(uid)
+            balance_cache_stats["loads"] += len(rows)
+        finally:
+            for uid in missing:
+                _loading.pop(uid, None)
+            future.set_result(None)
+        _evict()
 
-# ----- Переводы -----
-# шаг перевода: None / "await_username" / "await_amount"
-pending_transfer_step: Dict[int, str] = {}
-# временно сохраняем id получателя
-pending_transfer_target: Dict[int, int] = {}
-# временно сохраняем данные перевода
-temp_transfer: Dict[int, Any] = {}
+    if waiting:
+        await asyncio.gather(*waiting)
+
+
+async def load_user(uid: int) -> None:
+    await load_users((uid,))
+
+
+def balance_cache_size() -> int:
+    return len(user_balances)
+
+
+# 🟦 USERNAME INDEX ---------------------------------------------------------
+
+
+def _drop_username(uid: int) -> None:
+    old = user_usernames.pop(uid, None)
+    if old and username_index.get(old.lower()) == uid:
+        del username_index[old.lower()]
+
+
+def _set_username(uid: int, username: str, from_db: bool = False) -> None:
+    """
+    Сохранить username в кэше и индексе.
+    Username в Telegram уникален: если он был у другого пользователя,
+    у того он стирается (в БД — при ближайшем сбросе write-behind).
+    from_db=True — значение из БД могло устареть, чужой username не забираем.
+    """
+    key = username.lower()
+    owner = username_index.get(key)
+    if owner is not None and owner != uid:
+        if from_db:
+            return
+        user_usernames.pop(owner, None)
+
+    _drop_username(uid)
+    user_usernames[uid] = username
+    username_index[key] = uid
+
+
+def find_user_by_username(username: str) -> Optional[int]:
+    """user_id по @username из кэша (без учёта регистра) или None."""
+    uname = username.strip().lstrip("@").lower()
+    return username_index.get(uname) if uname else None
 
 
 # 🟦 USER MANAGEMENT --------------------------------------------------------
 
 
 def register_user(user) -> None:
-    """Регистрируем пользователя:
-    - сохраняем username в кэш
-    - создаём/обновляем запись в users в БД
+    """Регистрируем пользователя (вызывается middleware на каждый апдейт):
+    - новый пользователь — создаём с нулём
+    - сохраняем username в кэш, если он изменился
+    - в users пишем только если что-то поменялось (write-behind)
     """
     uid = user.id
+    changed = False
 
-    # Сохраняем username в кэше
-    if user.username:
-        user_usernames[uid] = user.username
+    # Сохраняем username в кэше (и в индексе для переводов)
+    if user.username and user_usernames.get(uid) != user.username:
+        _set_username(uid, user.username)
+        changed = True
 
-    # Если пользователя ещё нет в кэше балансов — создаём с нулём
+    # Пользователя нет в кэше (в режиме "lazy" — уже после загрузки из БД),
+    # значит, нет и в users — создаём с нулём
     if uid not in user_balances:
         user_balances[uid] = 0
+        _touch(uid)
+        _evict()
+        changed = True
+    else:
+        _touch(uid)
 
-    # Асинхронно создаём/обновляем запись в БД
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        # нет запущенного цикла (теоретически не должно быть в боте)
+    if not changed:
+        register_stats["skipped"] += 1
         return
 
-    loop.create_task(
-        upsert_user(
-            uid=uid,
-            username=user.username,
-            balance=user_balances[uid],
-        )
-    )
+    # Запись в БД уйдёт пачкой при ближайшем сбросе
+    register_stats["writes"] += 1
+    mark_dirty(uid)
 
 
 # 🟦 BALANCE ----------------------------------------------------------------
@@ -66,40 +224,190 @@ def register_user(user) -> None:
 
 def get_balance(uid: int) -> int:
     """Получаем баланс из кэша (он синхронизируется с БД при изменениях)."""
+    if uid in user_balances:
+        _touch(uid)
     return user_balances.get(uid, 0)
 
 
 def _sync_user_to_db(uid: int) -> None:
-    """Планируем обновление баланса/username в БД в фоне."""
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        return
-
-    username = user_usernames.get(uid)
-    balance = user_balances.get(uid, 0)
+    """Планируем обновление баланса/username в БД (write-behind, пачкой)."""
+    mark_dirty(uid)
 
-    loop.create_task(
-        upsert_user(
-            uid=uid,
-            username=username,
-            balance=balance,
-        )
-    )
 
-
-def change_balance(uid: int, amount: int) -> None:
-    """Изменить баланс на +amount или -amount и сохранить в БД."""
+def change_balance(
+    uid: int,
+    amount: int,
+    reason: str = "adjust",
+    ref_id: Optional[int] = None,
+) -> None:
+    """
+    Изменить баланс на +amount или -amount и сохранить в БД.
+    reason / ref_id попадают в журнал балансов (ledger).
+    """
     current = user_balances.get(uid, 0)
     new_balance = current + amount
     user_balances[uid] = new_balance
+    _touch(uid)
 
+    record_ledger(uid, amount, reason, ref_id)
     _sync_user_to_db(uid)
 
 
-def set_balance(uid: int, amount: int) -> None:
+def set_balance(uid: int, amount: int, reason: str = "admin_set") -> None:
     """Админская функция — установить баланс напрямую и сохранить в БД."""
+    current = user_balances.get(uid, 0)
     user_balances[uid] = amount
+    _touch(uid)
+
+    record_ledger(uid, amount - current, reason)
     _sync_user_to_db(uid)
 
 
+# 🟦 ATOMIC DEBIT -----------------------------------------------------------
+
+
+async def try_debit(
+    uid: int,
+    amount: int,
+    reason: str,
+    ref_id: Optional[int] = None,
+    settle_later: bool = False,
+    key: Optional[Hashable] = None,
+) -> bool:
+    """
+    Проверить баланс и списать amount под замком пользователя.
+    False — денег не хватает, баланс не тронут.
+    settle_later=True — списание только в кэше (apply_balance_delta с key),
+    в БД его запишет транзакция расчёта (settle_dice_game / итог раунда Банкира).
+    """
+    async with user_lock(uid):
+        await load_user(uid)
+        if user_balances.get(uid, 0) < amount:
+            return False
+        if settle_later:
+            apply_balance_delta(uid, -amount, reason, ref_id, key)
+        else:
+            change_balance(uid, -amount, reason, ref_id)
+        return True
+
+
+async def transfer_balance(from_uid: int, to_uid: int, amount: int) -> bool:
+    """
+    Перевод между пользователями: замки обоих (в фиксированном порядке),
+    проверка и списание/зачисление без await между ними.
+    """
+    async with user_locks(from_uid, to_uid):
+        await load_users((from_uid, to_uid))
+        if user_balances.get(from_uid, 0) < amount:
+            return False
+        change_balance(from_uid, -amount, reason="transfer_out", ref_id=to_uid)
+        change_balance(to_uid, amount, reason="transfer_in", ref_id=from_uid)
+        return True
+
+
+# 🟦 UNIT OF WORK -----------------------------------------------------------
+
+
+def apply_balance_delta(
+    uid: int,
+    amount: int,
+    reason: str,
+    ref_id: int,
+    key: Optional[Hashable] = None,
+) -> int:
+    """
+    Изменить баланс только в кэше, без постановки в write-behind.
+    Для операций, которые сами сохраняют балансы в своей транзакции
+    (расчёт игры в кости, ref_id — id игры). В БД и журнал изменение
+    попадёт вместе с расчётом (confirm_committed_balances).
+    key — ключ операции, если ref_id недостаточно (по умолчанию ref_id).
+    Возвращает новый баланс.
+    """
+    if key is None:
+        key = ref_id
+    new_balance = user_balances.get(uid, 0) + amount
+    user_balances[uid] = new_balance
+    # пока есть незакреплённые изменения, пользователя нельзя вытеснять из кэша
+    refs = _unsettled.setdefault(uid, {})
+    refs[key] = refs.get(key, 0) + amount
+    _unsettled_ledger.setdefault(key, []).append((uid, amount, reason, ref_id))
+    _touch(uid)
+    return new_balance
+
+
+def unsettled_changes(key: Hashable) -> List[Tuple[int, int, str]]:
+    """
+    Незакреплённые изменения операции key: (user_id, delta, reason).
+    Их хранит снимок живого состояния — после перезапуска они
+    применяются заново (в БД их ещё нет).
+    """
+    return [(uid, delta, reason) for uid, delta, reason, _ in _unsettled_ledger.get(key, [])]
+
+
+def unsettled_users(key: Hashable) -> List[int]:
+    """Пользователи с незакреплёнными изменениями операции key."""
+    return list(dict.fromkeys(uid for uid, _, _, _ in _unsettled_ledger.get(key, [])))
+
+
+def settled_balance(uid: int, include_ref: Optional[Hashable] = None) -> int:
+    """
+    Баланс без незакреплённых изменений — то, что можно писать в БД.
+    include_ref — изменения этой операции оставить (их пишет её транзакция).
+    """
+    balance = user_balances.get(uid, 0)
+    for ref_id, delta in _unsettled.get(uid, {}).items():
+        if ref_id != include_ref:
+            balance -= delta
+    return balance
+
+
+def snapshot_users(uids: Iterable[int], ref_id: Hashable) -> List[Tuple[int, str | None, int]]:
+    """(user_id, username, balance) для записи в транзакции расчёта операции ref_id."""
+    return [(uid, user_usernames.get(uid), settled_balance(uid, ref_id)) for uid in uids]
+
+
+def _settle_ref(ref_id: Hashable, uids: Iterable[int]) -> None:
+    uids = set(uids)
+    for uid in uids:
+        refs = _unsettled.get(uid)
+        if refs is not None:
+            refs.pop(ref_id, None)
+            if not refs:
+                del _unsettled[uid]
+    # в журнал — только изменения закреплённых пользователей,
+    # остальные ждут своей записи
+    entries = _unsettled_ledger.pop(ref_id, [])
+    rest = [e for e in entries if e[0] not in uids]
+    if rest:
+        _unsettled_ledger[ref_id] = rest
+    for uid, delta, reason, ledger_ref in entries:
+        if uid in uids:
+            record_ledger(uid, delta, reason, ledger_ref)
+
+
+def confirm_committed_balances(
+    ref_id: Hashable, committed: Dict[int, int], raced: Iterable[int] = ()
+) -> None:
+    """
+    Транзакция операции ref_id закоммичена: её изменения закреплены
+    и уходят в журнал. Если баланс успел измениться, пока шла
+    транзакция, — новое значение допишет write-behind.
+    raced — кого во время транзакции снимал сброс (watch_flushes):
+    он мог перезаписать закоммиченный баланс старым, пишем заново.
+    """
+    _settle_ref(ref_id, committed)
+    raced = set(raced)
+    for uid, balance in committed.items():
+        if uid in raced or settled_balance(uid) != balance:
+            _sync_user_to_db(uid)
+
+
+def requeue_unsettled(ref_id: Hashable, uids: Iterable[int]) -> None:
+    """
+    Изменения операции ref_id у пользователей uids допишет write-behind:
+    её транзакция не прошла или её не будет (ставку отменили).
+    """
+    uids = list(uids)
+    _settle_ref(ref_id, uids)
+    for uid in uids:
+        _sync_user_to_db(uid)
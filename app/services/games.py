@@ -1,51 +1,183 @@
 # app/services/games.py
 import asyncio
+from bisect import bisect_right
 from datetime import datetime, timedelta, timezone
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from sortedcontainers import SortedList
 
 from app.bot import bot
 from app.config import (
     HISTORY_LIMIT,
     HISTORY_PAGE_SIZE,
+    LOBBY_BET_BUCKETS,
+    LOBBY_PAGE_SIZE,
     MAIN_ADMIN_ID,
 )
 from app.db.games import (
-    get_user_games,
-    get_users_profit_and_games_30_days,
+    get_user_games_page,
+    get_user_games_stats,
+    get_dice_rating_30_days,
     get_user_dice_games_count,
-    upsert_game,
+    settle_dice_game,
 )
-from app.services.balances import change_balance, get_balance, user_usernames
+from app.services.balances import (
+    apply_balance_delta,
+    confirm_committed_balances,
+    get_balance,
+    load_users,
+    requeue_unsettled,
+    snapshot_users,
+    user_usernames,
+)
+from app.services.balance_writer import unwatch_flushes, watch_flushes
+from app.services.history_cache import (
+    get_cached_history,
+    history_generation,
+    invalidate_history,
+    put_cached_history,
+)
+from app.services.leaderboard import (
+    get_leaderboard_rating,
+    is_leaderboard_ready,
+    record_game_result,
+)
+from app.services.live_state import mark_live_state_changed
 from app.utils.formatters import format_rubles
 
-# Активные игры и служебные флаги
+# Живые игры: ждут соперника или играются прямо сейчас.
+# Завершённая игра удаляется, как только её расчёт записан в БД.
 games: Dict[int, Dict[str, Any]] = {}
-pending_bet_input: Dict[int, bool] = {}
+# Только ждущие соперника — из них строится лобби
+open_games: Dict[int, Dict[str, Any]] = {}
 next_game_id: int = 1
 
+# Индекс лобби: -id (новые игры первыми) — все открытые и по диапазонам ставки.
+# Страница лобби — срез SortedList, O(log n + размер страницы).
+_lobby_all: SortedList = SortedList()
+_lobby_by_bucket: List[SortedList] = [SortedList() for _ in LOBBY_BET_BUCKETS]
+
+games_stats: Dict[str, int] = {"created": 0, "evicted": 0}
+
+
+def allocate_game_id() -> int:
+    """Выдать id новой игры (синхронно — до первого await)."""
+    global next_game_id
+    gid = next_game_id
+    next_game_id += 1
+    return gid
+
+
+def bet_bucket(bet: int) -> int:
+    """Номер диапазона LOBBY_BET_BUCKETS, в который попадает ставка."""
+    return max(0, bisect_right(LOBBY_BET_BUCKETS, bet) - 1)
+
+
+def open_game(g: Dict[str, Any]) -> None:
+    """Выставить игру в лобби."""
+    gid = g["id"]
+    if gid in open_games:
+        return
+    open_games[gid] = g
+    _lobby_all.add(-gid)
+    _lobby_by_bucket[bet_bucket(g["bet"])].add(-gid)
+
+
+def close_open_game(gid: int) -> None:
+    """Убрать игру из лобби (вступил соперник, отмена, расчёт)."""
+    g = open_games.pop(gid, None)
+    if g is None:
+        return
+    _lobby_all.discard(-gid)
+    _lobby_by_bucket[bet_bucket(g["bet"])].discard(-gid)
+
+
+def add_game(g: Dict[str, Any]) -> None:
+    """Новая (или восстановленная) игра без соперника — в живые и в лобби."""
+    games[g["id"]] = g
+    open_game(g)
+    games_stats["created"] += 1
+
+
+def remove_game(gid: int) -> None:
+    """Убрать игру из памяти (отменена или рассчитана)."""
+    games.pop(gid, None)
+    close_open_game(gid)
+
+
+def live_games_size() -> Tuple[int, int]:
+    """(живых игр, из них открытых)"""
+    return len(games), len(open_games)
+
 
 # =====================================================
 #                     МЕНЮ ИГР
 # =====================================================
 
-def build_games_keyboard(uid: int) -> InlineKeyboardMarkup:
+# Лобби в callback_data: lobby:<a | номер диапазона>:<page>
+def _lobby_callback(bucket: Optional[int], page: int) -> str:
+    return f"lobby:{'a' if bucket is None else bucket}:{page}"
+
+
+def parse_lobby_callback(data: str) -> Tuple[Optional[int], int]:
+    """lobby:... → (bucket, page). refresh_games и мусор — первая страница всех игр."""
+    parts = data.split(":")
+    if len(parts) != 3 or not parts[2].isdigit():
+        return None, 0
+    bucket = int(parts[1]) if parts[1].isdigit() else None
+    if bucket is not None and bucket >= len(LOBBY_BET_BUCKETS):
+        bucket = None
+    return bucket, int(parts[2])
+
+
+def _bucket_label(i: int) -> str:
+    lo = LOBBY_BET_BUCKETS[i]
+    if i + 1 < len(LOBBY_BET_BUCKETS):
+        return f"{format_rubles(lo)}–{format_rubles(LOBBY_BET_BUCKETS[i + 1] - 1)}"
+    return f"от {format_rubles(lo)}"
+
+
+def build_games_keyboard(
+    uid: int, page: int = 0, bucket: Optional[int] = None
+) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
 
-    # верхний ряд — создать / обновить
+    # верхний ряд — создать / обновить (обновляем ту же страницу и фильтр)
     rows.append(
         [
             InlineKeyboardButton(text="✅ Создать игру", callback_data="create_game"),
-            InlineKeyboardButton(text="🔄 Обновить", callback_data="refresh_games"),
+            InlineKeyboardButton(
+                text="🔄 Обновить", callback_data=_lobby_callback(bucket, page)
+            ),
         ]
     )
 
-    # активные игры (без соперника)
-    active = [g for g in games.values() if g.get("opponent_id") is None]
-    active.sort(key=lambda x: x["id"], reverse=True)
+    # фильтр по ставке
+    filters = [
+        InlineKeyboardButton(
+            text=("• Все" if bucket is None else "Все"),
+            callback_data=_lobby_callback(None, 0),
+        )
+    ]
+    for i in range(len(LOBBY_BET_BUCKETS)):
+        label = _bucket_label(i)
+        filters.append(
+            InlineKeyboardButton(
+                text=(f"• {label}" if bucket == i else label),
+                callback_data=_lobby_callback(i, 0),
+            )
+        )
+    rows.append(filters)
+
+    # активные игры (без соперника), новые сверху — только текущая страница
+    index = _lobby_all if bucket is None else _lobby_by_bucket[bucket]
+    pages = max(1, -(-len(index) // LOBBY_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    start = page * LOBBY_PAGE_SIZE
 
-    for g in active:
+    for neg_id in index.islice(start, start + LOBBY_PAGE_SIZE):
+        g = open_games[-neg_id]
         txt = f"🎲 Игра №{g['id']} | {format_rubles(g['bet'])} ₽"
         if g["creator_id"] == uid:
             rows.append(
@@ -60,6 +192,21 @@ def build_games_keyboard(uid: int) -> InlineKeyboardMarkup:
                 [InlineKeyboardButton(text=txt, callback_data=f"game_open:{g['id']}")]
             )
 
+    if pages > 1:
+        nav_row: List[InlineKeyboardButton] = []
+        if page > 0:
+            nav_row.append(
+                InlineKeyboardButton(text="⬅️", callback_data=_lobby_callback(bucket, page - 1))
+            )
+        nav_row.append(
+            InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="ignore")
+        )
+        if page + 1 < pages:
+            nav_row.append(
+                InlineKeyboardButton(text="➡️", callback_data=_lobby_callback(bucket, page + 1))
+            )
+        rows.append(nav_row)
+
     # мои игры / рейтинг
     rows.append(
         [
@@ -120,46 +267,61 @@ def calculate_profit(uid: int, g: Dict[str, Any]) -> int:
     return 0
 
 
-async def build_user_stats_and_history(
-    uid: int,
-) -> tuple[str, List[Dict[str, Any]]]:
-    """
-    Статистика и история игр пользователя.
-    История берётся из БД → get_user_games.
-    """
-    finished = await get_user_games(uid)
-    finished = finished[:HISTORY_LIMIT]
+# Курсор истории в callback_data:
+#   my_games:<page>                          — первая страница
+#   my_games:<page>:<o|n>:<finished_at, мкс>:<id> — старше / новее этой игры
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
 
-    stats = {
-        "month": {"games": 0, "profit": 0},
-        "week": {"games": 0, "profit": 0},
-        "day": {"games": 0, "profit": 0},
-    }
 
-    now = datetime.now(timezone.utc)
+def _history_callback(page: int, direction: str, g: Dict[str, Any]) -> str:
+    if page == 0:
+        return "my_games:0"
+    us = (g["finished_at"] - _EPOCH) // timedelta(microseconds=1)
+    return f"my_games:{page}:{direction[0]}:{us}:{g['id']}"
 
-    for g in finished:
-        finished_at = g.get("finished_at")
-        if not finished_at:
-            continue
 
-        if isinstance(finished_at, str):
-            finished_at = datetime.fromisoformat(finished_at)
-        if finished_at.tzinfo is None:
-            finished_at = finished_at.replace(tzinfo=timezone.utc)
+def parse_history_callback(
+    data: str,
+) -> tuple[int, Optional[Tuple[datetime, int]], str]:
+    """my_games:... → (page, cursor, direction). Без курсора — первая страница."""
+    parts = data.split(":")
+    if len(parts) != 5:
+        return 0, None, "older"
 
-        diff = now - finished_at
-        profit = calculate_profit(uid, g)
+    page = int(parts[1])
+    direction = "newer" if parts[2] == "n" else "older"
+    finished_at = _EPOCH + timedelta(microseconds=int(parts[3]))
+    return page, (finished_at, int(parts[4])), direction
 
-        if diff <= timedelta(days=30):
-            stats["month"]["games"] += 1
-            stats["month"]["profit"] += profit
-        if diff <= timedelta(days=7):
-            stats["week"]["games"] += 1
-            stats["week"]["profit"] += profit
-        if diff <= timedelta(days=1):
-            stats["day"]["games"] += 1
-            stats["day"]["profit"] += profit
+
+async def build_user_stats_and_history(
+    uid: int,
+    page: int = 0,
+    cursor: Optional[Tuple[datetime, int]] = None,
+    direction: str = "older",
+) -> tuple[str, List[Dict[str, Any]], Dict[str, Optional[str]]]:
+    """
+    Статистика и одна страница истории игр пользователя.
+    - статистика → агрегат get_user_games_stats
+    - история → get_user_games_page по курсору (finished_at, id)
+    Возвращает (текст статистики, игры страницы, callback_data кнопок «назад»/«вперёд»).
+    Готовый результат кэшируется до завершения следующей игры пользователя.
+    """
+    cache_key = (page, cursor, direction)
+    cached = get_cached_history(uid, cache_key)
+    if cached is not None:
+        return cached
+
+    generation = history_generation(uid)
+    stats = await get_user_games_stats(uid)
+
+    if direction == "newer":
+        finished = await get_user_games_page(uid, cursor, "newer", HISTORY_PAGE_SIZE)
+        has_older = True
+    else:
+        finished = await get_user_games_page(uid, cursor, "older", HISTORY_PAGE_SIZE + 1)
+        has_older = len(finished) > HISTORY_PAGE_SIZE
+        finished = finished[:HISTORY_PAGE_SIZE]
 
     def ps(v: int) -> str:
         return ("+" if v > 0 else "") + format_rubles(v)
@@ -175,7 +337,7 @@ async def build_user_stats_and_history(
 
     # История
     history: List[Dict[str, Any]] = []
-    for g in finished[:HISTORY_LIMIT]:
+    for g in finished:
         creator = g["creator_id"] == uid
         opp_id = g["opponent_id"] if creator else g["creator_id"]
         opp_name = user_usernames.get(opp_id, f"ID{opp_id}")
@@ -193,30 +355,39 @@ async def build_user_stats_and_history(
         opp = g["opponent_roll"] if creator else g["creator_roll"]
 
         history.append(
-            {"bet": bet, "emoji": emoji, "text": text, "my": my, "opp": opp}
+            {
+                "id": g["id"],
+                "finished_at": g["finished_at"],
+                "bet": bet,
+                "emoji": emoji,
+                "text": text,
+                "my": my,
+                "opp": opp,
+            }
         )
 
-    return stats_text, history
+    # навигация: не дальше HISTORY_LIMIT последних игр
+    nav: Dict[str, Optional[str]] = {"prev": None, "next": None}
+    if history and page > 0:
+        nav["prev"] = _history_callback(page - 1, "newer", history[0])
+    if history and has_older and (page + 1) * HISTORY_PAGE_SIZE < HISTORY_LIMIT:
+        nav["next"] = _history_callback(page + 1, "older", history[-1])
+
+    put_cached_history(uid, cache_key, (stats_text, history, nav), generation)
+    return stats_text, history, nav
 
 
 def build_history_keyboard(
-    history: List[Dict[str, Any]], page: int
+    history: List[Dict[str, Any]], nav: Dict[str, Optional[str]]
 ) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
 
-    total = len(history)
-    if total == 0:
+    if not history:
         rows.append([InlineKeyboardButton(text="История пуста", callback_data="ignore")])
         rows.append([InlineKeyboardButton(text="🎮 Игры", callback_data="menu_games")])
         return InlineKeyboardMarkup(inline_keyboard=rows)
 
-    pages = (total + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE
-    page = max(0, min(page, pages - 1))
-
-    start = page * HISTORY_PAGE_SIZE
-    end = start + HISTORY_PAGE_SIZE
-
-    for h in history[start:end]:
+    for h in history:
         text = (
             f"{format_rubles(h['bet'])} ₽ | "
             f"{h['emoji']} | "
@@ -226,14 +397,10 @@ def build_history_keyboard(
         rows.append([InlineKeyboardButton(text=text, callback_data="ignore")])
 
     nav_row: List[InlineKeyboardButton] = []
-    if page > 0:
-        nav_row.append(
-            InlineKeyboardButton(text="⬅️ Назад", callback_data=f"my_games:{page - 1}")
-        )
-    if page < pages - 1:
-        nav_row.append(
-            InlineKeyboardButton(text="➡️ Вперёд", callback_data=f"my_games:{page + 1}")
-        )
+    if nav.get("prev"):
+        nav_row.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=nav["prev"]))
+    if nav.get("next"):
+        nav_row.append(InlineKeyboardButton(text="➡️ Вперёд", callback_data=nav["next"]))
     if nav_row:
         rows.append(nav_row)
 
@@ -248,50 +415,22 @@ def build_history_keyboard(
 
 async def build_rating_text(requesting_uid: int) -> str:
     """
-    Строим рейтинг, учитывая, что get_users_profit_and_games_30_days()
-    возвращает КОРТЕЖ: (finished_games, all_uids)
+    Строим рейтинг: топ-3, место запрашивающего и общее число игроков.
+    Берём из рейтинга в памяти, а пока он не загружен — из БД.
     """
-    now = datetime.now(timezone.utc)
-    finished_games, all_uids = await get_users_profit_and_games_30_days()
-
-    user_stats: Dict[int, Dict[str, int]] = {}
-
-    # собираем профит и количество игр по каждому пользователю
-    for g in finished_games:
-        finished_at = g.get("finished_at")
-        if isinstance(finished_at, str):
-            finished_at = datetime.fromisoformat(finished_at)
-
-        if not finished_at:
-            continue
-        if finished_at.tzinfo is None:
-            finished_at = finished_at.replace(tzinfo=timezone.utc)
-
-        if (now - finished_at) > timedelta(days=30):
-            continue
-
-        for uid in (g["creator_id"], g["opponent_id"]):
-            if uid is None:
-                continue
-            stats = user_stats.setdefault(uid, {"profit": 0, "games": 0})
-            stats["profit"] += calculate_profit(uid, g)
-            stats["games"] += 1
+    if is_leaderboard_ready():
+        top_list, me, total_players = get_leaderboard_rating(requesting_uid, top_n=3)
+    else:
+        top_list, me, total_players = await get_dice_rating_30_days(requesting_uid, top_n=3)
 
-    if not user_stats:
+    if not top_list:
         return "🏆 Рейтинг пока пуст — за последние 30 дней не было завершённых игр."
 
-    # сортировка по профиту, при равном профите — по количеству игр
-    sorted_stats = sorted(
-        user_stats.items(),
-        key=lambda x: (x[1]["profit"], -x[1]["games"]),
-        reverse=True,
-    )
-
-    top_list = sorted_stats[:3]
     medals = ["🥇", "🥈", "🥉"]
     top_lines: List[str] = []
 
-    for i, (uid, s) in enumerate(top_list):
+    for i, s in enumerate(top_list):
+        uid = s["user_id"]
         username = user_usernames.get(uid) or f"ID{uid}"
         profit = s["profit"]
         games_count = s["games"]
@@ -300,25 +439,16 @@ async def build_rating_text(requesting_uid: int) -> str:
             f"{medals[i]} {username} — {sign}{format_rubles(profit)} ₽ за {games_count} игр"
         )
 
-    total_players = len(sorted_stats)
-    user_place = None
-    user_profit = user_stats.get(requesting_uid, {"profit": 0, "games": 0})
-
-    for i, (uid, _) in enumerate(sorted_stats):
-        if uid == requesting_uid:
-            user_place = i + 1
-            break
-
     lines: List[str] = ["🏆 ТОП 3 игроков в кости:\n"]
     lines.extend(top_lines)
     lines.append("\n")
 
-    if user_place:
-        profit_str = format_rubles(user_profit["profit"])
-        games_count = user_profit["games"]
-        sign = "+" if user_profit["profit"] >= 0 else ""
+    if me:
+        profit_str = format_rubles(me["profit"])
+        games_count = me["games"]
+        sign = "+" if me["profit"] >= 0 else ""
         lines.append(
-            f"Ваше место в рейтинге: {user_place} из {total_players} "
+            f"Ваше место в рейтинге: {me['place']} из {total_players} "
             f"({sign}{profit_str} ₽ за {games_count} игр)"
         )
     else:
@@ -351,6 +481,31 @@ async def telegram_roll(uid: int) -> int:
     return msg.dice.value
 
 
+async def settle_game(g: Dict[str, Any]) -> None:
+    """
+    Сохранить расчёт игры одной транзакцией (settle_dice_game):
+    результат, балансы обоих игроков (включая списание ставки соперника
+    при вступлении) и комиссию админа.
+    """
+    uids = list(dict.fromkeys((g["creator_id"], g["opponent_id"], MAIN_ADMIN_ID)))
+
+    # снимок балансов берём синхронно, до первого await
+    rows = snapshot_users(uids, g["id"])
+    # сброс write-behind, идущий параллельно, пишет баланс без этой игры
+    raced = watch_flushes(uids)
+    try:
+        committed = await settle_dice_game(g, rows)
+    except Exception as e:
+        print(f"Ошибка сохранения игры #{g['id']}:", e)
+        # балансы не потеряем — допишет write-behind
+        requeue_unsettled(g["id"], uids)
+        return
+    finally:
+        unwatch_flushes(raced)
+
+    confirm_committed_balances(g["id"], committed, raced)
+
+
 async def play_game(gid: int):
     """
     Логика игры в кости:
@@ -389,18 +544,38 @@ async def play_game(gid: int):
     commission = bank // 100
     prize = bank - commission
 
+    # ленивый кэш: игроки и админ должны быть в памяти до выплат
+    await load_users((c, o, MAIN_ADMIN_ID))
+
+    # выплаты — пока только в кэше, в БД их запишет settle_game
     if cr > orr:
         winner = "creator"
-        change_balance(c, prize)
+        apply_balance_delta(c, prize, reason="dice_win", ref_id=gid)
     else:
         winner = "opponent"
-        change_balance(o, prize)
+        apply_balance_delta(o, prize, reason="dice_win", ref_id=gid)
 
-    change_balance(MAIN_ADMIN_ID, commission)
+    apply_balance_delta(MAIN_ADMIN_ID, commission, reason="dice_commission", ref_id=gid)
     g["winner"] = winner
 
-    # сохраняем в БД
-    await upsert_game(g)
+    # обновляем рейтинг в памяти
+    for user in (c, o):
+        record_game_result(user, calculate_profit(user, g), g["finished_at"])
+
+    # результат игры, балансы и счётчики профиля — одной транзакцией
+    await settle_game(g)
+
+    # игра записана (или ошибка напечатана, балансы допишет write-behind) —
+    # держать её в памяти больше незачем
+    remove_game(gid)
+    games_stats["evicted"] += 1
+    # снимок меняем только после расчёта: упади бот раньше — игра
+    # восстановится как прерванная и ставка вернётся создателю
+    mark_live_state_changed()
+
+    # кэш истории игроков больше не актуален
+    for user in (c, o):
+        invalidate_history(user)
 
     # отправляем результат обоим игрокам
     for user in (c, o):
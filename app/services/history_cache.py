@@ -0,0 +1,96 @@
+# app/services/history_cache.py
+
+"""
+Кэш раздела «📋 Мои игры».
+
+Храним готовый результат build_user_stats_and_history по каждой
+открытой странице пользователя. play_game сбрасывает запись обоих игроков,
+когда их игра завершается, так что листание истории не ходит в БД.
+- LRU по пользователям, не больше HISTORY_CACHE_MAX_USERS записей
+- TTL на случай, если игр нет, а «за сутки / за неделю» уже устарели
+- поколение пользователя: страница, прочитанная из БД до сброса,
+  а положенная после, в кэш не попадает
+"""
+
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from app.config import HISTORY_CACHE_MAX_USERS, HISTORY_CACHE_TTL_SECONDS
+
+# user_id -> {"created": monotonic-время, "pages": {ключ страницы -> результат}}
+_cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+
+# user_id -> поколение: растёт при каждом сбросе (значения — из общего счётчика).
+# Храним не больше HISTORY_CACHE_MAX_USERS последних сбросов; вытесненным
+# отдаём _generation_floor — он не меньше любого их значения, так что
+# сброс, случившийся во время чтения из БД, не потеряется
+_generations: "OrderedDict[int, int]" = OrderedDict()
+_generation_counter = 0
+_generation_floor = 0
+
+history_cache_stats: Dict[str, int] = {
+    "hits": 0,
+    "misses": 0,
+    "evictions": 0,
+    "invalidations": 0,
+    "stale": 0,
+}
+
+
+def get_cached_history(uid: int, key: Hashable) -> Optional[Any]:
+    """Результат для страницы key или None, если его нет в кэше."""
+    entry = _cache.get(uid)
+    if entry is not None and time.monotonic() - entry["created"] > HISTORY_CACHE_TTL_SECONDS:
+        del _cache[uid]
+        entry = None
+
+    if entry is None or key not in entry["pages"]:
+        history_cache_stats["misses"] += 1
+        return None
+
+    _cache.move_to_end(uid)
+    history_cache_stats["hits"] += 1
+    return entry["pages"][key]
+
+
+def history_generation(uid: int) -> int:
+    """Поколение кэша пользователя — читать до похода в БД."""
+    return _generations.get(uid, _generation_floor)
+
+
+def put_cached_history(uid: int, key: Hashable, value: Any, generation: int) -> None:
+    """generation — history_generation(uid) до чтения из БД."""
+    if generation != history_generation(uid):
+        # пока читали, игра завершилась — результат уже устарел
+        history_cache_stats["stale"] += 1
+        return
+
+    entry = _cache.get(uid)
+    if entry is None:
+        entry = {"created": time.monotonic(), "pages": {}}
+        _cache[uid] = entry
+    entry["pages"][key] = value
+    _cache.move_to_end(uid)
+
+    while len(_cache) > HISTORY_CACHE_MAX_USERS:
+        _cache.popitem(last=False)
+        history_cache_stats["evictions"] += 1
+
+
+def invalidate_history(uid: int) -> None:
+    """Сбросить кэш пользователя (его игра только что завершилась)."""
+    global _generation_counter, _generation_floor
+    _generation_counter += 1
+    _generations[uid] = _generation_counter
+    _generations.move_to_end(uid)
+    while len(_generations) > HISTORY_CACHE_MAX_USERS:
+        _, generation = _generations.popitem(last=False)
+        _generation_floor = max(_generation_floor, generation)
+
+    if _cache.pop(uid, None) is not None:
+        history_cache_stats["invalidations"] += 1
+
+
+def history_cache_size() -> int:
+    return len(_cache)
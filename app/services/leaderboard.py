@@ -0,0 +1,139 @@
+# app/services/leaderboard.py
+
+"""
+Инкрементальный рейтинг костей за скользящее окно RATING_WINDOW_DAYS.
+
+play_game сообщает результат каждой завершённой игры, профит и количество
+игр копятся по дням (UTC). Дни, вышедшие из окна, вычитаются из итогов.
+Игроки лежат в SortedList по ключу (-profit, games, user_id) — тот же
+порядок, что и в SQL-рейтинге, поэтому место игрока — это O(log n) поиск
+без обращения к БД. При старте рейтинг заполняется одним потоковым запросом.
+"""
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from sortedcontainers import SortedList
+
+from app.config import RATING_WINDOW_DAYS
+from app.db.games import iter_finished_games_since
+
+# user_id -> {день (ordinal) -> [profit, games]}
+_buckets: Dict[int, Dict[int, List[int]]] = {}
+# user_id -> [profit, games] за всё окно
+_totals: Dict[int, List[int]] = {}
+# день -> user_id, у которых есть корзина за этот день
+_day_users: Dict[int, Set[int]] = {}
+# упорядоченный рейтинг: (-profit, games, user_id)
+_ranking: SortedList = SortedList()
+
+_ready: bool = False
+
+
+def _day_of(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).date().toordinal()
+
+
+def _key(uid: int) -> Tuple[int, int, int]:
+    profit, games_count = _totals[uid]
+    return (-profit, games_count, uid)
+
+
+def _expire(now: datetime) -> None:
+    """Вычесть из итогов дни, вышедшие за окно."""
+    first_day = _day_of(now) - RATING_WINDOW_DAYS + 1
+
+    for day in sorted(d for d in _day_users if d < first_day):
+        for uid in _day_users.pop(day):
+            profit, games_count = _buckets[uid].pop(day)
+            if not _buckets[uid]:
+                del _buckets[uid]
+
+            _ranking.remove(_key(uid))
+            total = _totals[uid]
+            total[0] -= profit
+            total[1] -= games_count
+            if total[1] <= 0:
+                del _totals[uid]
+            else:
+                _ranking.add(_key(uid))
+
+
+def record_game_result(uid: int, profit: int, finished_at: datetime) -> None:
+    """Учесть одну завершённую игру пользователя (вызывается из play_game)."""
+    now = datetime.now(timezone.utc)
+    _expire(now)
+
+    day = _day_of(finished_at)
+    if day < _day_of(now) - RATING_WINDOW_DAYS + 1:
+        return
+
+    if uid in _totals:
+        _ranking.remove(_key(uid))
+    else:
+        _totals[uid] = [0, 0]
+
+    bucket = _buckets.setdefault(uid, {}).setdefault(day, [0, 0])
+    bucket[0] += profit
+    bucket[1] += 1
+    _day_users.setdefault(day, set()).add(uid)
+
+    total = _totals[uid]
+    total[0] += profit
+    total[1] += 1
+    _ranking.add(_key(uid))
+
+
+def get_leaderboard_rating(
+    requesting_uid: int,
+    top_n: int = 3,
+) -> Tuple[List[Dict[str, Any]], Optional[Dict[str, Any]], int]:
+    """
+    То же, что get_dice_rating_30_days(), но из памяти:
+    (топ-N строк, строка запрашивающего или None, всего игроков).
+    """
+    _expire(datetime.now(timezone.utc))
+
+    top = [
+        {"user_id": uid, "profit": -neg_profit, "games": games_count, "place": i + 1}
+        for i, (neg_profit, games_count, uid) in enumerate(_ranking[:top_n])
+    ]
+
+    me = None
+    if requesting_uid in _totals:
+        key = _key(requesting_uid)
+        me = {
+            "user_id": requesting_uid,
+            "profit": -key[0],
+            "games": key[1],
+            "place": _ranking.index(key) + 1,
+        }
+
+    return top, me, len(_ranking)
+
+
+def is_leaderboard_ready() -> bool:
+    return _ready
+
+
+async def seed_leaderboard() -> None:
+    """Заполнить рейтинг завершёнными играми за окно (при старте бота)."""
+    global _ready
+
+    _buckets.clear()
+    _totals.clear()
+    _day_users.clear()
+    _ranking.clear()
+
+    since = datetime.now(timezone.utc) - timedelta(days=RATING_WINDOW_DAYS)
+    async for g in iter_finished_games_since(since):
+        for uid, profit in (
+            (g["creator_id"], g["creator_profit"]),
+            (g["opponent_id"], -g["creator_profit"]),
+        ):
+            if uid is not None:
+                record_game_result(uid, profit, g["finished_at"])
+
+    _ready = True
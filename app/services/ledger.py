@@ -0,0 +1,148 @@
+# app/services/ledger.py
+
+"""
+Журнал изменений балансов (append-only таблица ledger).
+
+Каждое изменение баланса в кэше добавляет запись (user_id, delta, reason, ref_id, ts)
+в буфер. Фоновая задача дописывает буфер в БД пачкой через COPY,
+а раз в LEDGER_SNAPSHOT_INTERVAL_SECONDS делает снимок балансов —
+чтобы сверка читала «последний снимок + хвост журнала», а не всю историю.
+Журнал разбит на месячные партиции: старые можно отсоединить
+(DETACH PARTITION), когда они целиком попали в снимок.
+"""
+
+import asyncio
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
+
+from app.config import (
+    LEDGER_FLUSH_INTERVAL_SECONDS,
+    LEDGER_MAX_PENDING,
+    LEDGER_SNAPSHOT_INTERVAL_SECONDS,
+)
+from app.db.ledger import (
+    LedgerRow,
+    append_ledger_entries,
+    create_balance_snapshot,
+    ensure_ledger_partitions,
+    find_balance_mismatches,
+)
+from app.services.tasks import spawn
+
+# записи, ещё не дошедшие до БД
+_pending: List[LedgerRow] = []
+# месяцы, для которых партиция точно создана
+_known_months: Set[date] = set()
+
+_wakeup = asyncio.Event()
+_flush_lock = asyncio.Lock()
+_ledger_task: asyncio.Task | None = None
+_stopping: bool = False
+
+ledger_stats: Dict[str, int] = {"entries": 0, "flushes": 0, "errors": 0, "snapshots": 0}
+
+
+def _month_of(ts: datetime) -> date:
+    return ts.astimezone(timezone.utc).date().replace(day=1)
+
+
+def record_ledger(uid: int, delta: int, reason: str, ref_id: Optional[int] = None) -> None:
+    """Добавить запись в журнал (в БД уйдёт пачкой при ближайшем сбросе)."""
+    if delta == 0:
+        return
+    _pending.append((uid, delta, reason, ref_id, datetime.now(timezone.utc)))
+    if len(_pending) >= LEDGER_MAX_PENDING:
+        _wakeup.set()
+
+
+async def flush_ledger() -> int:
+    """Дописать буфер журнала одной пачкой. Возвращает число записей."""
+    async with _flush_lock:
+        if not _pending:
+            return 0
+
+        rows = _pending[:]
+        del _pending[:]
+        months = {_month_of(row[4]) for row in rows} - _known_months
+
+        try:
+            await append_ledger_entries(rows, months=sorted(months))
+        except Exception as e:
+            ledger_stats["errors"] += 1
+            print("Ошибка записи журнала балансов:", e)
+            # возвращаем записи в начало буфера, порядок сохраняется
+            _pending[:0] = rows
+            return 0
+
+        _known_months.update(months)
+        ledger_stats["flushes"] += 1
+        ledger_stats["entries"] += len(rows)
+        return len(rows)
+
+
+async def take_balance_snapshot() -> None:
+    """
+    Снимок балансов. Делаем под тем же замком, что и сброс журнала:
+    в момент снимка в БД нет недописанных пачек с меньшими id.
+    """
+    async with _flush_lock:
+        try:
+            # заодно заранее создаём партицию следующего месяца
+            this_month = _month_of(datetime.now(timezone.utc))
+            next_month = (this_month + timedelta(days=32)).replace(day=1)
+            await ensure_ledger_partitions([this_month, next_month])
+            _known_months.update((this_month, next_month))
+
+            await create_balance_snapshot()
+            ledger_stats["snapshots"] += 1
+        except Exception as e:
+            ledger_stats["errors"] += 1
+            print("Ошибка снимка балансов:", e)
+
+
+async def reconcile_ledger() -> None:
+    """Сверить users.balance с журналом (последний снимок + хвост) и сообщить о расхождениях."""
+    total, sample = await find_balance_mismatches()
+    if not total:
+        print("📒 Журнал балансов сходится с users.balance")
+        return
+    print(f"⚠️ Расхождения журнала и users.balance: {total}")
+    for row in sample:
+        print(f"   user {row['user_id']}: users={row['cached']} ledger={row['ledger']}")
+
+
+async def _ledger_loop():
+    last_snapshot = time.monotonic()
+    while not _stopping:
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=LEDGER_FLUSH_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        _wakeup.clear()
+        if _pending:
+            spawn("flush_ledger", flush_ledger, key="flush_ledger")
+
+        if time.monotonic() - last_snapshot >= LEDGER_SNAPSHOT_INTERVAL_SECONDS:
+            spawn("balance_snapshot", take_balance_snapshot, key="balance_snapshot")
+            last_snapshot = time.monotonic()
+
+
+def start_ledger() -> None:
+    """Запустить фоновую запись журнала и снимков (после init_db)."""
+    global _ledger_task, _stopping
+    if _ledger_task and not _ledger_task.done():
+        return
+    _stopping = False
+    _ledger_task = asyncio.create_task(_ledger_loop())
+
+
+async def stop_ledger() -> None:
+    """Остановить фоновую задачу и дописать остаток буфера."""
+    global _ledger_task, _stopping
+    _stopping = True
+    _wakeup.set()
+    if _ledger_task:
+        await _ledger_task
+        _ledger_task = None
+    await flush_ledger()
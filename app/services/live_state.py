@@ -0,0 +1,386 @@
+# app/services/live_state.py
+
+"""
+Снимок живого состояния: открытые игры в кости (games) и комнаты
+Банкира (raffle_rooms). Ставки по ним списаны только в кэше — в users они
+попадут транзакцией расчёта игры / итога раунда (apply_balance_delta), —
+так что БД никогда не видит ставку без её игры. До расчёта эти изменения
+хранит снимок (поле "changes"), при перезапуске они применяются заново.
+
+- mark_live_state_changed() вызывается после каждого изменения; запись идёт
+  фоновой задачей (spawn с одним key), так что серия изменений подряд
+  склеивается в одну запись
+- файл пишется целиком во временный, fsync и os.replace — на диске всегда
+  либо старый, либо новый снимок, недописанного не бывает
+- сорвавшаяся запись повторяется с растущей паузой; call_after_saved()
+  откладывает действие (объявление итога Банкира) до снимка, в котором
+  уже есть все изменения на момент вызова
+- restore_live_state() при старте читает снимок и сверяет его с БД:
+  * счётчик id игр — не меньше максимума из БД; id комнат Банкира выдаёт
+    последовательность в БД, её сдвигаем выше id восстановленных комнат
+  * игры, которые БД считает завершёнными, отбрасываются (их изменения
+    балансов записаны расчётом)
+  * открытые игры и комнаты Банкира восстанавливаются вместе со своими
+    незакреплёнными изменениями; таймеры комнат — от draw_at
+  * игра, прерванная после вступления соперника: ни одна ставка в БД
+    не попала, изменения не применяем — это и есть возврат, оба игрока
+    получают сообщение
+  * комнаты, чей итог уже есть в raffle_rounds, отбрасываются; итоги,
+    не успевшие попасть в БД, снова ставятся на запись
+  * снимки версии 1 (без "changes"): ставки там уже в БД, создателю
+    прерванной игры ставка возвращается
+"""
+
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from app.config import (
+    LIVE_STATE_PATH,
+    LIVE_STATE_RETRY_MAX_SECONDS,
+    LIVE_STATE_RETRY_SECONDS,
+    MAIN_ADMIN_ID,
+)
+from app.services.balances import (
+    apply_balance_delta,
+    change_balance,
+    load_users,
+    unsettled_changes,
+)
+from app.services.tasks import spawn
+from app.utils.fenwick import WeightedPicker
+
+_SNAPSHOT_VERSION = 2
+
+# одновременно пишет одна задача (временный файл общий)
+_save_lock = asyncio.Lock()
+
+live_state_stats: Dict[str, int] = {"saves": 0, "errors": 0, "retries": 0}
+
+# номер последнего изменения и до какого номера включительно снимок записан
+_changes = 0
+_saved_changes = 0
+# ждут снимка: (номер изменения, колбэк)
+_after_saved: List[Tuple[int, Callable[[], None]]] = []
+# пауза перед повтором сорвавшейся записи (0 — последняя запись удалась)
+_retry_delay: float = 0
+_retry_pending = False
+
+
+def _dt(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _parse_dt(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value is not None else None
+
+
+# =====================================================
+#                    СЕРИАЛИЗАЦИЯ
+# =====================================================
+
+def _dump_game(g: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": g["id"],
+        "creator_id": g["creator_id"],
+        "opponent_id": g.get("opponent_id"),
+        "bet": g["bet"],
+        "created_at": _dt(g.get("created_at")),
+        # ставки, которые в БД запишет только расчёт
+        "changes": unsettled_changes(g["id"]),
+    }
+
+
+def _load_game(d: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": d["id"],
+        "creator_id": d["creator_id"],
+        "opponent_id": d.get("opponent_id"),
+        "bet": d["bet"],
+        "creator_roll": None,
+        "opponent_roll": None,
+        "winner": None,
+        "finished": False,
+        "created_at": _parse_dt(d.get("created_at")) or datetime.now(timezone.utc),
+        "finished_at": None,
+    }
+
+
+def _dump_raffle_round(r: Dict[str, Any], changes: List[Tuple[int, int, str]]) -> Dict[str, Any]:
+    # ключи-int в JSON стали бы строками — храним пары
+    return {
+        "id": r["id"],
+        "created_at": _dt(r["created_at"]),
+        "entry_amount": r["entry_amount"],
+        "total_bank": r["total_bank"],
+        "user_bets": list(r["user_bets"].items()),
+        "user_last_bet_at": [(uid, _dt(ts)) for uid, ts in r["user_last_bet_at"].items()],
+        # ставки, ещё не записанные в raffle_bets, — снимок их журнал
+        "pending_bets": list(r["pending_bets"].items()),
+        "draw_at": _dt(r.get("draw_at")),
+        # ставки и возвраты, которые в users запишет итог раунда
+        "changes": changes,
+    }
+
+
+def _load_raffle_round(d: Dict[str, Any]) -> Dict[str, Any]:
+    user_bets = {uid: shares for uid, shares in d["user_bets"]}
+    # веса розыгрыша — те же доли
+    picker = WeightedPicker()
+    for uid, shares in user_bets.items():
+        picker.set(uid, shares)
+    return {
+        "id": d["id"],
+        "created_at": _parse_dt(d["created_at"]),
+        "finished_at": None,
+        "entry_amount": d["entry_amount"],
+        "total_bank": d["total_bank"],
+        "picker": picker,
+        "participants": set(user_bets),
+        "user_bets": user_bets,
+        "user_last_bet_at": {uid: _parse_dt(ts) for uid, ts in d["user_last_bet_at"]},
+        # в старых снимках поля нет — тогда ставки уже записаны в БД
+        "pending_bets": {uid: list(amounts) for uid, amounts in d.get("pending_bets", [])},
+        "winner_id": None,
+        "finished": False,
+        "draw_at": _parse_dt(d.get("draw_at")),
+        "version": 0,
+    }
+
+
+def _dump_raffle_result(res: Dict[str, Any], changes: List[Tuple[int, int, str]]) -> Dict[str, Any]:
+    return {
+        **res,
+        "created_at": _dt(res["created_at"]),
+        "finished_at": _dt(res["finished_at"]),
+        # ставки и выплаты раунда, ещё не записанные в users
+        "changes": changes,
+    }
+
+
+def _load_raffle_result(d: Dict[str, Any]) -> Dict[str, Any]:
+    res = {
+        **d,
+        "created_at": _parse_dt(d["created_at"]),
+        "finished_at": _parse_dt(d["finished_at"]),
+        "bets": [(uid, amount) for uid, amount in d["bets"]],
+    }
+    res.pop("changes", None)
+    return res
+
+
+def _build_snapshot() -> Dict[str, Any]:
+    # импорт внутри — games / raffle сами импортируют этот модуль
+    import app.services.games as games_mod
+    import app.services.raffle as raffle_mod
+
+    return {
+        "version": _SNAPSHOT_VERSION,
+        "saved_at": _dt(datetime.now(timezone.utc)),
+        "next_game_id": games_mod.next_game_id,
+        # в games и доигранные, но ещё не рассчитанные — они нужны при восстановлении
+        "games": [_dump_game(g) for g in games_mod.games.values()],
+        # в raffle_rooms и комнаты, которые сейчас разыгрываются: выплат по ним
+        # ещё не было (они делаются вместе с _close_room), разыграем заново
+        "raffle_rooms": [
+            _dump_raffle_round(r, unsettled_changes(raffle_mod.balance_key(rid)))
+            for rid, r in raffle_mod.raffle_rooms.items()
+        ],
+        # итоги разыгранных комнат, которые ещё не записаны в БД
+        "raffle_results": [
+            _dump_raffle_result(res, unsettled_changes(raffle_mod.balance_key(rid)))
+            for rid, res in raffle_mod.unsaved_rounds.items()
+        ],
+    }
+
+
+def _write_file(path: str, payload: str) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_file(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Снимок живых игр {path} не прочитан:", e)
+        return None
+
+
+# =====================================================
+#                       ЗАПИСЬ
+# =====================================================
+
+async def save_live_state() -> None:
+    """Записать снимок сейчас."""
+    global _saved_changes, _retry_delay, _after_saved
+    async with _save_lock:
+        # состояние сериализуем синхронно — это согласованный срез
+        covered = _changes
+        payload = json.dumps(_build_snapshot(), ensure_ascii=False, separators=(",", ":"))
+        try:
+            await asyncio.to_thread(_write_file, LIVE_STATE_PATH, payload)
+        except OSError as e:
+            live_state_stats["errors"] += 1
+            print("Ошибка записи снимка живых игр:", e)
+            _schedule_retry()
+            return
+        live_state_stats["saves"] += 1
+        _retry_delay = 0
+        _saved_changes = max(_saved_changes, covered)
+
+    ready = [cb for n, cb in _after_saved if n <= _saved_changes]
+    _after_saved = [(n, cb) for n, cb in _after_saved if n > _saved_changes]
+    for cb in ready:
+        cb()
+
+
+def _spawn_save() -> None:
+    if not spawn("save_live_state", save_live_state, key="live_state"):
+        _schedule_retry()
+
+
+def _schedule_retry() -> None:
+    """Повторить запись через растущую паузу (без новых изменений снимок сам не перепишется)."""
+    global _retry_delay, _retry_pending
+    if _retry_pending:
+        return
+    _retry_pending = True
+    # подряд сорвавшиеся записи — пауза вдвое больше, до предела
+    if _retry_delay:
+        _retry_delay = min(_retry_delay * 2, LIVE_STATE_RETRY_MAX_SECONDS)
+    else:
+        _retry_delay = LIVE_STATE_RETRY_SECONDS
+    asyncio.get_running_loop().call_later(_retry_delay, _retry_save)
+
+
+def _retry_save() -> None:
+    global _retry_pending
+    _retry_pending = False
+    live_state_stats["retries"] += 1
+    _spawn_save()
+
+
+def mark_live_state_changed() -> None:
+    """Игры или раунд Банкира изменились — записать снимок в фоне."""
+    global _changes
+    _changes += 1
+    _spawn_save()
+
+
+def call_after_saved(callback: Callable[[], None]) -> None:
+    """Вызвать callback, когда на диске будет снимок со всеми изменениями на этот момент."""
+    if _saved_changes >= _changes:
+        callback()
+        return
+    _after_saved.append((_changes, callback))
+
+
+# =====================================================
+#                  ВОССТАНОВЛЕНИЕ
+# =====================================================
+
+async def _notify(uid: int, text: str) -> None:
+    from app.bot import bot
+
+    try:
+        await bot.send_message(uid, text)
+    except Exception:
+        pass
+
+
+async def restore_live_state() -> None:
+    """Поднять игры и раунд Банкира из снимка и сверить с БД (при старте бота)."""
+    import app.services.games as games_mod
+    import app.services.raffle as raffle_mod
+    from app.db.games import get_finished_game_ids, get_max_game_id
+    from app.db.raffle import get_saved_raffle_ids
+    from app.services.balance_writer import flush_dirty_users
+    from app.utils.formatters import format_rubles
+
+    started = time.perf_counter()
+    snap = await asyncio.to_thread(_read_file, LIVE_STATE_PATH) or {}
+
+    # id не должны повторять уже записанные в БД
+    games_mod.next_game_id = max(snap.get("next_game_id", 1), await get_max_game_id() + 1)
+
+    saved_games = snap.get("games", [])
+    finished = set(await get_finished_game_ids([d["id"] for d in saved_games]))
+    saved_games = [d for d in saved_games if d["id"] not in finished]  # расчёт успел записаться
+
+    # до комнат в снимке был один раунд "raffle_round"
+    saved_rooms = snap.get("raffle_rooms")
+    if saved_rooms is None:
+        saved_rooms = [snap["raffle_round"]] if snap.get("raffle_round") else []
+    # пустой раунд — восстанавливать нечего
+    saved_rooms = [d for d in saved_rooms if d.get("entry_amount") and d.get("user_bets")]
+    saved_results = snap.get("raffle_results", [])
+    # итог раунда пишется раньше, чем снимок успевает забыть комнату:
+    # записанную комнату не разыгрываем второй раз
+    drawn = set(await get_saved_raffle_ids([d["id"] for d in saved_rooms + saved_results]))
+    saved_rooms = [d for d in saved_rooms if d["id"] not in drawn]
+    saved_results = [d for d in saved_results if d["id"] not in drawn]
+
+    open_games = [d for d in saved_games if d.get("opponent_id") is None]
+    interrupted = [d for d in saved_games if d.get("opponent_id") is not None]
+    # в снимках версии 1 ставка создателя уже в БД — её надо вернуть
+    refund_creators = [d for d in interrupted if "changes" not in d]
+
+    # незакреплённые изменения живых игр и комнат — заново в кэш
+    revived = [(d["id"], None, d.get("changes", [])) for d in open_games]
+    revived += [
+        (d["id"], raffle_mod.balance_key(d["id"]), d.get("changes", []))
+        for d in saved_rooms + saved_results
+    ]
+    await load_users(
+        [uid for _, _, changes in revived for uid, _, _ in changes]
+        + [d["creator_id"] for d in refund_creators]
+        + [MAIN_ADMIN_ID]
+    )
+    for ref_id, key, changes in revived:
+        for uid, delta, reason in changes:
+            apply_balance_delta(uid, delta, reason, ref_id, key)
+
+    for d in open_games:
+        games_mod.add_game(_load_game(d))
+
+    if refund_creators:
+        for d in refund_creators:
+            change_balance(d["creator_id"], d["bet"], reason="dice_refund", ref_id=d["id"])
+        # возврат — в БД до того, как снимок забудет эти игры
+        await flush_dirty_users()
+    for d in interrupted:
+        text = (
+            f"⚠ Игра №{d['id']} прервана перезапуском бота.\n"
+            f"Ставка {format_rubles(d['bet'])} ₽ возвращена на баланс."
+        )
+        await _notify(d["creator_id"], text)
+        await _notify(d["opponent_id"], text)
+
+    for d in saved_rooms:
+        raffle_mod.restore_room(_load_raffle_round(d))
+    # выплаты по этим итогам уже в кэше — дописываем итог, ставки и балансы
+    for d in saved_results:
+        raffle_mod.queue_round_save(_load_raffle_result(d))
+    # id комнат выдаёт последовательность в БД — она должна быть выше восстановленных
+    await raffle_mod.start_raffle_ids(
+        max([*raffle_mod.raffle_rooms, *raffle_mod.unsaved_rounds], default=0)
+    )
+
+    await save_live_state()
+
+    print(
+        f"✅ Живые игры восстановлены за {time.perf_counter() - started:.3f} с: "
+        f"открытых игр {len(open_games)}, прерванных {len(interrupted)}, "
+        f"комнат Банкира {len(saved_rooms)}, незаписанных итогов Банкира {len(saved_results)}"
+    )
@@ -1,8 +1,8 @@
 # app/services/raffle.py
 import asyncio
-import random
+from bisect import bisect_right
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any, Set, List
+from typing import Dict, Any, Iterable, Set, List, Optional, Tuple
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
@@ -12,118 +12,313 @@ from app.config import (
     RAFFLE_MAX_BETS_PER_ROUND,
     RAFFLE_TIMER_SECONDS,
     RAFFLE_CANCEL_WINDOW_SECONDS,
+    RAFFLE_STAKE_TIERS,
+    RAFFLE_ROOM_MAX_PARTICIPANTS,
+    RAFFLE_MAX_ROOMS_PER_TIER,
+    RAFFLE_SAVE_RETRY_SECONDS,
+    RAFFLE_DRAW_RETRY_SECONDS,
     MAIN_ADMIN_ID,
 )
-from app.db.raffle import upsert_raffle_round, add_raffle_bet, get_raffle_rounds_and_bets_30_days
-from app.services.balances import change_balance, get_balance, user_usernames
+from app.db.raffle import (
+    ensure_raffle_ids_above,
+    get_raffle_rounds_and_bets_30_days,
+    reserve_raffle_id_block,
+    upsert_raffle_round,
+)
+from app.services.balances import (
+    apply_balance_delta,
+    confirm_committed_balances,
+    get_balance,
+    load_users,
+    requeue_unsettled,
+    snapshot_users,
+    try_debit,
+    unsettled_users,
+    user_usernames,
+)
+from app.services.balance_writer import unwatch_flushes, wait_for_room, watch_flushes
+from app.services.live_state import call_after_saved, mark_live_state_changed
+from app.services.tasks import spawn
+from app.utils.fenwick import WeightedPicker
 from app.utils.formatters import format_rubles
 
 
-# Текущее состояние розыгрыша
-raffle_round: Dict[str, Any] | None = None
-raffle_task: asyncio.Task | None = None
-next_raffle_id: int = 1
+# Комнаты Банкира: id раунда -> раунд. Комнаты независимы — у каждой
+# своя ставка за долю, свой таймер и свои строки в БД. Комната живёт,
+# пока не разыграна; следующая ставка откроет новую.
+raffle_rooms: Dict[int, Dict[str, Any]] = {}
+# В какой комнате сейчас ставки пользователя (одна комната на игрока)
+_user_room: Dict[int, int] = {}
 
-# ожидание ввода суммы для Банкира (используется в handlers/text.py)
-pending_raffle_bet_input: Dict[int, bool] = {}
+# Итоги разыгранных комнат, ещё не записанные в БД: id -> итог (_round_result).
+# Пока итог здесь, его вместе с накопленными ставками хранит снимок живого
+# состояния; запись повторяется через супервизор, пока не пройдёт.
+unsaved_rounds: Dict[int, Dict[str, Any]] = {}
+raffle_save_stats: Dict[str, int] = {"saved": 0, "retries": 0}
 
+# Общая часть текста комнаты (участники, банк, доля) — одна на всех,
+# пересобирается только когда меняется версия раунда: id -> (version, текст)
+_header_cache: Dict[int, Tuple[int, str]] = {}
 
-def _ensure_raffle_round() -> Dict[str, Any]:
+
+def balance_key(rid: int) -> Tuple[str, int]:
     """
-    Гарантирует наличие текущего раунда.
-    Если раунд завершён или отсутствует — создаёт новый.
+    Ключ незакреплённых изменений раунда rid (apply_balance_delta): ставки,
+    возвраты и выплаты раунда пишутся в users одной транзакцией с его итогом.
+    Свой ключ — id раундов и игр в костях могут совпадать.
     """
-    global raffle_round, next_raffle_id
-
-    if raffle_round is None or raffle_round.get("finished"):
-        raffle_round = {
-            "id": next_raffle_id,
-            "created_at": datetime.now(timezone.utc),
-            "finished_at": None,
-
-            # фиксированная ставка за 1 «долю» (share)
-            "entry_amount": None,            # int | None
-
-            # банк и ставки
-            "total_bank": 0,                 # общая сумма в банке
-            "tickets": [],                   # список user_id, по 1 на каждую ставку
-            "participants": set(),           # set(user_id)
-            "user_bets": {},                 # user_id -> количество ставок (долей)
-            "user_last_bet_at": {},          # user_id -> datetime последней ставки
-
-            # итог
-            "winner_id": None,
-            "finished": False,
-            "draw_at": None,                 # datetime, когда должен быть розыгрыш
-        }
-        next_raffle_id += 1
+    return ("raffle", rid)
+
+
+def _refund_stake(uid: int, amount: int, rid: int, reason: str) -> None:
+    """Вернуть ставку, которая списана только в кэше."""
+    apply_balance_delta(uid, amount, reason, rid, balance_key(rid))
+    if rid not in raffle_rooms:
+        # комнаты нет (не открылась или уже закрыта) — итог раунда этого
+        # пользователя не запишет, его изменения допишет write-behind
+        requeue_unsettled(balance_key(rid), [uid])
+
+
+def stake_tier(entry_amount: int) -> int:
+    """Номер уровня ставок RAFFLE_STAKE_TIERS для ставки за долю."""
+    return max(0, bisect_right(RAFFLE_STAKE_TIERS, entry_amount) - 1)
+
+
+# =====================================================
+#                 ID РАУНДОВ (hi/lo)
+# =====================================================
+# id выдаёт последовательность raffle_rounds блоками (её шаг —
+# RAFFLE_ID_BLOCK_SIZE). Новая комната берёт id из блока в памяти без
+# запроса к БД; следующий блок подкачивается в фоне, когда текущий
+# израсходован на три четверти. Неиспользованный остаток блока при
+# перезапуске просто пропадает — дыры в id допустимы.
+_id_block: range = range(0)
+_id_pos: int = 0
+_next_id_block: Optional[range] = None
+_id_block_lock = asyncio.Lock()
+
+
+async def _fetch_id_block() -> None:
+    global _next_id_block
+    async with _id_block_lock:
+        if _next_id_block is None:
+            _next_id_block = await reserve_raffle_id_block()
+
+
+def _take_raffle_id() -> Optional[int]:
+    global _id_block, _id_pos, _next_id_block
+    if _id_pos >= len(_id_block) and _next_id_block is not None:
+        _id_block, _id_pos, _next_id_block = _next_id_block, 0, None
+    if _id_pos >= len(_id_block):
+        return None
+
+    rid = _id_block[_id_pos]
+    _id_pos += 1
+    if _next_id_block is None and _id_pos >= len(_id_block) * 3 // 4:
+        spawn("reserve_raffle_ids", _fetch_id_block, key="raffle_ids")
+    return rid
+
+
+async def _allocate_raffle_id() -> int:
+    """id новой комнаты; запрос к БД — только если блок кончился раньше подкачки."""
+    rid = _take_raffle_id()
+    while rid is None:
+        await _fetch_id_block()
+        rid = _take_raffle_id()
+    return rid
+
+
+async def start_raffle_ids(restored_max_id: int = 0) -> None:
+    """
+    При старте: последовательность — выше id восстановленных комнат,
+    первый блок id — сразу в память.
+    """
+    if restored_max_id:
+        await ensure_raffle_ids_above(restored_max_id)
+    await _fetch_id_block()
+
+
+def _open_room(rid: int, entry_amount: int) -> Dict[str, Any]:
+    """Новая комната; первая ставка задаёт ставку за долю."""
+    r = {
+        "id": rid,
+        "created_at": datetime.now(timezone.utc),
+        "finished_at": None,
+
+        # фиксированная ставка за 1 «долю» (share) и её уровень
+        "entry_amount": entry_amount,
+        "tier": stake_tier(entry_amount),
+
+        # банк и ставки
+        "total_bank": 0,                 # общая сумма в банке
+        "picker": WeightedPicker(),      # user_id -> доли, вес при розыгрыше
+        "participants": set(),           # set(user_id)
+        "user_bets": {},                 # user_id -> количество ставок (долей)
+        "user_last_bet_at": {},          # user_id -> datetime последней ставки
+        # ставки, ещё не записанные в raffle_bets: user_id -> [суммы].
+        # Пишутся одной транзакцией с итогом раунда; до этого их
+        # сохраняет снимок живого состояния
+        "pending_bets": {},
+
+        # итог
+        "winner_id": None,
+        "finished": False,
+        "draw_at": None,                 # datetime, когда должен быть розыгрыш
+        "task": None,                    # таймер розыгрыша этой комнаты
+
+        # растёт при каждом изменении — ключ кэша текста
+        "version": 0,
+    }
+    raffle_rooms[rid] = r
+    return r
+
+
+def _close_room(r: Dict[str, Any]) -> None:
+    """Комната разыграна (или опустела) — убрать её из живых."""
+    raffle_rooms.pop(r["id"], None)
+    _header_cache.pop(r["id"], None)
+    for uid in r["user_bets"]:
+        if _user_room.get(uid) == r["id"]:
+            del _user_room[uid]
+
+
+def _start_timer(r: Dict[str, Any], delay: float = RAFFLE_TIMER_SECONDS) -> None:
+    r["task"] = asyncio.create_task(raffle_draw_worker(r["id"], delay=delay))
+
+
+def restore_room(r: Dict[str, Any]) -> None:
+    """Вернуть комнату из снимка живого состояния и перезапустить её таймер от draw_at."""
+    r["tier"] = stake_tier(r["entry_amount"])
+    r["task"] = None
+    raffle_rooms[r["id"]] = r
+    for uid in r["user_bets"]:
+        _user_room[uid] = r["id"]
+    if r["draw_at"] is not None:
+        delay = (r["draw_at"] - datetime.now(timezone.utc)).total_seconds()
+        _start_timer(r, delay=max(0.0, delay))
+
+
+def user_room(uid: int) -> Optional[Dict[str, Any]]:
+    """Комната, в которой у пользователя есть ставки."""
+    rid = _user_room.get(uid)
+    return raffle_rooms.get(rid) if rid is not None else None
 
-    return raffle_round
+
+def _is_full(r: Dict[str, Any]) -> bool:
+    return len(r["participants"]) >= RAFFLE_ROOM_MAX_PARTICIPANTS
+
+
+def _find_room(amount: int) -> Optional[Dict[str, Any]]:
+    """
+    Комната для новичка со ставкой amount: того же уровня, не заполненная,
+    amount кратна ставке за долю. Сначала с точно такой ставкой,
+    затем самая людная — там розыгрыш начнётся раньше.
+    """
+    tier = stake_tier(amount)
+    best = None
+    best_key = None
+    for r in raffle_rooms.values():
+        entry = r["entry_amount"]
+        if r["tier"] != tier or r["finished"] or _is_full(r):
+            continue
+        if amount % entry or amount // entry > RAFFLE_MAX_BETS_PER_ROUND:
+            continue
+        key = (entry != amount, -len(r["participants"]), r["id"])
+        if best_key is None or key < best_key:
+            best, best_key = r, key
+    return best
+
+
+def _rooms_in_tier(tier: int) -> List[Dict[str, Any]]:
+    return [r for r in raffle_rooms.values() if r["tier"] == tier]
+
+
+def _open_rooms() -> List[Dict[str, Any]]:
+    """Комнаты, куда можно войти: по ставке за долю, затем по id."""
+    rooms = [r for r in raffle_rooms.values() if not r["finished"] and not _is_full(r)]
+    rooms.sort(key=lambda r: (r["entry_amount"], r["id"]))
+    return rooms
+
+
+def _round_changed(r: Dict[str, Any]) -> None:
+    """Ставка / отмена / таймер / итог: новая версия раунда и снимок живого состояния."""
+    r["version"] += 1
+    mark_live_state_changed()
+
+
+def _user_stake(r: Dict[str, Any], uid: int) -> Tuple[int, int, int]:
+    """(доли, сумма в ₽, шанс в %) пользователя — из агрегатов раунда, без перебора."""
+    picker: WeightedPicker = r["picker"]
+    shares = picker.get(uid)
+    amount = shares * (r["entry_amount"] or 0)
+    chance = round(shares / picker.total * 100) if picker.total and shares else 0
+    return shares, amount, chance
+
+
+def _seconds_left(r: Dict[str, Any]) -> int:
+    return max(0, int((r["draw_at"] - datetime.now(timezone.utc)).total_seconds()))
+
+
+def _round_header(r: Dict[str, Any]) -> str:
+    cached = _header_cache.get(r["id"])
+    if cached is not None and cached[0] == r["version"]:
+        return cached[1]
+
+    text = "\n".join(
+        [
+            f"🎩 Игра «Банкир» — комната №{r['id']}\n",
+            f"👥 Участников: {len(r['participants'])}",
+            f"💰 Банк: {format_rubles(r['total_bank'])} ₽",
+            f"💵 Фиксированная ставка за 1 долю: {format_rubles(r['entry_amount'])} ₽",
+        ]
+    )
+    _header_cache[r["id"]] = (r["version"], text)
+    return text
 
 
 def build_raffle_text(uid: int) -> str:
     """
     Текст состояния игры «Банкир» для пользователя uid.
-    Как на твоём примере: участники, банк, твой вклад, шанс и таймер.
+    Есть ставки — его комната: участники, банк, вклад, шанс и таймер.
+    Нет — правила и список открытых комнат.
     """
-    r = raffle_round
+    r = user_room(uid)
 
-    if not r or r.get("finished") or not r.get("tickets"):
-        return (
-            "🏁 Розыгрыш начнётся когда будет как минимум два участника.\n\n"
-            "🧑‍🦳 Станьте первым, кто сделает ставку.\n\n"
+    if not r:
+        text = (
+            "🏁 Розыгрыш начнётся когда в комнате будет как минимум два участника.\n\n"
+            "🧑‍🦳 Войдите в открытую комнату или сделайте ставку — "
+            "если подходящей комнаты нет, откроется новая.\n\n"
             f"Минимальная первая ставка: {RAFFLE_MIN_BET} ₽.\n"
             f"Можно сделать до {RAFFLE_MAX_BETS_PER_ROUND} ставок за раунд.\n\n"
             "Чем больше вы положили в банк, тем выше шанс на победу.\n"
             "После появления 2 участников запускается таймер на 60 секунд.\n"
             "По его истечении случайный участник забирает весь банк (минус 1% комиссии)."
         )
-
-    entry_amount: int = r["entry_amount"]
-    total_bank: int = r["total_bank"]
-    participants: Set[int] = r["participants"]
-    user_bets: Dict[int, int] = r["user_bets"]
-
-    user_shares = user_bets.get(uid, 0)
-    user_amount = user_shares * entry_amount
-
-    # шансы в процентах
-    if total_bank > 0 and user_amount > 0:
-        user_chance = round((user_amount / total_bank) * 100)
-    else:
-        user_chance = 0
-
-    # шанс победителя ≈ максимальная доля
-    if total_bank > 0 and participants:
-        biggest_uid = max(
-            participants,
-            key=lambda u: user_bets.get(u, 0) * entry_amount,
-        )
-        biggest_amount = user_bets.get(biggest_uid, 0) * entry_amount
-        winner_chance = round((biggest_amount / total_bank) * 100)
-    else:
-        winner_chance = 0
-
+        rooms = _open_rooms()
+        if rooms:
+            lines = ["", "", "🚪 Открытые комнаты:"]
+            for room in rooms[:10]:
+                lines.append(
+                    f"• №{room['id']}: {format_rubles(room['entry_amount'])} ₽ за долю, "
+                    f"участников {len(room['participants'])}, "
+                    f"банк {format_rubles(room['total_bank'])} ₽"
+                )
+            text += "\n".join(lines)
+        return text
+
+    user_shares, user_amount, user_chance = _user_stake(r, uid)
+
+    # таймер зависит от текущего времени — его не кэшируем
     timer_line = ""
-    draw_at = r.get("draw_at")
-    if draw_at:
-        seconds_left = int((draw_at - datetime.now(timezone.utc)).total_seconds())
-        if seconds_left < 0:
-            seconds_left = 0
-        timer_line = f"\n⏳ До окончания раунда: {seconds_left} сек."
+    if r.get("draw_at"):
+        timer_line = f"\n⏳ До окончания раунда: {_seconds_left(r)} сек."
     else:
-        need = max(0, 2 - len(participants))
+        need = max(0, 2 - len(r["participants"]))
         if need > 0:
             timer_line = f"\nОжидаем ещё {need} участника(ов) для запуска таймера."
 
-    text_lines = [
-        "🎩 Игра «Банкир» — текущий раунд\n",
-        f"👥 Участников: {len(participants)}",
-        f"💰 Банк: {format_rubles(total_bank)} ₽",
-        f"💵 Фиксированная ставка за 1 долю: {format_rubles(entry_amount)} ₽",
-        timer_line,
-        "",
-    ]
+    text_lines = [_round_header(r), timer_line, ""]
 
     if user_shares > 0:
         text_lines += [
@@ -142,14 +337,14 @@ def build_raffle_menu_keyboard(uid: int) -> InlineKeyboardMarkup:
     - Сделать ставку
     - Обновить
     - Игры / Помощь
-    + динамические быстрые суммы, если уже известна entry_amount
+    + быстрые суммы: в своей комнате — 1/3/7 долей,
+      без комнаты — вход в открытые комнаты на 1 долю
     """
-    r = raffle_round
+    r = user_room(uid)
 
     rows: List[List[InlineKeyboardButton]] = []
 
-    # Быстрые суммы, если уже есть фиксированная ставка
-    if r and not r.get("finished") and r.get("entry_amount"):
+    if r:
         entry_amount: int = r["entry_amount"]
         # 1, 3, 7 долей — как 25 / 75 / 175 RUB на твоём скрине
         quick_amounts = [
@@ -160,11 +355,24 @@ def build_raffle_menu_keyboard(uid: int) -> InlineKeyboardMarkup:
         quick_buttons = [
             InlineKeyboardButton(
                 text=f"{format_rubles(a)} ₽",
-                callback_data=f"raffle_quick:{a}",
+                callback_data=f"raffle_quick:{a}:{r['id']}",
             )
             for a in quick_amounts
         ]
         rows.append(quick_buttons)
+    else:
+        # самые людные открытые комнаты — там розыгрыш начнётся раньше
+        rooms = sorted(_open_rooms(), key=lambda x: -len(x["participants"]))[:3]
+        if rooms:
+            rows.append(
+                [
+                    InlineKeyboardButton(
+                        text=f"№{x['id']}: {format_rubles(x['entry_amount'])} ₽",
+                        callback_data=f"raffle_quick:{x['entry_amount']}:{x['id']}",
+                    )
+                    for x in rooms
+                ]
+            )
 
     # Кнопка «Сделать ставку»
     rows.append(
@@ -205,15 +413,18 @@ async def send_raffle_menu(chat_id: int, uid: int):
     )
 
 
-async def _process_raffle_bet(uid: int, chat_id: int, amount: int) -> str:
+async def _process_raffle_bet(
+    uid: int, chat_id: int, amount: int, room_id: Optional[int] = None
+) -> str:
     """
     Обработка ставки пользователя:
-    - первая ставка задаёт entry_amount
-    - далее сумма должна быть кратна entry_amount
+    - есть ставки в комнате — ставка идёт туда же
+    - иначе в комнату room_id (кнопка) или в подходящую открытую
+      того же уровня ставок; нет такой — открывается новая,
+      и её первая ставка задаёт entry_amount
+    - сумма должна быть кратна entry_amount комнаты
     - максимум RAFFLE_MAX_BETS_PER_ROUND долей на игрока
     """
-    global raffle_task
-
     if amount < RAFFLE_MIN_BET:
         return f"Минимальная сумма первой ставки: {format_rubles(RAFFLE_MIN_BET)} ₽."
 
@@ -225,13 +436,26 @@ async def _process_raffle_bet(uid: int, chat_id: int, amount: int) -> str:
             f"ставка: {format_rubles(amount)} ₽."
         )
 
-    r = _ensure_raffle_round()
-
-    if r["entry_amount"] is None:
-        # первая ставка в раунде задаёт entry_amount и ровно 1 долю
+    r = user_room(uid)
+    if r is None and room_id is not None:
+        r = raffle_rooms.get(room_id)
+        if r is None or r["finished"]:
+            return "Эта комната уже разыграна. Выберите другую или сделайте ставку."
+        if _is_full(r):
+            return "Эта комната заполнена. Выберите другую или сделайте ставку."
+    if r is None:
+        r = _find_room(amount)
+
+    if r is None:
+        # новая комната: первая ставка задаёт entry_amount и ровно 1 долю
+        # (комнату открываем только после успешного списания)
+        if len(_rooms_in_tier(stake_tier(amount))) >= RAFFLE_MAX_ROOMS_PER_TIER:
+            return (
+                "Все комнаты с такими ставками заняты. "
+                "Войдите в одну из открытых комнат — они есть в меню Банкира."
+            )
         entry_amount = amount
         shares_to_add = 1
-        r["entry_amount"] = entry_amount
     else:
         entry_amount: int = r["entry_amount"]
         if amount % entry_amount != 0:
@@ -245,121 +469,251 @@ async def _process_raffle_bet(uid: int, chat_id: int, amount: int) -> str:
             return "Сумма слишком мала."
 
     # проверка лимита долей на игрока
-    current_shares = r["user_bets"].get(uid, 0)
+    current_shares = r["user_bets"].get(uid, 0) if r else 0
     if current_shares + shares_to_add > RAFFLE_MAX_BETS_PER_ROUND:
         return (
             f"Нельзя сделать более {RAFFLE_MAX_BETS_PER_ROUND} ставок в одном раунде.\n"
             f"Сейчас у вас уже {current_shares}."
         )
 
-    # списываем деньги
-    change_balance(uid, -amount)
+    # списываем деньги: проверка баланса и списание атомарно, под замком пользователя
+    rid = r["id"] if r else await _allocate_raffle_id()
+    # в БД ставка попадёт вместе с итогом раунда, до него её хранит снимок
+    if not await try_debit(
+        uid, amount, reason="raffle_bet", ref_id=rid, settle_later=True, key=balance_key(rid)
+    ):
+        return f"Недостаточно средств. Ваш баланс: {format_rubles(get_balance(uid))} ₽."
+
+    if r is None:
+        # пока ждали id и замок, игрок мог уже открыть или занять другую
+        # комнату (вторая ставка подряд), а уровень — заполниться комнатами
+        if uid in _user_room or (
+            len(_rooms_in_tier(stake_tier(amount))) >= RAFFLE_MAX_ROOMS_PER_TIER
+        ):
+            _refund_stake(uid, amount, rid, reason="raffle_cancel")
+            return "Раунд изменился, пока принималась ставка. Деньги возвращены, попробуйте ещё раз."
+        r = _open_room(rid, entry_amount)
+    # пока ждали замок, комнату могли разыграть или заполнить,
+    # а сам игрок — поставить в другую комнату
+    elif (
+        r["id"] not in raffle_rooms
+        or r["finished"]
+        or r["user_bets"].get(uid, 0) != current_shares
+        or _user_room.get(uid, r["id"]) != r["id"]
+        or (current_shares == 0 and _is_full(r))
+    ):
+        _refund_stake(uid, amount, r["id"], reason="raffle_cancel")
+        return "Раунд изменился, пока принималась ставка. Деньги возвращены, попробуйте ещё раз."
 
     # обновляем состояние раунда
     r["total_bank"] += amount
     r["participants"].add(uid)
     r["user_bets"][uid] = current_shares + shares_to_add
     r["user_last_bet_at"][uid] = datetime.now(timezone.utc)
+    _user_room[uid] = r["id"]
 
-    # добавляем «билеты» в список
-    for _ in range(shares_to_add):
-        r["tickets"].append(uid)
+    # вес участника при розыгрыше = число его долей
+    r["picker"].add(uid, shares_to_add)
 
-    # пишем в БД поштучные суммы (как есть)
-    await add_raffle_bet(r["id"], uid, amount)
+    # поштучные суммы (как есть) уйдут в БД вместе с итогом раунда
+    r["pending_bets"].setdefault(uid, []).append(amount)
 
-    # запускаем таймер, если это второй участник
+    # запускаем таймер комнаты, если это второй участник
     if len(r["participants"]) >= 2 and r.get("draw_at") is None:
         r["draw_at"] = datetime.now(timezone.utc) + timedelta(
             seconds=RAFFLE_TIMER_SECONDS
         )
-        raffle_task = asyncio.create_task(raffle_draw_worker(r["id"]))
+        _start_timer(r)
+
+    _round_changed(r)
 
     # текст ответа пользователю
-    entry_amount = r["entry_amount"]
-    total_bets = len(r["tickets"])
-    user_shares = r["user_bets"][uid]
-    total_bank = r["total_bank"]
-
-    # шанс пользователя
-    user_amount = user_shares * entry_amount
-    if total_bank > 0:
-        user_chance = round((user_amount / total_bank) * 100)
-    else:
-        user_chance = 0
+    user_shares, user_amount, user_chance = _user_stake(r, uid)
 
     timer_line = ""
-    draw_at = r.get("draw_at")
-    if draw_at:
-        seconds_left = int((draw_at - datetime.now(timezone.utc)).total_seconds())
-        if seconds_left < 0:
-            seconds_left = 0
-        timer_line = f"\n⏳ До окончания: ~{seconds_left} сек."
+    if r.get("draw_at"):
+        timer_line = f"\n⏳ До окончания: ~{_seconds_left(r)} сек."
     else:
         need = max(0, 2 - len(r["participants"]))
         timer_line = f"\nОжидаем ещё {need} участника(ов) для запуска таймера."
 
     return (
-        "✅ Ставка в игре «Банкир» принята!\n\n"
+        f"✅ Ставка в игре «Банкир» принята! Комната №{r['id']}\n\n"
         f"👥 Участников: {len(r['participants'])}\n"
-        f"💰 Банк: {format_rubles(total_bank)} ₽\n"
+        f"💰 Банк: {format_rubles(r['total_bank'])} ₽\n"
         f"🪙 Вы положили: {format_rubles(user_amount)} ₽ ({user_shares}/{RAFFLE_MAX_BETS_PER_ROUND})\n"
         f"🎲 Ваш шанс: {user_chance}%"
         f"{timer_line}"
     )
 
 
-async def raffle_draw_worker(raffle_id: int):
+async def raffle_draw_worker(raffle_id: int, delay: float = RAFFLE_TIMER_SECONDS):
     """
-    Фоновая задача: ждёт RAFFLE_TIMER_SECONDS и запускает розыгрыш.
+    Фоновая задача комнаты: ждёт delay секунд (по умолчанию RAFFLE_TIMER_SECONDS)
+    и запускает розыгрыш. После перезапуска delay считается от draw_at.
     """
-    global raffle_round, raffle_task
-    await asyncio.sleep(RAFFLE_TIMER_SECONDS)
+    await asyncio.sleep(delay)
 
-    r = raffle_round
-    if not r or r.get("finished") or r.get("id") != raffle_id:
+    r = raffle_rooms.get(raffle_id)
+    if not r or r.get("finished"):
         return
 
-    await perform_raffle_draw()
-    raffle_task = None
+    r["task"] = None
+    # сам розыгрыш — через супервизор: его ошибки печатаются и считаются
+    if not spawn("raffle_draw", lambda: perform_raffle_draw(r), key=("raffle_draw", raffle_id)):
+        _start_timer(r, delay=RAFFLE_DRAW_RETRY_SECONDS)
 
 
-async def perform_raffle_draw():
+async def _load_for_draw(r: Dict[str, Any], uids: Iterable[int]) -> None:
+    """
+    Подгрузить получателей выплат. Не вышло (в режиме "lazy" это запрос
+    к БД) — раунд снова открыт, розыгрыш повторится по таймеру.
+    """
+    try:
+        await load_users(uids)
+    except Exception:
+        r["finished"] = False
+        r["finished_at"] = None
+        _start_timer(r, delay=RAFFLE_DRAW_RETRY_SECONDS)
+        raise
+
+
+def _save_round(
+    r: Dict[str, Any],
+    winner_id: Optional[int],
+    total_bank: int,
+    participant_ids: Iterable[int] = (),
+) -> None:
     """
-    Сам розыгрыш:
+    Итог раунда и накопленные ставки (pending_bets) — в unsaved_rounds
+    (а значит, в снимок) и в фоновую запись одной транзакцией.
+    Вызывается синхронно вместе с _close_room: снимок видит либо комнату,
+    либо её итог.
+    """
+    queue_round_save({
+        "id": r["id"],
+        "created_at": r["created_at"],
+        "finished_at": r["finished_at"],
+        "winner_id": winner_id,
+        "total_bank": total_bank,
+        "participant_ids": list(participant_ids),
+        "bets": [
+            (uid, amount)
+            for uid, amounts in r["pending_bets"].items()
+            for amount in amounts
+        ],
+    })
+
+
+def queue_round_save(result: Dict[str, Any]) -> None:
+    """Поставить итог раунда на запись (и при восстановлении из снимка)."""
+    unsaved_rounds[result["id"]] = result
+    mark_live_state_changed()
+    _spawn_round_save(result["id"])
+
+
+def _spawn_round_save(rid: int) -> None:
+    if rid not in unsaved_rounds:
+        return
+    if not spawn("save_raffle_round", lambda: _write_round(rid), key=("raffle_round", rid)):
+        _retry_round_save(rid)
+
+
+def _retry_round_save(rid: int) -> None:
+    raffle_save_stats["retries"] += 1
+    asyncio.get_running_loop().call_later(RAFFLE_SAVE_RETRY_SECONDS, _spawn_round_save, rid)
+
+
+async def _write_round(rid: int) -> None:
+    res = unsaved_rounds.get(rid)
+    if res is None:
+        return
+    # ставки, возвраты и выплаты раунда — в той же транзакции;
+    # снимок балансов берём синхронно, до первого await
+    key = balance_key(rid)
+    uids = unsettled_users(key)
+    rows = snapshot_users(uids, key)
+    # сброс write-behind, идущий параллельно, пишет балансы без этого раунда
+    raced = watch_flushes(uids)
+    try:
+        committed = await upsert_raffle_round(
+            res,
+            participant_ids=res["participant_ids"],
+            bets=[(rid, uid, amount) for uid, amount in res["bets"]],
+            user_rows=rows,
+        )
+    except Exception:
+        # итог остаётся в unsaved_rounds и в снимке — повторим;
+        # ошибку напечатает и посчитает супервизор
+        _retry_round_save(rid)
+        raise
+    finally:
+        unwatch_flushes(raced)
+
+    if committed is None:
+        # раунд уже был записан (или БД нет) — балансы допишет write-behind
+        requeue_unsettled(key, uids)
+    else:
+        confirm_committed_balances(key, committed, raced)
+
+    # записано — итог больше не нужен снимку
+    del unsaved_rounds[rid]
+    raffle_save_stats["saved"] += 1
+    mark_live_state_changed()
+
+
+async def perform_raffle_draw(r: Dict[str, Any]):
+    """
+    Розыгрыш комнаты r:
     - если участников < 2 — возврат ставок
-    - иначе случайный победитель по билетам (tickets)
+    - иначе случайный победитель, шанс пропорционален долям (picker)
     """
-    global raffle_round
-    r = raffle_round
-    if not r or r.get("finished"):
+    # не копим изменения балансов, если очередь записи переполнена;
+    # ждём до того, как читать раунд, — пока ждали, он мог измениться
+    await wait_for_room()
+    if r.get("finished"):
         return
 
+    # раунд закрываем для ставок и отмен сразу, до первого await:
+    # ставка, списанная в это время, вернётся (проверка finished после
+    # списания), отмена получит отказ — банк и участники дальше не меняются
+    r["finished"] = True
+    r["finished_at"] = datetime.now(timezone.utc)
+
     participants: Set[int] = r["participants"]
-    tickets: List[int] = r["tickets"]
+    picker: WeightedPicker = r["picker"]
     entry_amount: int | None = r["entry_amount"]
     total_bank: int = r["total_bank"]
 
-    if not tickets or not entry_amount:
+    if not picker or not entry_amount:
         # Нечего разыгрывать
-        r["finished"] = True
-        r["finished_at"] = datetime.now(timezone.utc)
-        await upsert_raffle_round(
-            {
-                "created_at": r["created_at"],
-                "finished_at": r["finished_at"],
-                "winner_id": None,
-                "total_bank": 0,
-            }
-        )
+        _close_room(r)
+        _round_changed(r)
+        _save_round(r, winner_id=None, total_bank=0)
         return
 
     # если участников меньше 2 — отменяем раунд и возвращаем всем деньги
     if len(participants) < 2:
-        for uid, shares in r["user_bets"].items():
-            refund_amount = shares * entry_amount
-            if refund_amount > 0:
-                change_balance(uid, refund_amount)
+        refunds = {
+            uid: shares * entry_amount
+            for uid, shares in r["user_bets"].items()
+            if shares * entry_amount > 0
+        }
+        await _load_for_draw(r, refunds)
+        for uid, refund_amount in refunds.items():
+            apply_balance_delta(
+                uid, refund_amount, "raffle_refund", r["id"], balance_key(r["id"])
+            )
+
+        r["winner_id"] = None
+        _close_room(r)
+        _round_changed(r)
+
+        _save_round(r, winner_id=None, total_bank=0, participant_ids=r["user_bets"].keys())
+
+        # как и итог с победителем — объявляем, когда он уже в снимке
+        async def announce_refunds() -> None:
+            for uid, refund_amount in refunds.items():
                 try:
                     await bot.send_message(
                         uid,
@@ -369,22 +723,11 @@ async def perform_raffle_draw():
                 except Exception:
                     pass
 
-        r["finished"] = True
-        r["finished_at"] = datetime.now(timezone.utc)
-        r["winner_id"] = None
-
-        await upsert_raffle_round(
-            {
-                "created_at": r["created_at"],
-                "finished_at": r["finished_at"],
-                "winner_id": None,
-                "total_bank": 0,
-            }
-        )
+        call_after_saved(lambda: spawn("raffle_announce", announce_refunds))
         return
 
-    # случайный победитель по «билетам»
-    winner_uid = random.choice(tickets)
+    # случайный победитель: вероятность = доли / все доли
+    winner_uid = picker.pick()
     commission = total_bank // 100
     prize = total_bank - commission
 
@@ -405,62 +748,65 @@ async def perform_raffle_draw():
             profit_by_user[uid] = -put_amount
 
     # выплаты
-    change_balance(winner_uid, prize)
-    change_balance(MAIN_ADMIN_ID, commission)
+    await _load_for_draw(r, (winner_uid, MAIN_ADMIN_ID))
+    # выплаты — в кэше, в users их запишет транзакция итога раунда
+    key = balance_key(r["id"])
+    apply_balance_delta(winner_uid, prize, "raffle_win", r["id"], key)
+    apply_balance_delta(MAIN_ADMIN_ID, commission, "raffle_commission", r["id"], key)
 
-    r["finished"] = True
-    r["finished_at"] = datetime.now(timezone.utc)
     r["winner_id"] = winner_uid
+    _close_room(r)
+    _round_changed(r)
 
-    await upsert_raffle_round(
-        {
-            "created_at": r["created_at"],
-            "finished_at": r["finished_at"],
-            "winner_id": winner_uid,
-            "total_bank": total_bank,
-        }
+    _save_round(
+        r, winner_id=winner_uid, total_bank=total_bank, participant_ids=participants
     )
 
-    # сообщения участникам
-    for uid in participants:
-        put_amount = per_user_amount.get(uid, 0)
-        shares = user_bets.get(uid, 0)
+    # сообщения участникам — только когда итог уже в записанном снимке:
+    # иначе после падения комната восстановится и разыграется заново,
+    # возможно с другим победителем
+    async def announce() -> None:
+        for uid in participants:
+            put_amount = per_user_amount.get(uid, 0)
+            shares = user_bets.get(uid, 0)
 
-        if total_bank > 0 and put_amount > 0:
-            user_chance = round((put_amount / total_bank) * 100)
-        else:
-            user_chance = 0
+            if total_bank > 0 and put_amount > 0:
+                user_chance = round((put_amount / total_bank) * 100)
+            else:
+                user_chance = 0
 
-        if total_bank > 0:
-            winner_chance = round(
-                (per_user_amount.get(winner_uid, 0) / total_bank) * 100
-            )
-        else:
-            winner_chance = 0
+            if total_bank > 0:
+                winner_chance = round(
+                    (per_user_amount.get(winner_uid, 0) / total_bank) * 100
+                )
+            else:
+                winner_chance = 0
 
-        if uid == winner_uid:
-            result_text = (
-                "🥳 Поздравляем! Вы выиграли розыгрыш Банкира!\n"
-                f"🏆 Ваш выигрыш: {format_rubles(prize)} ₽."
+            if uid == winner_uid:
+                result_text = (
+                    "🥳 Поздравляем! Вы выиграли розыгрыш Банкира!\n"
+                    f"🏆 Ваш выигрыш: {format_rubles(prize)} ₽."
+                )
+            else:
+                result_text = "😔 К сожалению, вы проиграли в этом раунде."
+
+            msg = (
+                "🏁 Розыгрыш Банкира завершён!\n\n"
+                f"👥 Участников: {len(participants)}\n"
+                f"💰 Банк составил: {format_rubles(total_bank)} ₽\n"
+                f"🎲 Шанс победителя: {winner_chance}%\n\n"
+                f"🪙 Вы положили: {format_rubles(put_amount)} ₽ ({shares}/{RAFFLE_MAX_BETS_PER_ROUND})\n"
+                f"🎯 Ваш шанс: {user_chance}%\n\n"
+                f"{result_text}\n\n"
+                f"💼 Баланс: {format_rubles(get_balance(uid))} ₽"
             )
-        else:
-            result_text = "😔 К сожалению, вы проиграли в этом раунде."
-
-        msg = (
-            "🏁 Розыгрыш Банкира завершён!\n\n"
-            f"👥 Участников: {len(participants)}\n"
-            f"💰 Банк составил: {format_rubles(total_bank)} ₽\n"
-            f"🎲 Шанс победителя: {winner_chance}%\n\n"
-            f"🪙 Вы положили: {format_rubles(put_amount)} ₽ ({shares}/{RAFFLE_MAX_BETS_PER_ROUND})\n"
-            f"🎯 Ваш шанс: {user_chance}%\n\n"
-            f"{result_text}\n\n"
-            f"💼 Баланс: {format_rubles(get_balance(uid))} ₽"
-        )
 
-        try:
-            await bot.send_message(uid, msg)
-        except Exception:
-            pass
+            try:
+                await bot.send_message(uid, msg)
+            except Exception:
+                pass
+
+    call_after_saved(lambda: spawn("raffle_announce", announce))
 
 
 async def cancel_user_bets(uid: int) -> str:
@@ -468,8 +814,8 @@ async def cancel_user_bets(uid: int) -> str:
     Отмена ставок пользователя в текущем раунде (если прошло не более 10 минут
     с его последней ставки).
     """
-    r = raffle_round
-    if not r or r.get("finished") or not r.get("tickets"):
+    r = user_room(uid)
+    if not r or r.get("finished") or not r.get("picker"):
         return "Сейчас нет активного розыгрыша с вашими ставками."
 
     user_bets: Dict[int, int] = r["user_bets"]
@@ -490,11 +836,14 @@ async def cancel_user_bets(uid: int) -> str:
     entry_amount: int = r["entry_amount"]
     refund_amount = shares * entry_amount
 
-    # возвращаем деньги
-    change_balance(uid, refund_amount)
+    # возвращаем деньги: ставки пользователя жили только в кэше, вместе
+    # с возвратом они дают ноль — раунд его больше не касается, журнал
+    # и баланс допишет write-behind
+    apply_balance_delta(uid, refund_amount, "raffle_cancel", r["id"], balance_key(r["id"]))
+    requeue_unsettled(balance_key(r["id"]), [uid])
 
-    # убираем билеты пользователя
-    r["tickets"] = [u for u in r["tickets"] if u != uid]
+    # убираем вес пользователя из розыгрыша
+    r["picker"].remove(uid)
     r["total_bank"] -= refund_amount
     if r["total_bank"] < 0:
         r["total_bank"] = 0
@@ -502,8 +851,14 @@ async def cancel_user_bets(uid: int) -> str:
     # убираем пользователя из структуры
     del user_bets[uid]
     last_bet_at.pop(uid, None)
+    r["pending_bets"].pop(uid, None)
     if uid in r["participants"]:
         r["participants"].remove(uid)
+    _user_room.pop(uid, None)
+    # опустевшая комната без таймера больше никому не нужна
+    if not r["participants"] and r.get("draw_at") is None:
+        _close_room(r)
+    _round_changed(r)
 
     return (
         f"♻ Ваши ставки в текущем раунде отменены.\n"
@@ -0,0 +1,111 @@
+# app/services/tasks.py
+
+"""
+Супервизор фоновых задач.
+
+Фоновая работа с БД (сброс балансов, журнала, снимки) не запускается
+голым create_task, а ставится сюда через spawn():
+- одновременно выполняется не больше BACKGROUND_TASKS_MAX_CONCURRENCY задач,
+  остальные ждут в очереди
+- очередь ограничена BACKGROUND_TASKS_MAX_BACKLOG: задача с тем же key,
+  что уже ждёт, заменяет её (merge), а при переполнении новая отбрасывается
+  (drop) — поэтому сюда ставится только работа, которую можно повторить
+- ошибки не теряются: печатаются и считаются по имени задачи
+- drain_tasks() при остановке дожидается очереди и запущенных задач
+"""
+
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Set, Tuple
+
+from app.config import (
+    BACKGROUND_TASKS_DRAIN_TIMEOUT,
+    BACKGROUND_TASKS_MAX_BACKLOG,
+    BACKGROUND_TASKS_MAX_CONCURRENCY,
+)
+
+TaskFactory = Callable[[], Awaitable[object]]
+
+# ждут свободного слота: key -> (имя, фабрика корутины)
+_backlog: "OrderedDict[Hashable, Tuple[str, TaskFactory]]" = OrderedDict()
+# выполняются сейчас (ссылки держим, чтобы задачи не собрал GC)
+_running: Set[asyncio.Task] = set()
+_idle = asyncio.Event()
+_idle.set()
+
+task_stats: Dict[str, int] = {
+    "submitted": 0,
+    "merged": 0,
+    "dropped": 0,
+    "done": 0,
+    "errors": 0,
+}
+# ошибки по имени задачи
+task_errors: Dict[str, int] = {}
+
+
+def spawn(name: str, factory: TaskFactory, key: Optional[Hashable] = None) -> bool:
+    """
+    Поставить фоновую задачу. factory вызывается, когда появится слот.
+    key — задачи с одинаковым key в очереди склеиваются (остаётся последняя).
+    Возвращает False, если очередь переполнена и задача отброшена.
+    """
+    task_stats["submitted"] += 1
+
+    if key is not None and key in _backlog:
+        _backlog[key] = (name, factory)
+        task_stats["merged"] += 1
+        return True
+
+    if len(_backlog) >= BACKGROUND_TASKS_MAX_BACKLOG:
+        task_stats["dropped"] += 1
+        print(f"⚠️ Очередь фоновых задач переполнена, задача {name} отброшена")
+        return False
+
+    _backlog[key if key is not None else object()] = (name, factory)
+    _idle.clear()
+    _pump()
+    return True
+
+
+def _pump() -> None:
+    """Запустить задачи из очереди, пока есть свободные слоты."""
+    while _backlog and len(_running) < BACKGROUND_TASKS_MAX_CONCURRENCY:
+        _, (name, factory) = _backlog.popitem(last=False)
+        task = asyncio.create_task(_run(name, factory), name=name)
+        _running.add(task)
+        task.add_done_callback(_on_done)
+
+
+async def _run(name: str, factory: TaskFactory) -> None:
+    try:
+        await factory()
+        task_stats["done"] += 1
+    except Exception as e:
+        task_stats["errors"] += 1
+        task_errors[name] = task_errors.get(name, 0) + 1
+        print(f"Ошибка фоновой задачи {name}:", e)
+
+
+def _on_done(task: asyncio.Task) -> None:
+    _running.discard(task)
+    _pump()
+    if not _running and not _backlog:
+        _idle.set()
+
+
+def pending_tasks() -> Tuple[int, int]:
+    """(выполняются, ждут в очереди)"""
+    return len(_running), len(_backlog)
+
+
+async def drain_tasks(timeout: float = BACKGROUND_TASKS_DRAIN_TIMEOUT) -> None:
+    """Дождаться очереди и запущенных задач (при остановке бота)."""
+    try:
+        await asyncio.wait_for(_idle.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        running, queued = pending_tasks()
+        print(
+            f"⚠️ Фоновые задачи не завершились за {timeout} с: "
+            f"выполняются {running}, в очереди {queued}"
+        )
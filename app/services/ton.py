@@ -13,7 +13,7 @@ from app.config import (
     MAIN_ADMIN_ID,
 )
 from app.db.deposits import add_ton_deposit
-from app.services.balances import change_balance, get_balance
+from app.services.balances import change_balance, get_balance, load_user
 from app.utils.formatters import format_rubles
 from app.bot import bot
 
@@ -114,7 +114,8 @@ async def ton_deposit_worker():
                     continue
 
                 # Зачисление ₽
-                change_balance(user_id, coins)
+                await load_user(user_id)
+                change_balance(user_id, coins, reason="ton_deposit")
                 processed_ton_tx.add(tx_hash)
 
                 # Запись в БД
@@ -0,0 +1,87 @@
+# app/services/user_locks.py
+
+"""
+Блокировки по пользователям для операций «проверить баланс → списать».
+
+Один глобальный замок выстроил бы в очередь весь бот, замок на каждого
+пользователя — бесконечно растущий dict. Поэтому USER_LOCK_STRIPES
+замков («полос»): пользователь попадает в полосу uid % USER_LOCK_STRIPES.
+Разные пользователи почти всегда в разных полосах и не ждут друг друга.
+- user_lock(uid) — замок одного пользователя
+- user_locks(*uids) — несколько пользователей; полосы берутся по
+  возрастанию номера, поэтому два перевода навстречу друг другу
+  не зациклятся
+Замки не реентерабельные: внутри user_locks(a, b) нельзя брать user_lock(a).
+
+Замер конкуренции: python -m app.services.user_locks
+"""
+
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+from typing import AsyncIterator, List
+
+from app.config import USER_LOCK_STRIPES
+
+_stripes: List[asyncio.Lock] = [asyncio.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+
+def user_lock(uid: int) -> asyncio.Lock:
+    return _stripes[uid % USER_LOCK_STRIPES]
+
+
+@asynccontextmanager
+async def user_locks(*uids: int) -> AsyncIterator[None]:
+    """Взять замки нескольких пользователей в фиксированном порядке."""
+    indexes = sorted({uid % USER_LOCK_STRIPES for uid in uids})
+    taken: List[asyncio.Lock] = []
+    try:
+        for i in indexes:
+            await _stripes[i].acquire()
+            taken.append(_stripes[i])
+        yield
+    finally:
+        for lock in reversed(taken):
+            lock.release()
+
+
+# =====================================================
+#                 ЗАМЕР КОНКУРЕНЦИИ
+# =====================================================
+
+async def _benchmark(users: int, ops_per_user: int, io_seconds: float) -> None:
+    import time
+
+    # денег на одно списание меньше, чем попыток: без замка кто-то уйдёт в минус
+    balances = {uid: ops_per_user - 1 for uid in range(1, users + 1)}
+
+    async def debit(uid: int, lock) -> None:
+        async with lock:
+            # проверка и списание разделены await (подгрузка из БД и т.п.)
+            if balances[uid] >= 1:
+                await asyncio.sleep(io_seconds)
+                balances[uid] -= 1
+
+    async def run(label: str, lock_for) -> None:
+        for uid in balances:
+            balances[uid] = ops_per_user - 1
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(debit(uid, lock_for(uid)) for uid in balances for _ in range(ops_per_user))
+        )
+        elapsed = time.perf_counter() - started
+        total = users * ops_per_user
+        overspent = sum(1 for b in balances.values() if b < 0)
+        print(
+            f"{label:<18} {total:>7} списаний за {elapsed:6.2f} с "
+            f"({total / elapsed:>9.0f} оп/с), ушли в минус: {overspent}"
+        )
+
+    global_lock = asyncio.Lock()
+    print(f"{users} польз. × {ops_per_user} списаний, ожидание внутри замка {io_seconds * 1000:.0f} мс")
+    await run("без замка", lambda uid: nullcontext())
+    await run("глобальный замок", lambda uid: global_lock)
+    await run("полосы", user_lock)
+
+
+if __name__ == "__main__":
+    asyncio.run(_benchmark(users=1000, ops_per_user=5, io_seconds=0.002))
@@ -0,0 +1,227 @@
+# app/services/user_state.py
+
+"""
+Состояние диалога пользователя (какой ввод бот от него ждёт).
+
+Раньше это были отдельные dict в разных модулях (ставка в кости, ставка
+в Банкире, шаги вывода и перевода), и reset_user_state должен был знать их все.
+Теперь у пользователя одна запись UserState: flow (какой сценарий),
+step (шаг внутри него) и data (собранные значения). Новый сценарий
+заменяет предыдущий, сброс — удаление одной записи.
+
+Записи живут USER_STATE_TTL_SECONDS с последнего изменения: если
+пользователь бросил ввод на полпути, запись удалит колесо таймеров.
+
+Хранилище выбирается USER_STATE_BACKEND:
+- "memory" — dict + колесо таймеров (один процесс)
+- "redis"  — Redis-совместимый сервер по REDIS_URL (несколько процессов);
+  TTL выставляется ключам, истечение делает сам сервер
+"""
+
+import asyncio
+import json
+import math
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from app.config import REDIS_URL, USER_STATE_BACKEND, USER_STATE_TTL_SECONDS
+
+# Сценарии ввода
+FLOW_DICE_BET = "dice_bet"      # ставка для новой игры в кости
+FLOW_RAFFLE_BET = "raffle_bet"  # ставка в Банкире
+FLOW_WITHDRAW = "withdraw"      # вывод TON: step "amount" / "details"
+FLOW_TRANSFER = "transfer"      # перевод: step "await_username" / "await_amount"
+
+_WHEEL_TICK_SECONDS = 1.0
+
+
+class UserState:
+    __slots__ = ("flow", "step", "data", "expires_at")
+
+    def __init__(
+        self,
+        flow: str,
+        step: Optional[str] = None,
+        data: Optional[Dict[str, Any]] = None,
+        expires_at: float = 0.0,
+    ):
+        self.flow = flow
+        self.step = step
+        self.data = data if data is not None else {}
+        self.expires_at = expires_at
+
+    def to_json(self) -> str:
+        return json.dumps({"flow": self.flow, "step": self.step, "data": self.data})
+
+    @classmethod
+    def from_json(cls, raw: str) -> "UserState":
+        d = json.loads(raw)
+        return cls(d["flow"], d.get("step"), d.get("data") or {})
+
+
+# =====================================================
+#                    ХРАНИЛИЩА
+# =====================================================
+
+class MemoryStateBackend:
+    """dict + колесо таймеров: слот = секунда истечения по модулю длины колеса."""
+
+    def __init__(self, ttl: float, tick: float = _WHEEL_TICK_SECONDS):
+        self._ttl = ttl
+        self._tick = tick
+        self._states: Dict[int, UserState] = {}
+        self._wheel: List[Set[int]] = [set() for _ in range(math.ceil(ttl / tick) + 2)]
+        self._last_tick = int(time.monotonic() / tick)
+
+    def _slot(self, expires_at: float) -> Set[int]:
+        return self._wheel[int(expires_at / self._tick) % len(self._wheel)]
+
+    def _drop(self, uid: int) -> None:
+        state = self._states.pop(uid, None)
+        if state is not None:
+            self._slot(state.expires_at).discard(uid)
+
+    async def get(self, uid: int) -> Optional[UserState]:
+        state = self._states.get(uid)
+        if state is not None and state.expires_at <= time.monotonic():
+            self._drop(uid)
+            return None
+        return state
+
+    async def set(self, uid: int, state: UserState) -> None:
+        old = self._states.get(uid)
+        if old is not None:
+            self._slot(old.expires_at).discard(uid)
+        state.expires_at = time.monotonic() + self._ttl
+        self._states[uid] = state
+        self._slot(state.expires_at).add(uid)
+
+    async def delete(self, uid: int) -> None:
+        self._drop(uid)
+
+    def expire(self) -> int:
+        """Провернуть колесо до текущего момента. Возвращает число удалённых записей."""
+        now = time.monotonic()
+        # тик t обрабатываем, когда он целиком в прошлом:
+        # у всех записей его слота expires_at < (t + 1) * tick <= now
+        current = int(now / self._tick) - 1
+        removed = 0
+        for t in range(self._last_tick + 1, current + 1):
+            slot = self._wheel[t % len(self._wheel)]
+            for uid in list(slot):
+                state = self._states.get(uid)
+                if state is not None and state.expires_at <= now:
+                    self._drop(uid)
+                    removed += 1
+        self._last_tick = max(self._last_tick, current)
+        return removed
+
+    def __len__(self) -> int:
+        return len(self._states)
+
+
+class RedisStateBackend:
+    """Состояния в Redis (или совместимом сервере) — общие для нескольких процессов."""
+
+    def __init__(self, url: str, ttl: float):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError(
+                "USER_STATE_BACKEND=redis требует пакет redis (pip install redis)"
+            ) from e
+        self._redis = redis.from_url(url, decode_responses=True)
+        self._ttl = int(ttl)
+
+    @staticmethod
+    def _key(uid: int) -> str:
+        return f"user_state:{uid}"
+
+    async def get(self, uid: int) -> Optional[UserState]:
+        raw = await self._redis.get(self._key(uid))
+        return UserState.from_json(raw) if raw else None
+
+    async def set(self, uid: int, state: UserState) -> None:
+        await self._redis.set(self._key(uid), state.to_json(), ex=self._ttl)
+
+    async def delete(self, uid: int) -> None:
+        await self._redis.delete(self._key(uid))
+
+    def expire(self) -> int:
+        return 0  # ключи истекают на стороне сервера
+
+    def __len__(self) -> int:
+        return 0  # размер знает только сервер
+
+
+def _make_backend():
+    if USER_STATE_BACKEND == "redis":
+        return RedisStateBackend(REDIS_URL, USER_STATE_TTL_SECONDS)
+    return MemoryStateBackend(USER_STATE_TTL_SECONDS)
+
+
+_backend = _make_backend()
+_expire_task: asyncio.Task | None = None
+
+user_state_stats: Dict[str, int] = {"expired": 0}
+
+
+# =====================================================
+#                       API
+# =====================================================
+
+async def get_state(uid: int, flow: Optional[str] = None) -> Optional[UserState]:
+    """Текущее состояние пользователя (если задан flow — только этого сценария)."""
+    state = await _backend.get(uid)
+    if state is None or (flow is not None and state.flow != flow):
+        return None
+    return state
+
+
+async def set_state(uid: int, flow: str, step: Optional[str] = None, **data: Any) -> UserState:
+    """Начать сценарий (предыдущий, если был, заменяется)."""
+    state = UserState(flow, step, data)
+    await _backend.set(uid, state)
+    return state
+
+
+async def save_state(uid: int, state: UserState) -> None:
+    """Сохранить изменённые step/data (TTL отсчитывается заново)."""
+    await _backend.set(uid, state)
+
+
+async def clear_state(uid: int, *flows: str) -> None:
+    """Сбросить состояние (если заданы flows — только если сейчас один из них)."""
+    if flows:
+        state = await _backend.get(uid)
+        if state is None or state.flow not in flows:
+            return
+    await _backend.delete(uid)
+
+
+def user_state_size() -> int:
+    return len(_backend)
+
+
+async def _expire_loop():
+    while True:
+        await asyncio.sleep(_WHEEL_TICK_SECONDS)
+        user_state_stats["expired"] += _backend.expire()
+
+
+def start_user_state() -> None:
+    """Запустить колесо таймеров (для хранилища в памяти)."""
+    global _expire_task
+    if isinstance(_backend, MemoryStateBackend) and not (_expire_task and not _expire_task.done()):
+        _expire_task = asyncio.create_task(_expire_loop())
+
+
+async def stop_user_state() -> None:
+    global _expire_task
+    if _expire_task:
+        _expire_task.cancel()
+        try:
+            await _expire_task
+        except asyncio.CancelledError:
+            pass
+        _expire_task = None
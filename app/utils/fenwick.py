@@ -0,0 +1,225 @@
+# app/utils/fenwick.py
+
+"""
+Взвешенный случайный выбор на дереве Фенвика.
+
+WeightedPicker хранит по одному весу на ключ (в Банкире: user_id -> число долей)
+вместо списка «билетов», где ключ повторяется столько раз, сколько у него долей.
+- set(key, weight) / remove(key) — O(log n)
+- pick(rng) — ключ с вероятностью weight / total, O(log n)
+- total и max_weight — O(1)
+Слоты удалённых ключей переиспользуются, дерево не растёт от отмен.
+
+Проверка распределения против random.choice(tickets) — ручная, тестов
+в репозитории нет (seed фиксирован, при отклонении код выхода 1):
+    python -m app.utils.fenwick
+"""
+
+import random
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+
+class WeightedPicker:
+    __slots__ = ("_tree", "_weights", "_keys", "_slots", "_free", "_total", "_counts", "_max")
+
+    def __init__(self):
+        self._tree: List[int] = [0]  # 1-based: _tree[i] — сумма весов (i - lowbit(i), i]
+        self._weights: List[int] = [0]
+        self._keys: List[Optional[Hashable]] = [None]
+        self._slots: Dict[Hashable, int] = {}
+        self._free: List[int] = []
+        self._total = 0
+        # сколько ключей с каждым весом — для max_weight без перебора ключей
+        self._counts: Dict[int, int] = {}
+        self._max = 0
+
+    # ---------- дерево ----------
+
+    def _add(self, i: int, delta: int) -> None:
+        tree = self._tree
+        n = len(tree) - 1
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, i: int) -> int:
+        tree = self._tree
+        s = 0
+        while i > 0:
+            s += tree[i]
+            i -= i & -i
+        return s
+
+    def _new_slot(self) -> int:
+        if self._free:
+            return self._free.pop()
+        # новый узел i отвечает за (i - lowbit(i), i]: вес пока 0,
+        # сумма остальных элементов этого диапазона — через префиксы
+        i = len(self._tree)
+        self._tree.append(self._prefix(i - 1) - self._prefix(i - (i & -i)))
+        self._weights.append(0)
+        self._keys.append(None)
+        return i
+
+    # ---------- счётчики весов ----------
+
+    def _count(self, weight: int, delta: int) -> None:
+        if weight <= 0:
+            return
+        c = self._counts.get(weight, 0) + delta
+        if c:
+            self._counts[weight] = c
+            if weight > self._max:
+                self._max = weight
+        else:
+            del self._counts[weight]
+            if weight == self._max:
+                # различных весов мало (в Банкире — не больше лимита долей)
+                self._max = max(self._counts, default=0)
+
+    # ---------- API ----------
+
+    def set(self, key: Hashable, weight: int) -> None:
+        """Задать вес ключа (0 — то же, что remove)."""
+        if weight < 0:
+            raise ValueError(f"Вес не может быть отрицательным: {weight}")
+        if weight == 0:
+            self.remove(key)
+            return
+
+        i = self._slots.get(key)
+        if i is None:
+            i = self._new_slot()
+            self._slots[key] = i
+            self._keys[i] = key
+
+        old = self._weights[i]
+        if old == weight:
+            return
+        self._count(old, -1)
+        self._count(weight, +1)
+        self._weights[i] = weight
+        self._add(i, weight - old)
+        self._total += weight - old
+
+    def add(self, key: Hashable, weight: int) -> None:
+        """Увеличить вес ключа."""
+        self.set(key, self.get(key) + weight)
+
+    def remove(self, key: Hashable) -> None:
+        i = self._slots.pop(key, None)
+        if i is None:
+            return
+        old = self._weights[i]
+        self._count(old, -1)
+        self._weights[i] = 0
+        self._keys[i] = None
+        self._add(i, -old)
+        self._total -= old
+        self._free.append(i)
+
+    def get(self, key: Hashable) -> int:
+        i = self._slots.get(key)
+        return self._weights[i] if i is not None else 0
+
+    @property
+    def total(self) -> int:
+        return self._total
+
+    def max_weight(self) -> int:
+        return self._max
+
+    def find(self, point: int) -> Hashable:
+        """Ключ, на чей отрезок весов попадает point из [0, total)."""
+        if not 0 <= point < self._total:
+            raise IndexError(point)
+        tree = self._tree
+        n = len(tree) - 1
+        i = 0
+        step = 1 << n.bit_length()
+        while step:
+            j = i + step
+            if j <= n and tree[j] <= point:
+                i = j
+                point -= tree[j]
+            step >>= 1
+        return self._keys[i + 1]
+
+    def pick(self, rng: random.Random = random) -> Hashable:
+        """Случайный ключ с вероятностью weight / total."""
+        if self._total <= 0:
+            raise IndexError("pick из пустого WeightedPicker")
+        return self.find(rng.randrange(self._total))
+
+    def items(self) -> Iterator[Tuple[Hashable, int]]:
+        for key, i in self._slots.items():
+            yield key, self._weights[i]
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __bool__(self) -> bool:
+        return self._total > 0
+
+
+# =====================================================
+#          ПРОВЕРКА РАСПРЕДЕЛЕНИЯ (хи-квадрат)
+# =====================================================
+
+def _chi2_critical(df: int, z: float = 3.090) -> float:
+    """Критическое значение хи-квадрат (уровень 0.001) по Уилсону–Хилферти."""
+    return df * (1 - 2 / (9 * df) + z * (2 / (9 * df)) ** 0.5) ** 3
+
+
+def _chi2(observed: Dict[Hashable, int], weights: Dict[Hashable, int], draws: int) -> float:
+    total = sum(weights.values())
+    return sum(
+        (observed.get(k, 0) - draws * w / total) ** 2 / (draws * w / total)
+        for k, w in weights.items()
+    )
+
+
+def _check(draws: int, seed: int) -> bool:
+    """Оба способа выбора укладываются в критическое значение хи-квадрат."""
+    rng = random.Random(seed)
+    # раунд как в Банкире: до 10 долей на игрока, часть игроков отменила ставки
+    weights = {uid: rng.randint(1, 10) for uid in range(1, 51)}
+    for uid in rng.sample(sorted(weights), 10):
+        del weights[uid]
+
+    # сначала ставки всех 50, потом отмены и новые веса — заодно
+    # проверяем переиспользование слотов и пересчёт max_weight
+    picker = WeightedPicker()
+    for uid in range(1, 51):
+        picker.set(uid, rng.randint(1, 10))
+    for uid in range(1, 51):
+        if uid not in weights:
+            picker.remove(uid)
+    for uid, w in weights.items():
+        picker.set(uid, w)
+    assert picker.total == sum(weights.values())
+    assert picker.max_weight() == max(weights.values())
+
+    tickets = [uid for uid, w in weights.items() for _ in range(w)]
+
+    by_tickets: Dict[Hashable, int] = {}
+    by_picker: Dict[Hashable, int] = {}
+    for _ in range(draws):
+        u = rng.choice(tickets)
+        by_tickets[u] = by_tickets.get(u, 0) + 1
+        u = picker.pick(rng)
+        by_picker[u] = by_picker.get(u, 0) + 1
+
+    df = len(weights) - 1
+    critical = _chi2_critical(df)
+    ok = True
+    for label, observed in (("random.choice(tickets)", by_tickets), ("WeightedPicker", by_picker)):
+        chi2 = _chi2(observed, weights, draws)
+        verdict = "ок" if chi2 < critical else "ОТКЛОНЕНИЕ"
+        print(f"{label:<24} χ² = {chi2:7.2f} (df={df}, порог p=0.001: {critical:.2f}) — {verdict}")
+        ok = ok and chi2 < critical
+    return ok
+
+
+if __name__ == "__main__":
+    raise SystemExit(0 if _check(draws=200_000, seed=1) else 1)
@@ -3,11 +3,25 @@ import asyncio
 
 from app.bot import bot, dp
 from app.db.pool import init_db
-from app.services.balances import user_balances, user_usernames
+from app.config import MAIN_ADMIN_ID
+from app.services.balances import (
+    is_lazy_cache,
+    load_user,
+    user_balances,
+    user_usernames,
+    username_index,
+)
+from app.services.balance_writer import start_balance_writer, stop_balance_writer
+from app.services.leaderboard import seed_leaderboard
+from app.services.live_state import restore_live_state, save_live_state
+from app.services.ledger import reconcile_ledger, start_ledger, stop_ledger
+from app.services.tasks import drain_tasks
+from app.services.user_state import start_user_state, stop_user_state
 from app.services.ton import processed_ton_tx
 
 
 # ⚠️ Хендлеры просто импортируем — при импорте они сами регистрируются
+import app.handlers.middleware
 import app.handlers.start
 import app.handlers.games_menu
 import app.handlers.balance
@@ -24,11 +38,39 @@ async def main():
         user_balances=user_balances,
         user_usernames=user_usernames,
         processed_ton_tx=processed_ton_tx,
+        preload_users=not is_lazy_cache(),
+        username_index=username_index,
     )
 
+    # ленивый кэш: админ (комиссии) всегда в памяти
+    await load_user(MAIN_ADMIN_ID)
+
+    # Рейтинг костей в памяти — одним потоковым запросом
+    await seed_leaderboard()
+
+    # Сверка users.balance с журналом (снимок + хвост)
+    await reconcile_ledger()
+
+    # Открытые игры и раунд Банкира из снимка (после сверки: возвраты
+    # за прерванные игры не должны в неё попасть наполовину)
+    await restore_live_state()
+
+    # Фоновый сброс балансов в БД (write-behind) и журнала балансов
+    start_balance_writer()
+    start_ledger()
+    start_user_state()
+
     print("🚀 Бот запущен!")
     # Запускаем пуллинг
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        # дописываем несохранённые балансы и журнал перед выходом
+        await save_live_state()
+        await stop_balance_writer()
+        await stop_ledger()
+        await stop_user_state()
+        await drain_tasks()
 
 
 if __name__ == "__main__":